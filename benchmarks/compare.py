@@ -0,0 +1,73 @@
+"""
+Сравнение двух результатов бенчмарков в JSON.
+Печатает метрики, изменившиеся больше чем на `--threshold`, и завершается
+с кодом 1, если среди них есть ухудшения. Метрики со `per_second` в имени
+лучше при росте, остальные - задержки, размеры и запросы - при снижении.
+
+Запуск:
+    python benchmarks/compare.py baseline.json current.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+from typing import Any
+
+
+def flatten(value: Any, prefix: str = '') -> dict[str, float]:
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        # Строки таблицы различаются по первому полю, например числу сообщений
+        items = (
+            (f'{next(iter(row.values()))}' if isinstance(row, dict) and row else str(i), row)
+            for i, row in enumerate(value)
+        )
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: float(value)}
+    else:
+        return {}
+    metrics: dict[str, float] = {}
+    for key, item in items:
+        metrics.update(flatten(item, f'{prefix}.{key}' if prefix else str(key)))
+    return metrics
+
+
+def compare(baseline: Any, current: Any, threshold: float) -> dict[str, dict]:
+    before: dict[str, float] = flatten(baseline)
+    after: dict[str, float] = flatten(current)
+    changes: dict[str, dict] = {}
+    for name in sorted(before.keys() & after.keys()):
+        if not before[name]:
+            continue
+        change: float = (after[name] - before[name]) / abs(before[name])
+        if abs(change) < threshold:
+            continue
+        worse: bool = change < 0 if 'per_second' in name else change > 0
+        changes[name] = {
+            'baseline': before[name],
+            'current': after[name],
+            'change': round(change, 4),
+            'regression': worse,
+        }
+    return changes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.1, help='относительное изменение')
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline, open(args.current) as current:
+        changes: dict[str, dict] = compare(json.load(baseline), json.load(current), args.threshold)
+    print(json.dumps(changes, ensure_ascii=False, indent=2))
+    if any(change['regression'] for change in changes.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
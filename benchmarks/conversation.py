@@ -0,0 +1,65 @@
+"""
+Время операций переписки в зависимости от её длины.
+
+Запуск:
+    PYTHONPATH=src python benchmarks/conversation.py
+"""
+import argparse
+import json
+import statistics
+import time
+from typing import Callable
+
+from hpc_bot.model.conversion import Conversation, Message, Role
+
+
+def build_conversation(count: int) -> Conversation:
+    conversation: Conversation = Conversation()
+    for i in range(count):
+        role: Role = Role.USER if i % 2 == 0 else Role.BOT
+        conversation.append(Message(role=role, content=f'Сообщение номер {i} про кластер'))
+    return conversation
+
+
+def measure(func: Callable[[], object], repeats: int) -> float:
+    timings: list[float] = []
+    for _ in range(repeats):
+        started: float = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1_000_000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=100)
+    parser.add_argument('--messages', type=int, nargs='+', default=[10, 100, 1_000, 10_000])
+    args = parser.parse_args()
+
+    results: list[dict] = []
+    for count in args.messages:
+        conversation: Conversation = build_conversation(count)
+        conversation.get_prompt()
+
+        def turn() -> None:
+            # Ход пользователя: добавить сообщение, собрать промпт и сдвинуть окно
+            conversation.append(Message(role=Role.USER, content='Новый вопрос'))
+            conversation.get_prompt()
+            conversation.pop_first_message()
+
+        results.append({
+            'messages': count,
+            'append_us': measure(
+                lambda: conversation.append(Message(role=Role.USER, content='Новый вопрос')),
+                args.repeats
+            ),
+            'get_prompt_us': measure(conversation.get_prompt, args.repeats),
+            'size_us': measure(lambda: conversation.size, args.repeats),
+            'window_turn_us': measure(turn, args.repeats),
+            'build_us': measure(lambda: build_conversation(count), max(1, args.repeats // 10)),
+        })
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Скорость генерации на процессоре для разных типов весов и числа потоков.
+
+Без `--model` используется случайная модель Llama заданного размера.
+
+Запуск:
+    PYTHONPATH=src python benchmarks/cpu_backend.py --precisions bf16 int8 fp32 --threads 1 4
+"""
+import argparse
+import copy
+import json
+import statistics
+import time
+
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    LlamaConfig,
+    LlamaForCausalLM,
+    PreTrainedModel,
+)
+
+from hpc_bot.model.backend import CpuBackend
+
+
+def load_model(args: argparse.Namespace) -> PreTrainedModel:
+    if args.model is not None:
+        return AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32)
+    torch.manual_seed(0)
+    return LlamaForCausalLM(LlamaConfig(
+        vocab_size=32000,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.layers,
+        num_attention_heads=8
+    ))
+
+
+def tokens_per_second(model: PreTrainedModel, backend: CpuBackend, args: argparse.Namespace) -> float:
+    input_ids: torch.Tensor = torch.randint(10, 1000, (1, args.prompt_tokens))
+    inputs: dict = {
+        'input_ids': input_ids,
+        'attention_mask': torch.ones_like(input_ids),
+        'pad_token_id': 0,
+        'do_sample': False,
+    }
+    timings: list[float] = []
+    with backend.inference_mode():
+        model.generate(**inputs, max_new_tokens=2)
+        for _ in range(args.repeats):
+            started: float = time.perf_counter()
+            model.generate(**inputs, min_new_tokens=args.new_tokens, max_new_tokens=args.new_tokens)
+            timings.append(time.perf_counter() - started)
+    return args.new_tokens / statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--model', default=None, help='путь или имя causal LM')
+    parser.add_argument('--hidden-size', type=int, default=512)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--precisions', nargs='+', default=list(CpuBackend.PRECISIONS))
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--prompt-tokens', type=int, default=128)
+    parser.add_argument('--new-tokens', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    base: PreTrainedModel = load_model(args)
+    results: list[dict] = []
+    for precision in args.precisions:
+        backend: CpuBackend = CpuBackend(precision=precision)
+        model: PreTrainedModel = backend.prepare(copy.deepcopy(base).to(backend.dtype))
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            results.append({
+                'precision': precision,
+                'threads': threads,
+                'tokens_per_second': tokens_per_second(model, backend, args),
+            })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Общие части нагрузочных и микробенчмарков: Redis, подсчёт запросов к нему,
+перцентили и запись результатов в JSON для сравнения между версиями.
+"""
+import json
+import math
+import statistics
+import sys
+from typing import Any
+
+import redis.asyncio as redis
+
+
+def redis_clients(host: str | None) -> tuple[redis.Redis, redis.Redis]:
+    """
+    Клиенты Redis с декодированием ответов и без него.
+    Без адреса используется fakeredis в памяти процесса: он не измеряет сеть,
+    но выполняет те же Lua скрипты и позволяет посчитать запросы.
+    """
+    if host:
+        return (
+            redis.Redis(host=host, port=6379, decode_responses=True),
+            redis.Redis(host=host, port=6379, decode_responses=False),
+        )
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("Без --redis нужен fakeredis[lua]: pip install 'fakeredis[lua]'")
+    server: fakeredis.FakeServer = fakeredis.FakeServer()
+    return (
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=True),
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=False),
+    )
+
+
+class RoundTrips:
+    """
+    Счётчик запросов к Redis: команда, скрипт и конвейер считаются за один запрос.
+    """
+
+    def __init__(self, *clients: redis.Redis) -> None:
+        self.count: int = 0
+        for client in clients:
+            self._instrument(client)
+
+    def _instrument(self, client: redis.Redis) -> None:
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+
+        async def counted_command(*args: Any, **kwargs: Any) -> Any:
+            self.count += 1
+            return await execute_command(*args, **kwargs)
+
+        def counted_pipeline(*args: Any, **kwargs: Any) -> Any:
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            async def counted_execute(*args: Any, **kwargs: Any) -> Any:
+                self.count += 1
+                return await execute(*args, **kwargs)
+
+            pipe.execute = counted_execute
+            return pipe
+
+        client.execute_command = counted_command
+        client.pipeline = counted_pipeline
+
+
+def percentiles(values: list[float], scale: float = 1000) -> dict[str, float]:
+    """
+    Медиана, p95 и p99 значений, по умолчанию секунды переводятся в миллисекунды.
+    """
+    ordered: list[float] = sorted(values)
+
+    def rank(q: float) -> float:
+        return ordered[max(0, math.ceil(q * len(ordered)) - 1)] * scale
+
+    return {
+        'p50': statistics.median(ordered) * scale,
+        'p95': rank(0.95),
+        'p99': rank(0.99),
+    }
+
+
+def emit(result: Any, output: str | None) -> None:
+    """
+    Напечатать результат в JSON и при необходимости сохранить его в файл.
+    """
+    text: str = json.dumps(result, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text + '\n')
+    print(text)
@@ -0,0 +1,116 @@
+"""
+Нагрузочный тест конвейера бота без модели и Telegram.
+Запускает `--chats` одновременных чатов, каждый из которых делает `--turns`
+ходов через ModelManager.answer. Вместо модели работает имитация с задержкой
+на каждый токен промпта и ответа, одновременно выполняется не больше
+`--engine-concurrency` генераций, как на одной видеокарте.
+Считает перцентили задержки хода, пропускную способность и число
+запросов к Redis на ход.
+
+Запуск:
+    PYTHONPATH=src python benchmarks/load_test.py --chats 100 --turns 10 [--redis localhost]
+"""
+import argparse
+import asyncio
+import time
+from typing import AsyncIterator
+
+from harness import RoundTrips, emit, percentiles, redis_clients
+
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.telegram.cache import ConversationCache
+from hpc_bot.telegram.manager import ModelManager
+
+
+class FakeInference:
+    """
+    Имитация модели: время генерации растёт с длиной промпта и ответа.
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self._prompt_latency: float = args.prompt_token_ms / 1000
+        self._output_latency: float = args.output_token_ms / 1000
+        self._output_tokens: int = args.output_tokens
+        self._chars_per_token: float = args.chars_per_token
+        self._engine: asyncio.Semaphore = asyncio.Semaphore(args.engine_concurrency)
+
+    async def __call__(self, conversation: Conversation) -> str:
+        return ''.join([chunk async for chunk in self.stream(conversation)])
+
+    async def stream(self, conversation: Conversation) -> AsyncIterator[str]:
+        prompt_tokens: float = len(conversation.get_prompt()) / self._chars_per_token
+        async with self._engine:
+            await asyncio.sleep(prompt_tokens * self._prompt_latency)
+            for _ in range(self._output_tokens):
+                await asyncio.sleep(self._output_latency)
+                yield 'токен '
+
+    async def invalidate(self, chat_id: int) -> None:
+        pass
+
+
+async def chat(
+    manager: ModelManager,
+    chat_id: int,
+    args: argparse.Namespace,
+    latencies: list[float]
+) -> None:
+    for turn in range(args.turns):
+        started: float = time.perf_counter()
+        await manager.answer(chat_id, f'Вопрос {turn} про очередь задач на кластере', 'UserMode:window')
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(args.think)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    cache, raw = redis_clients(args.redis)
+    conversations: ConversationCache = ConversationCache(cache, raw)
+    manager: ModelManager = ModelManager(inference=FakeInference(args), cache=conversations)
+
+    chat_ids: range = range(10_000_000, 10_000_000 + args.chats)
+    for chat_id in chat_ids:
+        await conversations.clear_conversion(chat_id)
+        await manager.start_conversion(chat_id, f'load{chat_id}')
+        for i in range(args.history):
+            role: Role = Role.USER if i % 2 == 0 else Role.BOT
+            await conversations.put_message(chat_id, Message(role=role, content=f'Старое сообщение {i}'))
+
+    round_trips: RoundTrips = RoundTrips(cache, raw)
+    latencies: list[float] = []
+    started: float = time.perf_counter()
+    await asyncio.gather(*(chat(manager, chat_id, args, latencies) for chat_id in chat_ids))
+    elapsed: float = time.perf_counter() - started
+
+    for chat_id in chat_ids:
+        await conversations.clear_conversion(chat_id)
+    return {
+        'chats': args.chats,
+        'turns': len(latencies),
+        'latency_ms': percentiles(latencies),
+        'turns_per_second': len(latencies) / elapsed,
+        'redis_round_trips_per_turn': round_trips.count / len(latencies),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--redis', default=None, help='адрес Redis, без него используется fakeredis')
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--history', type=int, default=0, help='сообщений в чате до начала теста')
+    parser.add_argument('--think', type=float, default=0.0, help='пауза пользователя между ходами, с')
+    parser.add_argument('--prompt-token-ms', type=float, default=0.05)
+    parser.add_argument('--output-token-ms', type=float, default=0.5)
+    parser.add_argument('--output-tokens', type=int, default=16)
+    parser.add_argument('--chars-per-token', type=float, default=4.0)
+    parser.add_argument('--engine-concurrency', type=int, default=1)
+    parser.add_argument('--output', default=None, help='файл для результата в JSON')
+    args = parser.parse_args()
+    emit(asyncio.run(run(args)), args.output)
+
+
+if __name__ == '__main__':
+    main()
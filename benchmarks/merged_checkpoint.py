@@ -0,0 +1,110 @@
+"""
+Сравнение загрузки модели с адаптером поверх базовых весов и объединённого чекпоинта:
+время загрузки, прирост памяти процесса и задержка на токен.
+
+Без `--adapter` собирается небольшая случайная модель Llama с LoRA адаптером.
+Каждый вариант загружается в отдельном процессе, чтобы замеры памяти не мешали друг другу.
+
+Запуск:
+    PYTHONPATH=src python benchmarks/merged_checkpoint.py --hidden-size 512 --layers 8
+"""
+import argparse
+import json
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
+
+import psutil
+import torch
+from peft import LoraConfig, PeftConfig, PeftModel, get_peft_model
+from transformers import (
+    AutoModelForCausalLM,
+    LlamaConfig,
+    LlamaForCausalLM,
+    PreTrainedModel,
+)
+
+from hpc_bot.model.checkpoint import load_merged, merge_adapter, read_manifest
+
+
+def build_adapter(folder: Path, args: argparse.Namespace) -> str:
+    torch.manual_seed(0)
+    base: LlamaForCausalLM = LlamaForCausalLM(LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.layers,
+        num_attention_heads=8
+    ))
+    base.save_pretrained(folder / 'base', safe_serialization=True)
+    model: PeftModel = get_peft_model(
+        base,
+        LoraConfig(r=args.rank, target_modules=['q_proj', 'k_proj', 'v_proj', 'o_proj'])
+    )
+    model.peft_config['default'].base_model_name_or_path = str(folder / 'base')
+    model.save_pretrained(folder / 'adapter')
+    return str(folder / 'adapter')
+
+
+def load(variant: str, adapter: str, merged: str) -> PreTrainedModel:
+    if variant == 'merged':
+        return load_merged(merged, read_manifest(merged, adapter))
+    config: PeftConfig = PeftConfig.from_pretrained(adapter)
+    base: PreTrainedModel = AutoModelForCausalLM.from_pretrained(config.base_model_name_or_path)
+    return PeftModel.from_pretrained(base, adapter).eval()
+
+
+def measure(variant: str, adapter: str, merged: str, tokens: int, queue: multiprocessing.Queue) -> None:
+    process: psutil.Process = psutil.Process()
+    rss: int = process.memory_info().rss
+    started: float = time.perf_counter()
+    model: PreTrainedModel = load(variant, adapter, merged)
+    load_seconds: float = time.perf_counter() - started
+    loaded_rss: int = process.memory_info().rss
+
+    input_ids: torch.Tensor = torch.tensor([[1] + list(range(10, 42))])
+    inputs: dict = {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids), 'pad_token_id': 0}
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=2, do_sample=False)
+        started = time.perf_counter()
+        model.generate(**inputs, min_new_tokens=tokens, max_new_tokens=tokens, do_sample=False)
+    queue.put({
+        'variant': variant,
+        'load_seconds': load_seconds,
+        'rss_mb': (loaded_rss - rss) / 2 ** 20,
+        'ms_per_token': (time.perf_counter() - started) / tokens * 1000,
+    })
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--adapter', default=None, help='имя или путь LoRA адаптера')
+    parser.add_argument('--vocab-size', type=int, default=32000)
+    parser.add_argument('--hidden-size', type=int, default=256)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--rank', type=int, default=16)
+    parser.add_argument('--tokens', type=int, default=32)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as folder:
+        adapter: str = args.adapter or build_adapter(Path(folder), args)
+        merged: str = str(Path(folder) / 'merged')
+        merge_adapter(adapter, merged, dtype='float32')
+
+        results: list[dict] = []
+        for variant in ('adapter', 'merged'):
+            queue: multiprocessing.Queue = context.Queue()
+            process = context.Process(target=measure, args=(variant, adapter, merged, args.tokens, queue))
+            process.start()
+            results.append(queue.get())
+            process.join()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
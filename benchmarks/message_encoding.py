@@ -0,0 +1,84 @@
+"""
+Сравнение хранения сообщений в JSON и в двоичном формате.
+Считает объём записей на 1000 сообщений и скорость их разбора.
+С `--redis` дополнительно измеряет `MEMORY USAGE` списка в Redis.
+
+Запуск:
+    PYTHONPATH=src python benchmarks/message_encoding.py [--redis localhost]
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+from typing import Callable
+
+import redis
+from hpc_bot.model.conversion import Message, Role
+from hpc_bot.telegram.codec import decode_message, encode_message
+
+WORDS: list[str] = ['кластер', 'задача', 'узел', 'очередь', 'slurm', 'память', 'GPU', 'ответ']
+
+
+def build_messages(count: int, length: int) -> list[Message]:
+    rng: random.Random = random.Random(0)
+    return [
+        Message(
+            role=Role.USER if i % 2 == 0 else Role.BOT,
+            content=' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, length)))
+        )
+        for i in range(count)
+    ]
+
+
+def decode_rate(decode: Callable[[bytes], Message], records: list[bytes], repeats: int) -> float:
+    timings: list[float] = []
+    for _ in range(repeats):
+        started: float = time.perf_counter()
+        for record in records:
+            decode(record)
+        timings.append(time.perf_counter() - started)
+    return len(records) / statistics.median(timings)
+
+
+def redis_usage(client: redis.Redis, records: list[bytes]) -> int:
+    key: str = 'benchmark:message_encoding'
+    client.delete(key)
+    client.rpush(key, *records)
+    usage: int = client.memory_usage(key, samples=0)
+    client.delete(key)
+    return usage
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--words', type=int, nargs='+', default=[8, 64, 512])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--redis', default=None, help='адрес Redis для измерения MEMORY USAGE')
+    args = parser.parse_args()
+
+    client: redis.Redis | None = redis.Redis(host=args.redis) if args.redis else None
+    formats: dict[str, tuple[Callable[[Message], bytes], Callable[[bytes], Message]]] = {
+        'json': (lambda message: message.model_dump_json().encode(), Message.model_validate_json),
+        'binary': (encode_message, decode_message),
+    }
+    results: list[dict] = []
+    for words in args.words:
+        messages: list[Message] = build_messages(args.messages, words)
+        for name, (encode, decode) in formats.items():
+            records: list[bytes] = [encode(message) for message in messages]
+            result: dict = {
+                'format': name,
+                'max_words': words,
+                'bytes_per_1000': sum(map(len, records)) * 1000 // len(records),
+                'decode_per_second': decode_rate(decode, records, args.repeats),
+            }
+            if client is not None:
+                result['redis_bytes_per_1000'] = redis_usage(client, records) * 1000 // len(records)
+            results.append(result)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Микробенчмарки шагов конвейера в зависимости от длины истории чата:
+сборка промпта, размер переписки, сжатие переписки менеджером
+и сериализация истории кэшем переписок.
+
+Запуск:
+    PYTHONPATH=src python benchmarks/pipeline.py [--redis localhost] [--output result.json]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Awaitable, Callable
+
+from harness import RoundTrips, emit, redis_clients
+
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.telegram.cache import ConversationCache
+from hpc_bot.telegram.codec import decode_message, encode_message
+from hpc_bot.telegram.manager import ModelManager
+
+CHAT_ID: int = 20_000_000
+
+
+class NoInference:
+    """
+    Заглушка модели: сжатию переписки нужен только сброс состояния чата.
+    """
+
+    async def invalidate(self, chat_id: int) -> None:
+        pass
+
+
+def build_messages(count: int) -> list[Message]:
+    return [
+        Message(role=Role.USER if i % 2 == 0 else Role.BOT, content=f'Сообщение номер {i} про кластер')
+        for i in range(count)
+    ]
+
+
+def measure(func: Callable[[], object], repeats: int) -> float:
+    timings: list[float] = []
+    for _ in range(repeats):
+        started: float = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1_000_000
+
+
+async def measure_async(
+    func: Callable[[], Awaitable[object]],
+    repeats: int,
+    setup: Callable[[], Awaitable[object]] | None = None
+) -> float:
+    timings: list[float] = []
+    for _ in range(repeats):
+        if setup is not None:
+            await setup()
+        started: float = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1_000_000
+
+
+async def run(args: argparse.Namespace) -> list[dict]:
+    cache, raw = redis_clients(args.redis)
+    conversations: ConversationCache = ConversationCache(cache, raw)
+    manager: ModelManager = ModelManager(inference=NoInference(), cache=conversations)
+    round_trips: RoundTrips = RoundTrips(cache, raw)
+
+    results: list[dict] = []
+    for count in args.messages:
+        messages: list[Message] = build_messages(count)
+        conversation: Conversation = Conversation(messages=[manager.start_message, *messages])
+        records: list[bytes] = [encode_message(message) for message in messages]
+
+        windows: list[Conversation] = []
+
+        async def fresh_window() -> None:
+            windows[:] = [Conversation(messages=[manager.start_message, *messages])]
+
+        async def compress() -> None:
+            # Половина переписки выбрасывается, как при переполнении контекста
+            await manager.compress_conversation(windows[0], CHAT_ID, windows[0].size // 2)
+
+        await conversations.clear_conversion(CHAT_ID)
+        await conversations.start_conversation(CHAT_ID, 'bench')
+        for message in messages:
+            await conversations.put_message(CHAT_ID, message)
+
+        async def cold_read() -> None:
+            conversations.history.invalidate(CHAT_ID)
+
+        async def turn() -> None:
+            await conversations.open_turn(CHAT_ID, Message(role=Role.USER, content='Новый вопрос'))
+            await conversations.close_turn(CHAT_ID, Message(role=Role.BOT, content='Ответ'), drop=2)
+
+        # Первый ход загружает Lua скрипты в Redis и не учитывается
+        await conversations.get_correspondence(CHAT_ID)
+        await turn()
+        round_trips.count = 0
+        turn_us: float = await measure_async(turn, args.repeats)
+        turn_round_trips: float = round_trips.count / args.repeats
+
+        results.append({
+            'messages': count,
+            'get_prompt_us': measure(conversation.get_prompt, args.repeats),
+            'size_us': measure(lambda: conversation.size, args.repeats),
+            'compress_us': await measure_async(compress, args.repeats, setup=fresh_window),
+            'encode_history_us': measure(lambda: [encode_message(m) for m in messages], args.repeats),
+            'decode_history_us': measure(lambda: [decode_message(r) for r in records], args.repeats),
+            'cache_cold_read_us': await measure_async(
+                lambda: conversations.get_correspondence(CHAT_ID),
+                args.repeats,
+                setup=cold_read
+            ),
+            'cache_turn_us': turn_us,
+            'cache_turn_round_trips': turn_round_trips,
+        })
+        await conversations.clear_conversion(CHAT_ID)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--redis', default=None, help='адрес Redis, без него используется fakeredis')
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--messages', type=int, nargs='+', default=[10, 100, 1_000])
+    parser.add_argument('--output', default=None, help='файл для результата в JSON')
+    args = parser.parse_args()
+    emit(asyncio.run(run(args)), args.output)
+
+
+if __name__ == '__main__':
+    main()
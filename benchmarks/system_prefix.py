@@ -0,0 +1,78 @@
+"""
+Сравнение времени предзаполнения промпта с нуля и с общим состоянием системного промпта.
+
+Запуск:
+    PYTHONPATH=src python benchmarks/system_prefix.py --model <путь или имя causal LM>
+Без `--model` загружается основная модель бота.
+"""
+import argparse
+import json
+import statistics
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.inference import ModelInference
+from hpc_bot.model.prefix_cache import PastKeyValues
+
+
+def load_inference(model_name: str | None) -> ModelInference:
+    if model_name is None:
+        return ModelInference()
+    return ModelInference.from_components(
+        tokenizer=AutoTokenizer.from_pretrained(model_name),
+        model=AutoModelForCausalLM.from_pretrained(model_name),
+        generation_config=GenerationConfig(max_new_tokens=1)
+    )
+
+
+def prefill_time(inference: ModelInference, input_ids: torch.Tensor, past: PastKeyValues | None) -> float:
+    started: float = time.perf_counter()
+    with torch.no_grad():
+        inference.model(input_ids=input_ids, past_key_values=past, use_cache=True)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--model', default=None)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--messages', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    inference: ModelInference = load_inference(args.model)
+    results: list[dict] = []
+    for count in args.messages:
+        conversation: Conversation = Conversation()
+        for i in range(count):
+            conversation.append(Message(role=Role.USER, content=f'Вопрос номер {i} про кластер'))
+        prompt: str = inference.render(conversation)
+        input_ids: torch.Tensor = inference.tokenizer(
+            prompt,
+            return_tensors='pt',
+            add_special_tokens=False
+        )['input_ids'].to(inference.model.device)
+        inference(conversation)
+        covered, past = inference.prefix_cache.lookup(None, input_ids[0])
+
+        full: list[float] = [prefill_time(inference, input_ids, None) for _ in range(args.repeats)]
+        suffix: list[float] = [
+            prefill_time(inference, input_ids[:, covered:], past)
+            for _ in range(args.repeats)
+        ]
+        results.append({
+            'messages': count,
+            'prompt_tokens': input_ids.shape[1],
+            'shared_tokens': covered,
+            'full_prefill_ms': statistics.median(full) * 1000,
+            'suffix_prefill_ms': statistics.median(suffix) * 1000,
+        })
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Нагрузочная проверка приёма обновлений через вебхук без сети Telegram.
+Отправляет синтетические обновления с сообщениями POST-запросами и измеряет
+время подтверждения и пропускную способность приёма.
+
+Без `--url` поднимает локальный вебхук с диспетчером, который только
+считает сообщения и имитирует обработку задержкой `--handler-delay`.
+С `--url` отправляет обновления в уже запущенного бота в режиме webhook.
+
+Запуск:
+    PYTHONPATH=src python benchmarks/webhook_intake.py --updates 5000 --concurrency 100
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiohttp import ClientSession, web
+
+from hpc_bot.telegram.webhook import WEBHOOK_PATH, build_application
+
+FAKE_TOKEN: str = '123456:' + 'A' * 35
+
+
+def make_update(update_id: int, chat_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load'},
+            'text': f'Синтетическое сообщение {update_id}',
+        },
+    }
+
+
+async def start_local_bot(args: argparse.Namespace, handled: list[float]) -> tuple[web.AppRunner, str]:
+    dispatcher: Dispatcher = Dispatcher()
+
+    @dispatcher.message()
+    async def count(message: Message) -> None:
+        await asyncio.sleep(args.handler_delay)
+        handled.append(time.perf_counter())
+
+    app: web.Application = build_application(
+        dispatcher,
+        Bot(FAKE_TOKEN),
+        workers=args.workers,
+        max_pending=args.queue
+    )
+    runner: web.AppRunner = web.AppRunner(app)
+    await runner.setup()
+    site: web.TCPSite = web.TCPSite(runner, host='127.0.0.1', port=0)
+    await site.start()
+    port: int = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}{WEBHOOK_PATH}'
+
+
+async def run(args: argparse.Namespace) -> dict:
+    handled: list[float] = []
+    runner: web.AppRunner | None = None
+    url: str = args.url
+    if not url:
+        runner, url = await start_local_bot(args, handled)
+
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    updates: asyncio.Queue = asyncio.Queue()
+    for update_id in range(args.updates):
+        updates.put_nowait(make_update(update_id, update_id % args.chats))
+
+    async def client(session: ClientSession) -> None:
+        while not updates.empty():
+            update: dict = updates.get_nowait()
+            sent: float = time.perf_counter()
+            async with session.post(url, json=update, headers=args.headers) as response:
+                await response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            latencies.append(time.perf_counter() - sent)
+
+    started: float = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(client(session) for _ in range(args.concurrency)))
+    acked: float = time.perf_counter() - started
+
+    accepted: int = statuses.get(200, 0)
+    if runner is not None:
+        while len(handled) < accepted:
+            await asyncio.sleep(0.01)
+        await runner.cleanup()
+
+    latencies.sort()
+    result: dict = {
+        'updates': args.updates,
+        'concurrency': args.concurrency,
+        'statuses': statuses,
+        'ack_per_second': args.updates / acked,
+        'ack_p50_ms': statistics.median(latencies) * 1000,
+        'ack_p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+    if runner is not None:
+        result['processed_per_second'] = accepted / (max(handled, default=started) - started)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--url', default=None, help='адрес вебхука запущенного бота')
+    parser.add_argument('--secret', default=None, help='секрет вебхука запущенного бота')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--queue', type=int, default=1024)
+    parser.add_argument('--handler-delay', type=float, default=0.01)
+    args = parser.parse_args()
+    args.headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+    print(json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
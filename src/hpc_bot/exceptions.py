@@ -10,3 +10,62 @@ class NoExistChatError(Exception):
     Ошибка несуществующего чата
     """
     ...
+
+
+class TooLongMessageError(Exception):
+    """
+    Ошибка сообщения, которое не помещается в контекст модели
+    """
+    ...
+
+
+class ContextOverflowError(Exception):
+    """
+    Ошибка переполнения контекста переписки
+    """
+    ...
+
+
+class BusyError(Exception):
+    """
+    Ошибка переполненной очереди запросов к модели
+    """
+
+    def __init__(self, position: int) -> None:
+        super().__init__(position)
+        self.position: int = position
+
+
+class RateLimitError(Exception):
+    """
+    Ошибка слишком частых сообщений пользователя
+    """
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(retry_after)
+        self.retry_after: float = retry_after
+
+
+class InferenceJobError(RuntimeError):
+    """
+    Ошибка задачи генерации, выполнявшейся в процессе инференса
+    """
+    ...
+
+
+class WarmingUpError(Exception):
+    """
+    Ошибка запроса к модели, которая ещё загружается
+    """
+    ...
+
+
+class MemoryLimitError(Exception):
+    """
+    Ошибка нехватки памяти процесса для генерации на процессоре
+    """
+
+    def __init__(self, required: int = 0, available: int = 0) -> None:
+        super().__init__(required, available)
+        self.required: int = required
+        self.available: int = available
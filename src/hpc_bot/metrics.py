@@ -1,47 +1,280 @@
 import asyncio
-from pathlib import Path
+import bisect
+import os
+from typing import TYPE_CHECKING, Final
 
-from prometheus_client import Gauge, Summary
+from prometheus_client import Counter, Gauge, Histogram, Summary
 
-from hpc_bot.telegram.cache import ConversationCache
+if TYPE_CHECKING:
+    # Кэш сам пишет метрики, поэтому импортируется только для аннотаций
+    from hpc_bot.telegram.cache import ConversationCache
 
-DEPTH_CONVERSION: Gauge = Gauge('depth_conversion', 'Глубина чата с пользователем', ['chat_id'])
+DEPTH_BUCKETS: Final[tuple[float, ...]] = (2, 4, 8, 16, 32, 64, 128, 256, 512, float('inf'))
+DEPTH_CHATS: Gauge = Gauge(
+    'conversation_depth_chats',
+    'Количество чатов с глубиной переписки не больше bound',
+    ['bound']
+)
+CONVERSATION_DEPTH: Histogram = Histogram(
+    'conversation_depth_on_write',
+    'Глубина переписки после записи сообщения',
+    buckets=DEPTH_BUCKETS
+)
 CHAT_COUNTS: Gauge = Gauge('quantity_chats', 'Количество открытых чатов')
 REQUEST_TIME: Summary = Summary('request_processing_seconds', 'Время выполнения запроса')
 WEIGHTS_SIZE: Gauge = Gauge('weights_size', 'Размер весов модели')
+FIRST_VISIBLE_TOKEN_TIME: Histogram = Histogram(
+    'first_visible_token_seconds',
+    'Время от получения сообщения до появления первого куска ответа в Telegram',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+)
+FAST_BUCKETS: Final[tuple[float, ...]] = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+LATENCY_BUCKETS: Final[tuple[float, ...]] = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+TOKEN_BUCKETS: Final[tuple[float, ...]] = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+TOKENIZATION_TIME: Histogram = Histogram(
+    'prompt_tokenization_seconds',
+    'Время токенизации промпта: целиком или сборкой из сохранённых токенов',
+    ['method', 'mode'],
+    buckets=FAST_BUCKETS
+)
+QUEUE_WAIT_TIME: Histogram = Histogram(
+    'inference_queue_wait_seconds',
+    'Время ожидания запроса в очереди до начала генерации',
+    ['mode'],
+    buckets=LATENCY_BUCKETS
+)
+PREFILL_TIME: Histogram = Histogram(
+    'inference_prefill_seconds',
+    'Время обработки промпта моделью до первого токена ответа',
+    ['mode'],
+    buckets=LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN: Histogram = Histogram(
+    'inference_time_to_first_token_seconds',
+    'Время от начала вызова модели до первого токена ответа',
+    ['mode'],
+    buckets=LATENCY_BUCKETS
+)
+DECODE_RATE: Histogram = Histogram(
+    'inference_decode_tokens_per_second',
+    'Скорость генерации токенов ответа после первого',
+    ['mode'],
+    buckets=(1, 2, 5, 10, 20, 40, 80, 160, 320)
+)
+PROMPT_TOKENS: Histogram = Histogram(
+    'inference_prompt_tokens',
+    'Количество токенов промпта',
+    ['mode'],
+    buckets=TOKEN_BUCKETS
+)
+GENERATED_TOKENS: Histogram = Histogram(
+    'inference_generated_tokens',
+    'Количество сгенерированных токенов ответа',
+    ['mode'],
+    buckets=TOKEN_BUCKETS
+)
+DETOKENIZE_TIME: Histogram = Histogram(
+    'inference_detokenize_seconds',
+    'Время декодирования токенов ответа в текст',
+    ['mode'],
+    buckets=FAST_BUCKETS
+)
+GENERATION_TIME: Histogram = Histogram(
+    'inference_generation_seconds',
+    'Время генерации одиночного ответа обычным или спекулятивным декодированием',
+    ['mode', 'decoding'],
+    buckets=LATENCY_BUCKETS
+)
+GENERATION_RATE: Histogram = Histogram(
+    'inference_generation_tokens_per_second',
+    'Скорость генерации одиночного ответа вместе с обработкой промпта',
+    ['mode', 'decoding'],
+    buckets=(1, 2, 5, 10, 20, 40, 80, 160, 320)
+)
+SPECULATIVE_ACCEPTANCE: Histogram = Histogram(
+    'speculative_acceptance_ratio',
+    'Доля токенов модели-черновика, принятых основной моделью за запрос',
+    ['mode'],
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+)
+SPECULATIVE_ACTIVE: Gauge = Gauge('speculative_decoding_active', 'Генерация идёт с моделью-черновиком')
+SPECULATIVE_FALLBACKS: Counter = Counter(
+    'speculative_fallbacks',
+    'Отключения модели-черновика из-за низкой доли принятых токенов'
+)
+KV_CACHE_HITS: Counter = Counter('kv_cache_hits', 'Ходы, переиспользовавшие состояние внимания чата')
+KV_CACHE_MISSES: Counter = Counter('kv_cache_misses', 'Ходы без сохранённого состояния внимания')
+KV_CACHE_EVICTIONS: Counter = Counter('kv_cache_evictions', 'Вытеснения состояний внимания из кэша')
+SYSTEM_PREFIX_HITS: Counter = Counter('system_prefix_hits', 'Ходы, начатые с состояния системного промпта')
+KV_CACHE_BYTES: Gauge = Gauge('kv_cache_bytes', 'Объём памяти, занятый состояниями внимания чатов')
+ADMISSION_QUEUE_DEPTH: Gauge = Gauge('admission_queue_depth', 'Ходы, ожидающие допуска к модели')
+ADMISSION_WAIT_TIME: Histogram = Histogram(
+    'admission_wait_seconds',
+    'Время ожидания допуска хода к модели',
+    buckets=LATENCY_BUCKETS
+)
+ADMISSION_REJECTIONS: Counter = Counter(
+    'admission_rejections',
+    'Отклонённые сообщения: переполнение очереди или ограничение частоты',
+    ['reason']
+)
+WEBHOOK_QUEUE_DEPTH: Gauge = Gauge('webhook_queue_depth', 'Обновления Telegram, ожидающие обработки')
+WEBHOOK_REJECTIONS: Counter = Counter('webhook_rejections', 'Обновления, отклонённые из-за полной очереди')
+INFERENCE_JOBS: Counter = Counter(
+    'inference_jobs',
+    'Задачи генерации, обработанные процессом инференса: выполненные, упавшие, отброшенные',
+    ['status']
+)
+JOB_CLAIMS: Counter = Counter('job_claims', 'Задачи, забранные у процессов, которые их не подтвердили')
+STARTUP_TIME: Gauge = Gauge(
+    'startup_phase_seconds',
+    'Длительность этапов запуска модели: токенизатор, веса, адаптер, системный промпт, прогрев',
+    ['phase']
+)
+MODEL_READY: Gauge = Gauge('model_ready', 'Модель загружена, прогрета и принимает запросы')
+RESPONSE_CACHE_HITS: Counter = Counter('response_cache_hits', 'Ответы, взятые из кэша ответов', ['mode'])
+RESPONSE_CACHE_MISSES: Counter = Counter(
+    'response_cache_misses',
+    'Подходящие для кэша ответов промпты, которых в нём не нашлось',
+    ['mode']
+)
+RESPONSE_CACHE_SAVED_SECONDS: Counter = Counter(
+    'response_cache_saved_seconds',
+    'Время генерации, сэкономленное кэшем ответов',
+    ['mode']
+)
+COMPACTIONS: Counter = Counter(
+    'history_compactions',
+    'Сжатия истории чатов пересказом: выполненные, бесполезные, устаревшие, упавшие',
+    ['status']
+)
+COMPACTION_SAVED_TOKENS: Counter = Counter(
+    'history_compaction_saved_tokens',
+    'Токены истории, заменённые пересказом, за вычетом самого пересказа'
+)
+COMPACTION_TIME: Histogram = Histogram(
+    'history_compaction_seconds',
+    'Время пересказа старых сообщений чата',
+    buckets=LATENCY_BUCKETS
+)
+ARCHIVE_OPERATIONS: Counter = Counter(
+    'conversation_archive_operations',
+    'Выгрузки холодных переписок в архив, возвраты из него и отменённые выгрузки',
+    ['operation']
+)
+ARCHIVE_TIME: Histogram = Histogram(
+    'conversation_archive_seconds',
+    'Время выгрузки переписки в архив и её возврата в Redis',
+    ['operation'],
+    buckets=FAST_BUCKETS + LATENCY_BUCKETS[4:]
+)
+COALESCED_MESSAGES: Counter = Counter(
+    'coalesced_messages',
+    'Сообщения, склеенные с другими в один ход из-за уже идущей генерации'
+)
+HISTORY_CACHE_HITS: Counter = Counter('history_cache_hits', 'Чтения истории с догрузкой только хвоста')
+HISTORY_CACHE_MISSES: Counter = Counter('history_cache_misses', 'Чтения истории из Redis целиком')
+HISTORY_CACHE_BYTES_SAVED: Counter = Counter(
+    'history_cache_bytes_saved',
+    'Объём сообщений, не прочитанных из Redis благодаря кэшу историй'
+)
 
 WEIGTHS_PATH: str = '/root/.cache'
 
 
-def get_size(folder_path: str = '.') -> int:
+class FolderSize:
     """
-    Получить размер директории.
-    :param folder_path: путь до директории.
-    :return: размер директории в байтах.
+    Размер директории с запоминанием обхода.
+    Для каждой поддиректории хранится её время изменения и списки файлов
+    и вложенных директорий. Повторный обход перечитывает только директории,
+    время изменения которых поменялось. Размеры файлов читаются заново
+    при каждом обходе, так как запись в файл не меняет время изменения директории.
+    Символьные ссылки не учитываются, чтобы снимки кэша HuggingFace
+    не считались дважды вместе с блобами.
     """
-    return sum(
-        file.stat().st_size
-        for file in Path(folder_path).glob('**/*')
-        if file.is_file()
-    )
 
+    __slots__ = ('_folders',)
 
-async def depth_conversion_track(cache: ConversationCache, sleep_time: int = 5) -> None:
+    def __init__(self) -> None:
+        self._folders: dict[str, tuple[int, list[str], list[str]]] = {}
+
+    def __call__(self, folder_path: str = '.') -> int:
+        """
+        Получить размер директории.
+        :param folder_path: путь до директории.
+        :return: размер директории в байтах.
+        """
+        total: int = 0
+        seen: set[str] = set()
+        stack: list[str] = [folder_path]
+        while stack:
+            path: str = stack.pop()
+            try:
+                mtime: int = os.stat(path).st_mtime_ns
+                entry: tuple[int, list[str], list[str]] | None = self._folders.get(path)
+                if entry is None or entry[0] != mtime:
+                    entry = (mtime, *self._scan(path))
+                    self._folders[path] = entry
+            except FileNotFoundError:
+                continue
+            seen.add(path)
+            for file in entry[1]:
+                try:
+                    total += os.stat(file, follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    continue
+            stack.extend(entry[2])
+
+        for path in self._folders.keys() - seen:
+            del self._folders[path]
+        return total
+
+    @staticmethod
+    def _scan(path: str) -> tuple[list[str], list[str]]:
+        files: list[str] = []
+        folders: list[str] = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(entry.path)
+        return files, folders
+
+
+def depth_buckets(depths: list[int]) -> dict[float, int]:
+    """
+    Разложить глубины переписок по накопительным корзинам.
+    :param depths: глубины переписок.
+    :return: количество чатов с глубиной не больше границы корзины.
+    """
+    counts: list[int] = [0] * len(DEPTH_BUCKETS)
+    for depth in depths:
+        counts[bisect.bisect_left(DEPTH_BUCKETS, depth)] += 1
+    total: int = 0
+    buckets: dict[float, int] = {}
+    for bound, count in zip(DEPTH_BUCKETS, counts):
+        total += count
+        buckets[bound] = total
+    return buckets
+
+
+async def depth_conversion_track(cache: 'ConversationCache', sleep_time: int = 5) -> None:
     """
-    Проставить в метрике глубину каждого чата.
+    Проставить в метрике распределение чатов по глубине.
+    Глубины отдаются корзинами, чтобы число меток не росло с числом чатов.
     :param cache: кэш откуда брать информацию о записях.
     :param sleep_time: интервал с которым следует обновлять информацию.
     :return:
     """
     while True:
-        running_chats: list[str] = await cache.get_actual_chats()
-        for chat in running_chats:
-            depth: int = await cache.metric_depth_correspondence(chat)
-            DEPTH_CONVERSION.labels(chat).set(depth)
+        depths: list[int] = await cache.metric_depths()
+        for bound, count in depth_buckets(depths).items():
+            DEPTH_CHATS.labels(str(bound) if bound != float('inf') else '+Inf').set(count)
         await asyncio.sleep(sleep_time)
 
 
-async def chat_counts_track(cache: ConversationCache, sleep_time: int = 5) -> None:
+async def chat_counts_track(cache: 'ConversationCache', sleep_time: int = 5) -> None:
     """
     Проставить в метрике количество активных чатов.
     :param cache: кэш откуда брать информацию о записях.
@@ -60,12 +293,18 @@ async def weights_size_track(sleep_time: int = 5) -> None:
     :param sleep_time: интервал с которым следует обновлять информацию.
     :return:
     """
+    get_size: FolderSize = FolderSize()
     while True:
-        WEIGHTS_SIZE.set(get_size(WEIGTHS_PATH))
+        # Обход файловой системы не должен останавливать событийный цикл
+        WEIGHTS_SIZE.set(await asyncio.to_thread(get_size, WEIGTHS_PATH))
         await asyncio.sleep(sleep_time)
 
 
-def start_tracking(loop: asyncio.AbstractEventLoop, cache: ConversationCache, sleep_time: int = 5) -> None:
+def start_tracking(
+    loop: asyncio.AbstractEventLoop,
+    cache: 'ConversationCache',
+    sleep_time: int = 5
+) -> None:
     """
     Начать отслеживание метрик.
     :param loop: событийный цикл в котором необходимо создать задачи отслеживания метрик.
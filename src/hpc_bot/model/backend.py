@@ -0,0 +1,238 @@
+import contextlib
+import logging
+import os
+from typing import Any, ContextManager, Final, Iterator
+
+import psutil
+import torch
+from peft import PeftModel
+from transformers import BitsAndBytesConfig, PreTrainedModel
+
+from hpc_bot.exceptions import MemoryLimitError
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+INFERENCE_DEVICE: Final[str] = os.environ.get('INFERENCE_DEVICE', 'auto')
+CPU_PRECISION: Final[str] = os.environ.get('CPU_PRECISION', 'bf16')
+CPU_THREADS: Final[int] = int(os.environ.get('CPU_THREADS', 0))
+CPU_INTEROP_THREADS: Final[int] = int(os.environ.get('CPU_INTEROP_THREADS', 0))
+CPU_MEMORY_LIMIT: Final[int] = int(os.environ.get('CPU_MEMORY_LIMIT', 0))
+
+# Ошибки нехватки памяти любого бэкенда, после которых переписку можно сжать и повторить
+OUT_OF_MEMORY: Final[tuple[type[Exception], ...]] = (torch.cuda.OutOfMemoryError, MemoryLimitError)
+
+
+class CudaBackend:
+    """
+    Инференс на видеокарте: веса квантуются bitsandbytes в 4 бита при загрузке.
+    """
+    name: str = 'cuda'
+
+    __slots__ = ()
+
+    @property
+    def identity(self) -> str:
+        """
+        Бэкенд вместе с типом весов, от которых зависят ответы модели.
+        :param:
+        :return:
+        """
+        return 'cuda-4bit'
+
+    def model_kwargs(self) -> dict[str, Any]:
+        """
+        Параметры загрузки весов модели.
+        :param:
+        :return: аргументы from_pretrained.
+        """
+        return {
+            'torch_dtype': torch.float32,
+            'device_map': 'auto',
+            'quantization_config': BitsAndBytesConfig(load_in_4bit=True),
+        }
+
+    def accepts(self, manifest: dict[str, Any]) -> bool:
+        """
+        Можно ли загрузить объединённый чекпоинт на этом бэкенде.
+        :param manifest: манифест чекпоинта.
+        :return:
+        """
+        return True
+
+    def prepare(self, model: PreTrainedModel) -> PreTrainedModel:
+        """
+        Подготовить загруженную модель к инференсу.
+        :param model: модель.
+        :return: модель.
+        """
+        return model
+
+    def inference_mode(self) -> ContextManager:
+        """
+        Контекст генерации без градиентов.
+        :param:
+        :return:
+        """
+        return torch.no_grad()
+
+    def check_memory(self, model: PreTrainedModel, batch: int, tokens: int) -> None:
+        """
+        Проверить, хватит ли памяти на генерацию.
+        На видеокарте нехватка памяти сообщается самим torch.
+        :param model: модель.
+        :param batch: количество промптов.
+        :param tokens: длина промпта вместе с ответом.
+        :return:
+        """
+
+
+class CpuBackend:
+    """
+    Инференс на процессоре без bitsandbytes и CUDA.
+    Веса хранятся в bf16 или квантуются динамически в int8 средствами torch,
+    генерация идёт в torch.inference_mode. Перед генерацией проверяется,
+    поместится ли состояние внимания в лимит памяти процесса, поэтому
+    переполнение сообщается заранее, а не падением аллокатора.
+    """
+    name: str = 'cpu'
+    PRECISIONS: tuple[str, ...] = ('bf16', 'int8', 'fp32')
+
+    __slots__ = (
+        'precision',
+        'memory_limit'
+    )
+
+    def __init__(
+        self,
+        precision: str = CPU_PRECISION,
+        threads: int = CPU_THREADS,
+        interop_threads: int = CPU_INTEROP_THREADS,
+        memory_limit: int = CPU_MEMORY_LIMIT
+    ) -> None:
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Unknown CPU precision {precision}")
+        self.precision: str = precision
+        # Лимит памяти процесса в байтах, без лимита ориентир на свободную память системы
+        self.memory_limit: int = memory_limit * 2 ** 20
+        if threads > 0:
+            torch.set_num_threads(threads)
+        if interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError as e:
+                # Число потоков между операциями задаётся только до первой параллельной операции
+                _LOGGER.warning(f"Не удалось задать CPU_INTEROP_THREADS: {e}")
+
+    @property
+    def dtype(self) -> torch.dtype:
+        """
+        Тип весов модели.
+        :param:
+        :return:
+        """
+        return torch.bfloat16 if self.precision == 'bf16' else torch.float32
+
+    @property
+    def identity(self) -> str:
+        """
+        Бэкенд вместе с типом весов, от которых зависят ответы модели.
+        :param:
+        :return:
+        """
+        return f'cpu-{self.precision}'
+
+    def model_kwargs(self) -> dict[str, Any]:
+        """
+        Параметры загрузки весов модели.
+        :param:
+        :return: аргументы from_pretrained.
+        """
+        return {
+            'torch_dtype': self.dtype,
+            'low_cpu_mem_usage': True,
+        }
+
+    def accepts(self, manifest: dict[str, Any]) -> bool:
+        """
+        Можно ли загрузить объединённый чекпоинт на этом бэкенде.
+        Веса, заранее квантованные bitsandbytes, на процессоре не работают.
+        :param manifest: манифест чекпоинта.
+        :return:
+        """
+        return manifest['quantization'] == 'none'
+
+    def prepare(self, model: PreTrainedModel) -> PreTrainedModel:
+        """
+        Подготовить загруженную модель к инференсу.
+        Адаптер вливается в веса, так как на процессоре веса не квантуются
+        в 4 бита и слияние точное. Для int8 линейные слои квантуются динамически.
+        :param model: модель.
+        :return: модель.
+        """
+        if isinstance(model, PeftModel):
+            model = model.merge_and_unload()
+        model.eval()
+        if self.precision == 'int8':
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def inference_mode(self) -> ContextManager:
+        """
+        Контекст генерации без учёта версий тензоров для autograd.
+        :param:
+        :return:
+        """
+        return torch.inference_mode()
+
+    def check_memory(self, model: PreTrainedModel, batch: int, tokens: int) -> None:
+        """
+        Проверить, поместится ли состояние внимания генерации в память.
+        :param model: модель.
+        :param batch: количество промптов.
+        :param tokens: длина промпта вместе с ответом.
+        :return:
+        """
+        config = model.config
+        heads: int = getattr(config, 'num_key_value_heads', None) or config.num_attention_heads
+        head_dim: int = config.hidden_size // config.num_attention_heads
+        element: int = torch.finfo(self.dtype).bits // 8
+        required: int = 2 * config.num_hidden_layers * heads * head_dim * element * batch * tokens
+        available: int
+        if self.memory_limit:
+            available = self.memory_limit - psutil.Process().memory_info().rss
+        else:
+            available = psutil.virtual_memory().available
+        if required > available:
+            raise MemoryLimitError(required, available)
+
+
+def select_backend(device: str = INFERENCE_DEVICE) -> CudaBackend | CpuBackend:
+    """
+    Выбрать бэкенд инференса.
+    :param device: cuda, cpu или auto, когда выбирается видеокарта при её наличии.
+    :return: бэкенд.
+    """
+    if device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if device == 'cuda':
+        return CudaBackend()
+    if device == 'cpu':
+        return CpuBackend()
+    raise ValueError(f"Unknown inference device {device}")
+
+
+@contextlib.contextmanager
+def allocation_guard() -> Iterator[None]:
+    """
+    Превратить отказ аллокатора процессора в ошибку нехватки памяти.
+    :param:
+    :return:
+    """
+    try:
+        yield
+    except MemoryError as e:
+        raise MemoryLimitError() from e
+    except RuntimeError as e:
+        if "can't allocate memory" not in str(e):
+            raise e
+        raise MemoryLimitError() from e
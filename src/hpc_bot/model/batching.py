@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Final
+
+from hpc_bot.metrics import QUEUE_WAIT_TIME
+from hpc_bot.model.conversion import Conversation
+from hpc_bot.model.executor import InferenceExecutor
+from hpc_bot.model.inference import Prompt
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+BATCH_WINDOW: Final[float] = float(os.environ.get('BATCH_WINDOW', 0.05))
+BATCH_MAX_SIZE: Final[int] = int(os.environ.get('BATCH_MAX_SIZE', 8))
+BATCH_MAX_TOKENS: Final[int] = int(os.environ.get('BATCH_MAX_TOKENS', 8192))
+BATCH_BUCKET_SIZE: Final[int] = int(os.environ.get('BATCH_BUCKET_SIZE', 256))
+
+
+@dataclass(slots=True)
+class BatchRequest:
+    """
+    Запрос на генерацию, ожидающий формирования пакета.
+    """
+    prompt: Prompt
+    tokens: int
+    future: asyncio.Future
+    chat_id: int | None = None
+    mode: str = 'unknown'
+    arrived: float = field(default_factory=time.monotonic)
+
+
+class BatchScheduler:
+    """
+    Планировщик динамических пакетов для инференса модели.
+    Собирает промпты, пришедшие в течение окна ожидания, группирует их
+    по длине и запускает одну пакетную генерацию на группу.
+
+    Баланс между пропускной способностью и задержкой настраивается окном
+    ожидания `batch_window`, размером пакета `max_batch_size` и бюджетом
+    токенов `max_batch_tokens`.
+    """
+
+    __slots__ = (
+        '_executor',
+        '_batch_window',
+        '_max_batch_size',
+        '_max_batch_tokens',
+        '_bucket_size',
+        '_buckets',
+        '_wakeup',
+        '_full',
+        '_worker'
+    )
+
+    def __init__(
+        self,
+        executor: InferenceExecutor,
+        batch_window: float = BATCH_WINDOW,
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_batch_tokens: int = BATCH_MAX_TOKENS,
+        bucket_size: int = BATCH_BUCKET_SIZE
+    ) -> None:
+        self._executor: InferenceExecutor = executor
+        self._batch_window: float = batch_window
+        self._max_batch_size: int = max_batch_size
+        self._max_batch_tokens: int = max_batch_tokens
+        self._bucket_size: int = bucket_size
+        self._buckets: defaultdict[int, deque[BatchRequest]] = defaultdict(deque)
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._full: asyncio.Event = asyncio.Event()
+        self._worker: asyncio.Task | None = None
+
+    @property
+    def executor(self) -> InferenceExecutor:
+        """
+        Исполнитель, в потоке которого запускаются пакеты.
+        :param:
+        :return:
+        """
+        return self._executor
+
+    @property
+    def pending(self) -> int:
+        """
+        Количество запросов, ожидающих генерации.
+        :param:
+        :return:
+        """
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+    async def __call__(self, conversation: Conversation) -> str:
+        """
+        Поставить переписку в очередь и дождаться ответа модели.
+        Промпт токенизируется в потоке инференса, чтобы не блокировать событийный
+        цикл и не менять состояние модели вне её потока.
+        :param conversation: переписка с пользователем.
+        :return: ответ модели в формате строки.
+        """
+        prompt: Prompt = await self._executor.submit(self._executor.inference.encode, conversation)
+        tokens: int = len(prompt)
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+        bucket: deque[BatchRequest] = self._buckets[tokens // self._bucket_size]
+        bucket.append(BatchRequest(
+            prompt=prompt,
+            tokens=tokens,
+            future=future,
+            chat_id=conversation.chat_id,
+            mode=conversation.mode
+        ))
+        if len(bucket) >= self._max_batch_size:
+            self._full.set()
+        self._wakeup.set()
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+        return await future
+
+    async def stream(self, conversation: Conversation) -> AsyncIterator[str]:
+        """
+        Получать ответ модели кусками по мере генерации.
+        Потоковая генерация идёт без пакета, так как стример поддерживает один промпт.
+        :param conversation: переписка с пользователем.
+        :return: куски ответа модели.
+        """
+        async for chunk in self._executor.stream(conversation):
+            yield chunk
+
+    async def invalidate(self, chat_id: int) -> None:
+        """
+        Сбросить сохранённое состояние внимания чата.
+        :param chat_id: индефикатор чата.
+        :return:
+        """
+        await self._executor.invalidate(chat_id)
+
+    def _next_batch(self) -> list[BatchRequest]:
+        """
+        Сформировать следующий пакет из корзины с самым старым запросом.
+        Пакет ограничен размером и бюджетом токенов с учётом паддинга.
+        :param:
+        :return: запросы для одной генерации.
+        """
+        key: int = min(
+            (key for key, bucket in self._buckets.items() if bucket),
+            key=lambda k: self._buckets[k][0].arrived
+        )
+        bucket: deque[BatchRequest] = self._buckets[key]
+
+        batch: list[BatchRequest] = [bucket.popleft()]
+        longest: int = batch[0].tokens
+        while bucket and len(batch) < self._max_batch_size:
+            candidate_longest: int = max(longest, bucket[0].tokens)
+            if candidate_longest * (len(batch) + 1) > self._max_batch_tokens:
+                break
+            longest = candidate_longest
+            batch.append(bucket.popleft())
+
+        if not bucket:
+            del self._buckets[key]
+        return batch
+
+    async def _generate(self, batch: list[BatchRequest]) -> None:
+        """
+        Запустить генерацию пакета и раздать ответы ожидающим чатам.
+        Если пакет из нескольких запросов упал, то запросы повторяются по одному,
+        чтобы ошибка одного промпта не затронула остальные.
+        :param batch: запросы одного пакета.
+        :return:
+        """
+        prompts: list[Prompt] = [request.prompt for request in batch]
+        try:
+            outputs: list[str] = await self._executor.submit(
+                self._executor.inference.generate_batch,
+                prompts,
+                chat_ids=[request.chat_id for request in batch],
+                modes=[request.mode for request in batch]
+            )
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0].future.done():
+                    batch[0].future.set_exception(e)
+                return
+            _LOGGER.warning(f"Не удалось сгенерировать пакет из {len(batch)} запросов, повтор по одному")
+            for request in batch:
+                await self._generate([request])
+            return
+
+        for request, output in zip(batch, outputs):
+            if not request.future.done():
+                request.future.set_result(output)
+
+    async def _run(self) -> None:
+        """
+        Цикл формирования пакетов.
+        :param:
+        :return:
+        """
+        while True:
+            await self._wakeup.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self._batch_window)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wakeup.clear()
+            self._full.clear()
+            while self.pending:
+                batch: list[BatchRequest] = self._next_batch()
+                started: float = time.monotonic()
+                for request in batch:
+                    QUEUE_WAIT_TIME.labels(request.mode).observe(started - request.arrived)
+                await self._generate(batch)
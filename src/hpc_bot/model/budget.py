@@ -0,0 +1,76 @@
+import functools
+import os
+from typing import Callable, Final
+
+from hpc_bot.exceptions import TooLongMessageError
+from hpc_bot.model.conversion import Conversation, Message
+
+CONTEXT_TOKENS: Final[int] = int(os.environ.get('CONTEXT_TOKENS', 4096))
+TOKEN_COUNT_CACHE: Final[int] = int(os.environ.get('TOKEN_COUNT_CACHE', 65536))
+
+
+class ContextBudget:
+    """
+    Планировщик контекста в токенах.
+    Заранее решает, сколько старых сообщений нужно выбросить, чтобы промпт
+    вместе с ответом модели поместился в заданный контекст.
+    """
+
+    __slots__ = (
+        '_count_tokens',
+        '_max_context',
+        '_max_new_tokens'
+    )
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_new_tokens: int,
+        max_context: int = CONTEXT_TOKENS
+    ) -> None:
+        # Каждое сообщение токенизируется один раз, повторные ходы берут число из кэша
+        self._count_tokens: Callable[[str], int] = functools.lru_cache(TOKEN_COUNT_CACHE)(count_tokens)
+        self._max_new_tokens: int = max_new_tokens
+        self._max_context: int = max_context
+
+    @property
+    def limit(self) -> int:
+        """
+        Сколько токенов может занять промпт.
+        :param:
+        :return:
+        """
+        return self._max_context - self._max_new_tokens
+
+    def message_tokens(self, conversation: Conversation, message: Message) -> int:
+        """
+        Посчитать токены сообщения в том виде, в котором оно попадёт в промпт.
+        :param conversation: переписка, задающая шаблон сообщения.
+        :param message: сообщение переписки.
+        :return: целое число токенов.
+        """
+        return self._count_tokens(conversation.render_message(message))
+
+    def plan(self, conversation: Conversation) -> int:
+        """
+        Посчитать, сколько самых старых сообщений нужно выбросить.
+        Системное сообщение и последнее сообщение пользователя не выбрасываются.
+        :param conversation: переписка с новым сообщением пользователя в конце.
+        :return: количество сообщений после системного, которые нужно выбросить.
+        """
+        # Переписка запоминает посчитанные токены, повторный план их не пересчитывает
+        tokens: list[int] = conversation.count_tokens(self._count_tokens)
+        response: int = self._count_tokens(conversation.response_template)
+        fixed: int = response + tokens[-1]
+        first: int = 1 if conversation.system_prefix else 0
+        if first:
+            fixed += tokens[0]
+        if fixed > self.limit:
+            raise TooLongMessageError()
+
+        total: int = sum(tokens) + response
+        drop: int = 0
+        while total > self.limit:
+            total -= tokens[first + drop]
+            drop += 1
+        return drop
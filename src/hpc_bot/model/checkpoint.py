@@ -0,0 +1,182 @@
+"""
+Объединённый чекпоинт модели: веса базовой модели с влитым LoRA адаптером.
+
+Сборка чекпоинта:
+    PYTHONPATH=src python -m hpc_bot.model.checkpoint --output /root/.cache/hpc_bot/merged
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Final
+
+import torch
+from peft import PeftConfig, PeftModel
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    GenerationConfig,
+    PreTrainedModel,
+)
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+MODEL_NAME: Final[str] = "IlyaGusev/saiga_mistral_7b"
+MERGED_MODEL_PATH: Final[str] = os.environ.get('MERGED_MODEL_PATH', '/root/.cache/hpc_bot/merged')
+MANIFEST_NAME: Final[str] = 'manifest.json'
+MANIFEST_VERSION: Final[int] = 1
+QUANTIZATIONS: Final[tuple[str, ...]] = ('none', '8bit')
+
+
+def merge_adapter(
+    adapter: str,
+    output: str | Path,
+    dtype: str = 'float16',
+    quantization: str = 'none',
+    max_shard_size: str = '2GB'
+) -> dict[str, Any]:
+    """
+    Влить LoRA адаптер в веса базовой модели и сохранить готовый чекпоинт.
+    Веса сохраняются в safetensors, рядом кладутся токенизатор, конфиг генерации
+    и манифест, по которому инференс узнаёт чекпоинт.
+    4-битные веса transformers сохранять не умеет, поэтому без квантования
+    чекпоинт квантуется в 4 бита при загрузке, а 8 бит можно сохранить заранее.
+    :param adapter: имя или путь адаптера.
+    :param output: директория чекпоинта.
+    :param dtype: тип весов чекпоинта.
+    :param quantization: квантование сохранённых весов: none или 8bit.
+    :param max_shard_size: максимальный размер одного файла весов.
+    :return: манифест чекпоинта.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization}")
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    # Старый манифест и веса убираются сразу, чтобы недособранный чекпоинт не был загружен
+    (output / MANIFEST_NAME).unlink(missing_ok=True)
+    for stale in output.glob('*.safetensors*'):
+        stale.unlink()
+    torch_dtype: torch.dtype = getattr(torch, dtype)
+
+    started: float = time.perf_counter()
+    config: PeftConfig = PeftConfig.from_pretrained(adapter)
+    base: PreTrainedModel = AutoModelForCausalLM.from_pretrained(
+        config.base_model_name_or_path,
+        torch_dtype=torch_dtype,
+        low_cpu_mem_usage=True
+    )
+    model: PreTrainedModel = PeftModel.from_pretrained(
+        base,
+        adapter,
+        torch_dtype=torch_dtype
+    ).merge_and_unload()
+    model.save_pretrained(output, safe_serialization=True, max_shard_size=max_shard_size)
+
+    if quantization == '8bit':
+        # bitsandbytes квантует веса только при загрузке, поэтому объединённые
+        # веса загружаются заново в 8 битах и перезаписываются
+        del model
+        model = AutoModelForCausalLM.from_pretrained(
+            output,
+            device_map='auto',
+            quantization_config=BitsAndBytesConfig(load_in_8bit=True)
+        )
+        staged: Path = output.with_name(output.name + '.8bit')
+        model.save_pretrained(staged, safe_serialization=True, max_shard_size=max_shard_size)
+        shutil.rmtree(output)
+        staged.rename(output)
+
+    for component in (AutoTokenizer, GenerationConfig):
+        try:
+            component.from_pretrained(adapter).save_pretrained(output)
+        except OSError:
+            _LOGGER.warning(f"У адаптера {adapter} нет {component.__name__}, он не попадёт в чекпоинт")
+
+    manifest: dict[str, Any] = {
+        'version': MANIFEST_VERSION,
+        'adapter': adapter,
+        'base_model': config.base_model_name_or_path,
+        'dtype': dtype,
+        'quantization': quantization,
+        'created': int(time.time()),
+        'merge_seconds': round(time.perf_counter() - started, 1),
+        'files': {
+            path.name: path.stat().st_size
+            for path in sorted(output.glob('*.safetensors'))
+        },
+    }
+    (output / MANIFEST_NAME).write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def read_manifest(path: str | Path, adapter: str) -> dict[str, Any] | None:
+    """
+    Прочитать манифест объединённого чекпоинта.
+    :param path: директория чекпоинта.
+    :param adapter: адаптер, который должен быть влит в чекпоинт.
+    :return: манифест или None, если чекпоинта нет или он собран из другого адаптера.
+    """
+    file: Path = Path(path) / MANIFEST_NAME
+    if not file.exists():
+        return None
+    manifest: dict[str, Any] = json.loads(file.read_text())
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('adapter') != adapter:
+        _LOGGER.warning(f"Чекпоинт {path} собран для {manifest.get('adapter')}, он не будет использован")
+        return None
+    missing: list[str] = [name for name in manifest['files'] if not (Path(path) / name).exists()]
+    if missing:
+        _LOGGER.warning(f"В чекпоинте {path} нет файлов {missing}, он не будет использован")
+        return None
+    return manifest
+
+
+def load_merged(path: str | Path, manifest: dict[str, Any], **kwargs: Any) -> PreTrainedModel:
+    """
+    Загрузить объединённый чекпоинт.
+    Файлы safetensors отображаются в память и копируются сразу на устройство,
+    без промежуточной копии весов в памяти процесса.
+    :param path: директория чекпоинта.
+    :param manifest: манифест чекпоинта.
+    :param kwargs: параметры загрузки бэкенда инференса. Заранее квантованный
+                   чекпоинт загружается со своими квантованием и типом весов.
+    :return: модель.
+    """
+    kwargs.setdefault('torch_dtype', getattr(torch, manifest['dtype']))
+    if manifest['quantization'] != 'none':
+        kwargs.pop('quantization_config', None)
+        kwargs.pop('torch_dtype')
+        kwargs.setdefault('device_map', 'auto')
+    model: PreTrainedModel = AutoModelForCausalLM.from_pretrained(path, use_safetensors=True, **kwargs)
+    model.eval()
+    return model
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--adapter', default=MODEL_NAME, help='имя или путь LoRA адаптера')
+    parser.add_argument('--output', default=MERGED_MODEL_PATH, help='директория чекпоинта')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'bfloat16', 'float32'])
+    parser.add_argument('--quantization', default='none', choices=QUANTIZATIONS)
+    parser.add_argument('--max-shard-size', default='2GB')
+    args = parser.parse_args()
+
+    manifest: dict[str, Any] = merge_adapter(
+        args.adapter,
+        args.output,
+        dtype=args.dtype,
+        quantization=args.quantization,
+        max_shard_size=args.max_shard_size
+    )
+    print(json.dumps(manifest, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
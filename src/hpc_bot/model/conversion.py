@@ -1,5 +1,6 @@
+from collections import deque
 from enum import Enum
-from typing import Final
+from typing import Callable, Final, Iterable
 
 from pydantic import BaseModel, ConfigDict
 
@@ -42,12 +43,26 @@ class Conversation:
     """
     Класс диалога модели с пользователем.
     Формирует промт заранее опредлённого формата.
+
+    Переписка хранится инкрементально: текст каждого сообщения по шаблону
+    готовится один раз при добавлении, а количество символов и токенов
+    поддерживается нарастающим итогом. Добавление в конец и выбрасывание
+    старых сообщений не пересчитывают всю переписку.
     """
 
     __slots__ = (
         'message_template',
         'response_template',
-        'messages'
+        'chat_id',
+        'mode',
+        'token_ids',
+        'dropped',
+        '_messages',
+        '_rendered',
+        '_tokens',
+        '_size',
+        '_token_total',
+        '_prefix'
     )
 
     def __init__(
@@ -55,19 +70,64 @@ class Conversation:
         message_template: str = DEFAULT_MESSAGE_TEMPLATE,
         system_prompt: str = DEFAULT_SYSTEM_PROMPT,
         response_template: str = DEFAULT_RESPONSE_TEMPLATE,
-        messages: list[Message] | None = None
+        messages: Iterable[Message] | None = None,
+        chat_id: int | None = None,
+        mode: str = 'unknown'
     ) -> None:
         self.message_template: str = message_template
         self.response_template: str = response_template
+        self.chat_id: int | None = chat_id
+        # Режим переписки пользователя, которым размечаются метрики инференса
+        self.mode: str = mode
+        # Токены промпта, собранные заранее из кэша; сбрасываются при изменении переписки
+        self.token_ids: list[int] | None = None
+        # Сколько сообщений выброшено из начала, чтобы повторить это в хранилище
+        self.dropped: int = 0
+
+        self._messages: deque[Message] = deque()
+        self._rendered: deque[str] = deque()
+        self._tokens: deque[int | None] = deque()
+        self._size: int = 0
+        self._token_total: int = 0
+        self._prefix: str | None = None
+
+        messages = list(messages or [])
         if not messages:
-            self.messages: list[Message] = [
-                Message(
-                    role=Role.SYSTEM,
-                    content=system_prompt
-                )
-            ]
-        else:
-            self.messages = messages
+            messages = [Message(role=Role.SYSTEM, content=system_prompt)]
+        self.extend(messages)
+
+    @property
+    def messages(self) -> list[Message]:
+        """
+        Вернуть сообщения переписки.
+        :param:
+        :return: копия списка сообщений.
+        """
+        return list(self._messages)
+
+    def append(self, message: Message) -> None:
+        """
+        Добавить сообщение в конец переписки.
+        :param message: сообщение пользователя или бота.
+        :return:
+        """
+        rendered: str = self.render_message(message)
+        self._messages.append(message)
+        self._rendered.append(rendered)
+        self._tokens.append(None)
+        self._size += len(message)
+        if self._prefix is not None:
+            self._prefix += rendered
+        self.token_ids = None
+
+    def extend(self, messages: Iterable[Message]) -> None:
+        """
+        Добавить несколько сообщений в конец переписки.
+        :param messages: сообщения пользователя или бота.
+        :return:
+        """
+        for message in messages:
+            self.append(message)
 
     def pop_first_message(self) -> Message:
         """
@@ -75,7 +135,39 @@ class Conversation:
         :param:
         :return: сообщение, которое было выброшено.
         """
-        return self.messages.pop(1)
+        return self.pop_first_messages(1)[0]
+
+    def pop_first_messages(self, count: int) -> list[Message]:
+        """
+        Выбросить несколько первых сообщений после системного за один раз.
+        :param count: количество сообщений.
+        :return: сообщения, которые были выброшены.
+        """
+        count = min(count, len(self._messages) - 1)
+        if count <= 0:
+            raise IndexError('pop from conversation without messages')
+
+        head: tuple[Message, str, int | None] = (
+            self._messages.popleft(),
+            self._rendered.popleft(),
+            self._tokens.popleft()
+        )
+        dropped: list[Message] = []
+        for _ in range(count):
+            message: Message = self._messages.popleft()
+            self._rendered.popleft()
+            tokens: int | None = self._tokens.popleft()
+            self._size -= len(message)
+            self._token_total -= tokens or 0
+            dropped.append(message)
+        self._messages.appendleft(head[0])
+        self._rendered.appendleft(head[1])
+        self._tokens.appendleft(head[2])
+
+        self.dropped += count
+        self._prefix = None
+        self.token_ids = None
+        return dropped
 
     def __len__(self) -> int:
         """
@@ -83,7 +175,7 @@ class Conversation:
         :param:
         :return: целое число сообщений.
         """
-        return len(self.messages)
+        return len(self._messages)
 
     @property
     def size(self) -> int:
@@ -92,7 +184,66 @@ class Conversation:
         :param:
         :return: целое число символов.
         """
-        return sum([len(msg) for msg in self.messages])
+        return self._size
+
+    def count_tokens(self, count_tokens: Callable[[str], int]) -> list[int]:
+        """
+        Посчитать токены сообщений по шаблону.
+        Уже посчитанные сообщения повторно не токенизируются.
+        :param count_tokens: функция подсчёта токенов текста.
+        :return: количество токенов каждого сообщения.
+        """
+        counted: list[int] = [
+            count_tokens(rendered) if tokens is None else tokens
+            for tokens, rendered in zip(self._tokens, self._rendered)
+        ]
+        if None in self._tokens:
+            self._tokens = deque(counted)
+            self._token_total = sum(counted)
+        return counted
+
+    @property
+    def tokens(self) -> int | None:
+        """
+        Вернуть количество токенов в переписке без шаблона ответа.
+        :param:
+        :return: целое число токенов или None, если токены ещё не посчитаны.
+        """
+        if None in self._tokens:
+            return None
+        return self._token_total
+
+    @property
+    def system_prefix(self) -> str:
+        """
+        Вернуть начало промпта с системным сообщением, общее для всех чатов.
+        :param:
+        :return: строка системного сообщения или пустая строка.
+        """
+        if not self._messages or self._messages[0].role != Role.SYSTEM:
+            return ""
+        return self._rendered[0]
+
+    def render_message(self, message: Message) -> str:
+        """
+        Подготовить текст одного сообщения по шаблону.
+        :param message: сообщение переписки.
+        :return: строка сообщения.
+        """
+        return self.message_template.format(role=message.role.value, content=message.content)
+
+    def get_prompt_parts(self) -> list[str]:
+        """
+        Разбить промпт на части по сообщениям.
+        Склейка частей совпадает с `get_prompt`.
+        :param:
+        :return: строки сообщений и шаблон ответа.
+        """
+        parts: list[str] = list(self._rendered)
+        parts.append(self.response_template)
+        parts[0] = parts[0].lstrip()
+        parts[-1] = parts[-1].rstrip()
+        return parts
 
     def get_prompt(self) -> str:
         """
@@ -100,9 +251,6 @@ class Conversation:
         :param:
         :return: строка промпта.
         """
-        final_text: str = ""
-        for message in self.messages:  # type: Message
-            message_text: str = self.message_template.format(**message.model_dump())
-            final_text += message_text
-        final_text += self.response_template
-        return final_text.strip()
+        if self._prefix is None:
+            self._prefix = "".join(self._rendered)
+        return (self._prefix + self.response_template).strip()
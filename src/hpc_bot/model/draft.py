@@ -0,0 +1,169 @@
+import logging
+import os
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Final, Iterator
+
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    PreTrainedModel,
+    PreTrainedTokenizerBase,
+)
+
+from hpc_bot.metrics import (
+    SPECULATIVE_ACCEPTANCE,
+    SPECULATIVE_ACTIVE,
+    SPECULATIVE_FALLBACKS,
+)
+from hpc_bot.model.backend import CpuBackend, CudaBackend
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+DRAFT_MODEL: Final[str] = os.environ.get('DRAFT_MODEL', '')
+DRAFT_MIN_ACCEPTANCE: Final[float] = float(os.environ.get('DRAFT_MIN_ACCEPTANCE', 0.4))
+DRAFT_WINDOW: Final[int] = int(os.environ.get('DRAFT_WINDOW', 16))
+DRAFT_COOLDOWN: Final[int] = int(os.environ.get('DRAFT_COOLDOWN', 64))
+
+
+class DraftModel:
+    """
+    Малая модель-черновик для спекулятивного декодирования.
+    Черновик предлагает несколько токенов, а основная модель проверяет их
+    одним проходом и принимает совпавшие. Словарь черновика должен совпадать
+    со словарём основной модели. По последним `window` запросам считается
+    доля принятых токенов: если она ниже `min_acceptance`, то черновик
+    отключается на `cooldown` запросов, после чего пробуется снова.
+    """
+
+    __slots__ = (
+        'model',
+        'min_acceptance',
+        'cooldown',
+        '_history',
+        '_skipped'
+    )
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        min_acceptance: float = DRAFT_MIN_ACCEPTANCE,
+        window: int = DRAFT_WINDOW,
+        cooldown: int = DRAFT_COOLDOWN
+    ) -> None:
+        self.model: PreTrainedModel = model
+        self.model.eval()
+        self.min_acceptance: float = min_acceptance
+        self.cooldown: int = cooldown
+        # Предложенные и принятые токены последних запросов
+        self._history: deque[tuple[int, int]] = deque(maxlen=window)
+        # Запросы без черновика с момента его отключения, None - черновик включён
+        self._skipped: int | None = None
+        SPECULATIVE_ACTIVE.set(1)
+
+    @classmethod
+    def load(
+        cls,
+        name: str,
+        backend: CudaBackend | CpuBackend,
+        tokenizer: PreTrainedTokenizerBase
+    ) -> 'DraftModel':
+        """
+        Загрузить модель-черновик.
+        :param name: имя или путь модели.
+        :param backend: бэкенд инференса, задающий тип весов и устройство.
+        :param tokenizer: токенизатор основной модели.
+        :return: черновик.
+        """
+        draft_tokenizer: PreTrainedTokenizerBase = AutoTokenizer.from_pretrained(name, use_fast=True)
+        if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            raise ValueError(f"Draft model {name} has a different vocabulary")
+        kwargs: dict[str, Any] = backend.model_kwargs()
+        model: PreTrainedModel = AutoModelForCausalLM.from_pretrained(name, **kwargs)
+        return cls(backend.prepare(model))
+
+    @property
+    def active(self) -> bool:
+        """
+        Используется ли черновик.
+        :param:
+        :return:
+        """
+        return self._skipped is None
+
+    @property
+    def acceptance(self) -> float:
+        """
+        Доля принятых токенов за последние запросы.
+        :param:
+        :return:
+        """
+        proposed: int = sum(proposed for proposed, _ in self._history)
+        if not proposed:
+            return 1.0
+        return sum(accepted for _, accepted in self._history) / proposed
+
+    def acquire(self) -> bool:
+        """
+        Решить, генерировать ли очередной ответ с черновиком.
+        :param:
+        :return:
+        """
+        if self._skipped is None:
+            return True
+        self._skipped += 1
+        if self._skipped <= self.cooldown:
+            return False
+        _LOGGER.info("Модель-черновик снова включена")
+        self._skipped = None
+        SPECULATIVE_ACTIVE.set(1)
+        return True
+
+    def record(self, proposed: int, accepted: int, mode: str = 'unknown') -> None:
+        """
+        Учесть результат генерации с черновиком и отключить его при низкой доле принятых токенов.
+        :param proposed: токены, предложенные черновиком.
+        :param accepted: токены черновика, принятые основной моделью.
+        :param mode: режим переписки для разметки метрик.
+        :return:
+        """
+        if proposed:
+            SPECULATIVE_ACCEPTANCE.labels(mode).observe(accepted / proposed)
+        self._history.append((proposed, accepted))
+        if len(self._history) < (self._history.maxlen or 0) or self.acceptance >= self.min_acceptance:
+            return
+        _LOGGER.warning(
+            f"Доля принятых токенов черновика {self.acceptance:.2f}, "
+            f"черновик отключён на {self.cooldown} запросов"
+        )
+        self._history.clear()
+        self._skipped = 0
+        SPECULATIVE_ACTIVE.set(0)
+        SPECULATIVE_FALLBACKS.inc()
+
+    @contextmanager
+    def track(self, target: torch.nn.Module) -> Iterator[list[int]]:
+        """
+        Считать проходы черновика и основной модели во время генерации.
+        Каждый проход черновика предлагает один токен, а каждый проход
+        основной модели проверяет предложенные и добавляет ещё один свой.
+        :param target: основная модель без обёртки адаптера.
+        :return: список из числа проходов черновика и основной модели.
+        """
+        counts: list[int] = [0, 0]
+
+        def count(index: int) -> Any:
+            def hook(module: torch.nn.Module, args: tuple, output: Any) -> None:
+                counts[index] += 1
+            return hook
+
+        handles: list[Any] = [
+            self.model.register_forward_hook(count(0)),
+            target.register_forward_hook(count(1))
+        ]
+        try:
+            yield counts
+        finally:
+            for handle in handles:
+                handle.remove()
@@ -0,0 +1,53 @@
+import itertools
+import time
+from typing import Callable
+
+from hpc_bot.metrics import TOKENIZATION_TIME
+from hpc_bot.model.conversion import Conversation
+from hpc_bot.telegram.cache import ConversationCache
+
+
+class PromptEncoder:
+    """
+    Сборщик токенов промпта из токенов отдельных сообщений.
+    Токены сообщений хранятся в кэше, поэтому на каждом ходе токенизируется
+    только новое сообщение, а история собирается склейкой готовых массивов.
+    """
+
+    __slots__ = (
+        '_tokenize',
+        '_version',
+        '_cache'
+    )
+
+    def __init__(
+        self,
+        tokenize: Callable[[list[str]], list[list[int]]],
+        version: str,
+        cache: ConversationCache
+    ) -> None:
+        self._tokenize: Callable[[list[str]], list[list[int]]] = tokenize
+        self._version: str = version
+        self._cache: ConversationCache = cache
+
+    async def encode(self, conversation: Conversation) -> list[int]:
+        """
+        Получить токены промпта переписки.
+        :param conversation: переписка с пользователем.
+        :return: токены промпта.
+        """
+        parts: list[str] = conversation.get_prompt_parts()
+        stored: list[list[int] | None] = await self._cache.get_token_ids(self._version, parts)
+
+        started: float = time.perf_counter()
+        missing: list[str] = list({part: None for part, ids in zip(parts, stored) if ids is None})
+        tokens: dict[str, list[int]] = dict(zip(missing, self._tokenize(missing))) if missing else {}
+        input_ids: list[int] = list(itertools.chain.from_iterable(
+            ids if ids is not None else tokens[part]
+            for part, ids in zip(parts, stored)
+        ))
+        TOKENIZATION_TIME.labels('cached', conversation.mode).observe(time.perf_counter() - started)
+
+        if tokens:
+            await self._cache.put_token_ids(self._version, tokens)
+        return input_ids
@@ -0,0 +1,123 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Final, TypeVar
+
+from hpc_bot.metrics import QUEUE_WAIT_TIME
+from hpc_bot.model.conversion import Conversation
+from hpc_bot.model.inference import ModelInference
+from hpc_bot.model.prefix_cache import PrefixCache
+from hpc_bot.model.streamer import AsyncTextStreamer
+
+INFERENCE_WORKERS: Final[int] = int(os.environ.get('INFERENCE_WORKERS', 1))
+
+_T = TypeVar('_T')
+
+
+class InferenceExecutor:
+    """
+    Исполнитель инференса модели вне событийного цикла.
+    Генерация выполняется в выделенном потоке, а событийный цикл
+    продолжает обрабатывать обновления Telegram и запросы в Redis.
+    """
+
+    __slots__ = (
+        '_inference',
+        '_pool'
+    )
+
+    def __init__(
+        self,
+        inference: ModelInference,
+        max_workers: int = INFERENCE_WORKERS
+    ) -> None:
+        self._inference: ModelInference = inference
+        self._pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='inference'
+        )
+
+    @property
+    def inference(self) -> ModelInference:
+        """
+        Инференс модели, который обслуживает исполнитель.
+        :param:
+        :return:
+        """
+        return self._inference
+
+    async def submit(self, func: Callable[..., _T], *args: Any, **kwargs: Any) -> _T:
+        """
+        Выполнить функцию в потоке инференса и дождаться результата.
+        :param func: блокирующая функция.
+        :param args: позиционные аргументы функции.
+        :param kwargs: именованные аргументы функции.
+        :return: результат выполнения функции.
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, functools.partial(func, *args, **kwargs))
+
+    async def __call__(self, conversation: Conversation) -> str:
+        """
+        Запросить ответ модели не блокируя событийный цикл.
+        :param conversation: переписка с пользователем.
+        :return: ответ модели в формате строки.
+        """
+        return await self.submit(self._timed(self._inference), conversation)
+
+    async def stream(self, conversation: Conversation) -> AsyncIterator[str]:
+        """
+        Запросить ответ модели и получать его кусками по мере генерации.
+        :param conversation: переписка с пользователем.
+        :return: куски ответа модели.
+        """
+        streamer: AsyncTextStreamer = AsyncTextStreamer(
+            self._inference.tokenizer,
+            asyncio.get_running_loop()
+        )
+
+        def generate(conversation: Conversation) -> str:
+            try:
+                return self._inference(conversation, streamer)
+            finally:
+                streamer.close()
+
+        generation: asyncio.Future = asyncio.ensure_future(self.submit(self._timed(generate), conversation))
+        async for chunk in streamer:
+            yield chunk
+        await generation
+
+    @staticmethod
+    def _timed(func: Callable[[Conversation], _T]) -> Callable[[Conversation], _T]:
+        """
+        Обернуть вызов инференса замером времени ожидания свободного потока.
+        :param func: вызов инференса для переписки.
+        :return: обёрнутый вызов.
+        """
+        queued: float = time.perf_counter()
+
+        def timed(conversation: Conversation) -> _T:
+            QUEUE_WAIT_TIME.labels(conversation.mode).observe(time.perf_counter() - queued)
+            return func(conversation)
+
+        return timed
+
+    async def invalidate(self, chat_id: int) -> None:
+        """
+        Сбросить сохранённое состояние внимания чата.
+        :param chat_id: индефикатор чата.
+        :return:
+        """
+        prefix_cache: PrefixCache | None = getattr(self._inference, 'prefix_cache', None)
+        if prefix_cache is not None:
+            prefix_cache.invalidate(chat_id)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Остановить поток инференса.
+        :param wait: дождаться завершения текущих генераций.
+        :return:
+        """
+        self._pool.shutdown(wait=wait)
@@ -1,4 +1,8 @@
-from typing import Final
+import copy
+import hashlib
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Iterator
 
 import torch
 from peft import PeftConfig, PeftModel
@@ -6,18 +10,49 @@ from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     BatchEncoding,
-    BitsAndBytesConfig,
     GenerationConfig,
     LlamaModel,
-    LlamaPreTrainedModel,
     LlamaTokenizerFast,
+    PreTrainedModel,
+    PreTrainedTokenizerBase,
 )
+from transformers.generation.streamers import BaseStreamer
+from transformers.utils import ModelOutput
 
-from hpc_bot.metrics import REQUEST_TIME
-from hpc_bot.model.conversion import Conversation
+from hpc_bot.exceptions import WarmingUpError
+from hpc_bot.metrics import (
+    DECODE_RATE,
+    DETOKENIZE_TIME,
+    GENERATED_TOKENS,
+    GENERATION_RATE,
+    GENERATION_TIME,
+    PREFILL_TIME,
+    PROMPT_TOKENS,
+    REQUEST_TIME,
+    STARTUP_TIME,
+    TIME_TO_FIRST_TOKEN,
+    TOKENIZATION_TIME,
+)
+from hpc_bot.model.backend import (
+    OUT_OF_MEMORY,
+    CpuBackend,
+    CudaBackend,
+    allocation_guard,
+    select_backend,
+)
+from hpc_bot.model.checkpoint import (
+    MERGED_MODEL_PATH,
+    MODEL_NAME,
+    load_merged,
+    read_manifest,
+)
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.draft import DRAFT_MODEL, DraftModel
+from hpc_bot.model.prefix_cache import PastKeyValues, PrefixCache, truncate_past
+from hpc_bot.model.timing import PhaseTimer, generated_lengths
 from hpc_bot.singleton import Singleton
 
-MODEL_NAME: Final[str] = "IlyaGusev/saiga_mistral_7b"
+Prompt = str | list[int]
 
 
 class ModelInference(metaclass=Singleton):
@@ -27,63 +62,463 @@ class ModelInference(metaclass=Singleton):
     __slots__ = (
         'tokenizer',
         'model',
-        'generation_config'
+        'backend',
+        'draft',
+        'generation_config',
+        'prefix_cache',
+        '_system_prefix',
+        '_tokenizer_version'
     )
 
-    def __init__(self) -> None:
+    def __init__(self, load_model: bool = True, backend: CudaBackend | CpuBackend | None = None) -> None:
+        # Видеокарта или процессор, смотря по INFERENCE_DEVICE
+        self.backend: CudaBackend | CpuBackend = backend or select_backend()
+
         # Загрузить токенизатора Mistral
-        self.tokenizer: LlamaTokenizerFast = AutoTokenizer.from_pretrained(
+        with STARTUP_TIME.labels('tokenizer').time():
+            self.tokenizer: LlamaTokenizerFast = self._load_tokenizer()
+
+        # Конфиг генерации
+        self.generation_config: GenerationConfig = GenerationConfig.from_pretrained(MODEL_NAME)
+
+        # Кэш состояний внимания по чатам и общего системного промпта
+        self.prefix_cache: PrefixCache = PrefixCache()
+        self._tokenizer_version: str | None = None
+        self._system_prefix: str = Conversation().system_prefix
+
+        self.model: LlamaModel | None = None
+        self.draft: DraftModel | None = None
+        if load_model:
+            self.load_model()
+
+    def load_model(self) -> None:
+        """
+        Загрузить веса модели и посчитать состояние системного промпта.
+        Если собран объединённый чекпоинт с этим адаптером, то загружается он.
+        Тип весов, квантование и устройство задаёт бэкенд инференса.
+        Если задан DRAFT_MODEL, то рядом загружается модель-черновик.
+        Время каждого этапа попадает в метрики запуска.
+        :param:
+        :return:
+        """
+        kwargs: dict[str, Any] = self.backend.model_kwargs()
+        manifest: dict[str, Any] | None = read_manifest(MERGED_MODEL_PATH, MODEL_NAME)
+        model: PreTrainedModel | PeftModel
+        if manifest is not None and self.backend.accepts(manifest):
+            # Адаптер уже влит в веса, поэтому он не загружается и не тормозит каждый шаг
+            with STARTUP_TIME.labels('merged_model').time():
+                model = load_merged(MERGED_MODEL_PATH, manifest, **kwargs)
+        else:
+            # Загрузить модель Mistral 7B
+            with STARTUP_TIME.labels('base_model').time():
+                config: PeftConfig = PeftConfig.from_pretrained(MODEL_NAME)
+                model = AutoModelForCausalLM.from_pretrained(
+                    config.base_model_name_or_path,
+                    **kwargs
+                )
+            with STARTUP_TIME.labels('adapter').time():
+                model = PeftModel.from_pretrained(
+                    model,
+                    MODEL_NAME,
+                    torch_dtype=kwargs['torch_dtype']
+                )
+                model.eval()
+        with STARTUP_TIME.labels('prepare').time():
+            model = self.backend.prepare(model)
+        self.model = model
+
+        if DRAFT_MODEL:
+            with STARTUP_TIME.labels('draft_model').time():
+                self.draft = DraftModel.load(DRAFT_MODEL, self.backend, self.tokenizer)
+
+        with STARTUP_TIME.labels('system_prefix').time():
+            self._build_system_prefix()
+
+    def warm_up(self, prompt: str, max_new_tokens: int) -> str:
+        """
+        Прогнать короткую генерацию, чтобы первый запрос пользователя
+        не платил за инициализацию ядер и аллокатора.
+        :param prompt: сообщение пользователя для прогрева.
+        :param max_new_tokens: сколько токенов сгенерировать.
+        :return: ответ модели.
+        """
+        self._require_model()
+        conversation: Conversation = Conversation(mode='warmup')
+        conversation.append(Message(role=Role.USER, content=prompt))
+        config: GenerationConfig = self.generation_config
+        self.generation_config = copy.deepcopy(config)
+        self.generation_config.max_new_tokens = max_new_tokens
+        try:
+            with STARTUP_TIME.labels('warmup').time():
+                return self.generate(self.render(conversation), mode=conversation.mode)
+        finally:
+            self.generation_config = config
+
+    @classmethod
+    def from_components(
+        cls,
+        tokenizer: PreTrainedTokenizerBase,
+        model: PreTrainedModel,
+        generation_config: GenerationConfig,
+        backend: CudaBackend | CpuBackend | None = None,
+        draft: DraftModel | None = None
+    ) -> 'ModelInference':
+        """
+        Собрать инференс из уже загруженных компонентов, минуя загрузку Mistral.
+        Используется для локальных моделей и тестов.
+        :param tokenizer: токенизатор модели.
+        :param model: языковая модель.
+        :param generation_config: конфиг генерации.
+        :param backend: бэкенд инференса, по умолчанию выбирается по INFERENCE_DEVICE.
+        :param draft: модель-черновик для спекулятивного декодирования.
+        :return: инференс модели.
+        """
+        inference: ModelInference = object.__new__(cls)
+        inference.backend = backend or select_backend()
+        inference.tokenizer = tokenizer
+        inference.tokenizer.padding_side = 'left'
+        if inference.tokenizer.pad_token is None:
+            inference.tokenizer.pad_token = inference.tokenizer.eos_token
+        inference.model = model
+        inference.model.eval()
+        inference.generation_config = generation_config
+        inference.draft = draft
+        inference.prefix_cache = PrefixCache()
+        inference._tokenizer_version = None
+        inference._system_prefix = Conversation().system_prefix
+        inference._build_system_prefix()
+        return inference
+
+    @classmethod
+    def without_model(cls) -> 'ModelInference':
+        """
+        Загрузить только токенизатор и конфиг генерации, без весов модели.
+        Веса загружаются позже через load_model, например в фоне после старта бота,
+        или не загружаются вовсе, когда генерация идёт в процессах инференса.
+        :param:
+        :return: инференс модели, пока пригодный только для токенизации.
+        """
+        return cls(load_model=False)
+
+    @staticmethod
+    def _load_tokenizer() -> LlamaTokenizerFast:
+        """
+        Загрузить токенизатор Mistral.
+        :param:
+        :return: токенизатор модели.
+        """
+        tokenizer: LlamaTokenizerFast = AutoTokenizer.from_pretrained(
             MODEL_NAME,
             use_fast=True,
-            legacy=False
+            legacy=False,
+            padding_side='left'
         )
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.unk_token
+        return tokenizer
 
-        # Загрузить модель Mistral 7B
-        quantization_config: BitsAndBytesConfig = BitsAndBytesConfig(
-            load_in_4bit=True
-        )
-        config: PeftConfig = PeftConfig.from_pretrained(MODEL_NAME)
-        self.model: LlamaPreTrainedModel = AutoModelForCausalLM.from_pretrained(
-            config.base_model_name_or_path,
-            torch_dtype=torch.float32,
-            device_map="auto",
-            quantization_config=quantization_config
-        )
-        self.model: LlamaModel = PeftModel.from_pretrained(
-            self.model,
-            MODEL_NAME,
-            torch_dtype=torch.float32
-        )
-        self.model.eval()
+    @property
+    def tokenizer_version(self) -> str:
+        """
+        Версия токенизатора для ключей сохранённых токенов.
+        :param:
+        :return: короткий хэш описания токенизатора.
+        """
+        if self._tokenizer_version is None:
+            description: str = self.tokenizer.backend_tokenizer.to_str()
+            self._tokenizer_version = hashlib.sha1(description.encode()).hexdigest()[:12]
+        return self._tokenizer_version
 
-        # Конфиг генерации
-        self.generation_config: GenerationConfig = GenerationConfig.from_pretrained(MODEL_NAME)
+    @property
+    def model_id(self) -> str:
+        """
+        Описание модели, от которого зависят её ответы: адаптер, бэкенд и токенизатор.
+        :param:
+        :return:
+        """
+        return f'{MODEL_NAME}:{self.backend.identity}:{self.tokenizer_version}'
 
-    def generate(self, prompt: str) -> str:
+    def tokenize(self, texts: list[str]) -> list[list[int]]:
         """
-        Сгенерировать ответ модели.
+        Токенизировать тексты без добавления служебных токенов.
+        :param texts: тексты.
+        :return: токены каждого текста.
+        """
+        return self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+    def encode(self, conversation: Conversation) -> list[int]:
+        """
+        Получить токены промпта переписки.
+        Если токены собраны заранее, то токенизатор не вызывается.
+        :param conversation: переписка с пользователем.
+        :return: токены промпта.
+        """
+        prompt: str = self.render(conversation)
+        if conversation.token_ids is not None:
+            return conversation.token_ids
+
+        started: float = time.perf_counter()
+        input_ids: list[int] = self.tokenize([prompt])[0]
+        TOKENIZATION_TIME.labels('full', conversation.mode).observe(time.perf_counter() - started)
+        return input_ids
+
+    def render(self, conversation: Conversation) -> str:
+        """
+        Подготовить промпт переписки и запомнить её системный префикс.
+        Если префикс изменился, то его состояние будет пересчитано перед следующей генерацией.
+        :param conversation: переписка с пользователем.
+        :return: строка промпта.
+        """
+        self._system_prefix = conversation.system_prefix
+        return conversation.get_prompt()
+
+    def count_tokens(self, prompt: str) -> int:
+        """
+        Посчитать количество токенов в промпте.
         :param prompt: входной промпт модели.
+        :return: целое число токенов.
+        """
+        return len(self.tokenize([prompt])[0])
+
+    def generate(
+        self,
+        prompt: Prompt,
+        streamer: BaseStreamer | None = None,
+        chat_id: int | None = None,
+        mode: str = 'unknown'
+    ) -> str:
+        """
+        Сгенерировать ответ модели.
+        :param prompt: входной промпт модели строкой или токенами.
+        :param streamer: стример, получающий токены по мере генерации.
+        :param chat_id: индефикатор чата для переиспользования состояния внимания.
+        :param mode: режим переписки для разметки метрик.
         :return: ответ модели в формате строки.
         """
-        data: BatchEncoding = self.tokenizer(prompt, return_tensors="pt", add_special_tokens=False)
-        with torch.no_grad():
-            data = {k: v.to(self.model.device) for k, v in data.items()}
-            output_ids = self.model.generate(
-                **data,
-                generation_config=self.generation_config
-            )[0]
-        output_ids = output_ids[len(data["input_ids"][0]):]
-        output = self.tokenizer.decode(output_ids, skip_special_tokens=True)
-        return output.strip()
+        return self.generate_batch([prompt], streamer, [chat_id], [mode])[0]
+
+    def generate_batch(
+        self,
+        prompts: list[Prompt],
+        streamer: BaseStreamer | None = None,
+        chat_ids: list[int | None] | None = None,
+        modes: list[str] | None = None
+    ) -> list[str]:
+        """
+        Сгенерировать ответы модели на несколько промптов за один вызов.
+        Промпты выравниваются паддингом слева, поэтому ответы всех промптов
+        начинаются с одной и той же позиции.
+        Для одиночного промпта с известным чатом переиспользуется сохранённое
+        состояние внимания, и заново считаются только новые токены.
+        :param prompts: входные промпты модели строками или токенами.
+        :param streamer: стример токенов, поддерживается только для одного промпта.
+        :param chat_ids: индефикаторы чатов промптов.
+        :param modes: режимы переписок промптов для разметки метрик.
+        :return: ответы модели в том же порядке, что и промпты.
+        """
+        model: LlamaModel = self._require_model()
+        timer: PhaseTimer = PhaseTimer(streamer)
+        # Лучевой поиск не поддерживает стримеры, фазы тогда не засекаются
+        steps: BaseStreamer | None = timer if (self.generation_config.num_beams or 1) == 1 else streamer
+        data: BatchEncoding = self.tokenizer.pad(
+            {"input_ids": [
+                self.tokenize([prompt])[0] if isinstance(prompt, str) else prompt
+                for prompt in prompts
+            ]},
+            return_tensors="pt"
+        )
+        try:
+            with self.backend.inference_mode(), allocation_guard():
+                self.backend.check_memory(
+                    model,
+                    len(prompts),
+                    data["input_ids"].shape[1] + (self.generation_config.max_new_tokens or 0)
+                )
+                data = {k: v.to(model.device) for k, v in data.items()}
+                timer.mark_prefill()
+                if len(prompts) == 1:
+                    chat_id: int | None = chat_ids[0] if chat_ids else None
+                    mode: str = modes[0] if modes else 'unknown'
+                    output_ids = self._generate_cached(chat_id, data["input_ids"], steps, mode)
+                else:
+                    output_ids = model.generate(
+                        **data,
+                        generation_config=self.generation_config,
+                        pad_token_id=self.tokenizer.pad_token_id,
+                        streamer=steps
+                    )
+        except OUT_OF_MEMORY as e:
+            # Освободить память, занятую состояниями чатов
+            self.prefix_cache.clear()
+            raise e
+        output_ids = output_ids[:, data["input_ids"].shape[1]:]
+        started: float = time.perf_counter()
+        outputs: list[str] = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+        detokenize_time: float = time.perf_counter() - started
+
+        prompt_lengths: list[int] = data["attention_mask"].sum(dim=1).tolist()
+        output_lengths: list[int] = generated_lengths(output_ids, self.generation_config.eos_token_id)
+        for mode, prompt_length, output_length in zip(
+            modes or ['unknown'] * len(prompts),
+            prompt_lengths,
+            output_lengths
+        ):
+            PROMPT_TOKENS.labels(mode).observe(prompt_length)
+            GENERATED_TOKENS.labels(mode).observe(output_length)
+            PREFILL_TIME.labels(mode).observe(timer.prefill_time)
+            TIME_TO_FIRST_TOKEN.labels(mode).observe(timer.time_to_first_token)
+            if timer.decode_time > 0:
+                DECODE_RATE.labels(mode).observe((output_length - 1) / timer.decode_time)
+            DETOKENIZE_TIME.labels(mode).observe(detokenize_time)
+        return [output.strip() for output in outputs]
+
+    def _build_system_prefix(self) -> None:
+        """
+        Посчитать состояние внимания системного промпта, общее для всех чатов.
+        :param:
+        :return:
+        """
+        if not self._system_prefix:
+            self.prefix_cache.set_shared(self._system_prefix, None, None)
+            return
+
+        model: LlamaModel = self._require_model()
+        input_ids: torch.Tensor = self.tokenizer(
+            self._system_prefix,
+            return_tensors="pt",
+            add_special_tokens=False
+        )["input_ids"].to(model.device)
+        with self.backend.inference_mode():
+            past: PastKeyValues = model(input_ids=input_ids, use_cache=True).past_key_values
+        self.prefix_cache.set_shared(self._system_prefix, input_ids[0], past)
+
+    def _generate_cached(
+        self,
+        chat_id: int | None,
+        input_ids: torch.Tensor,
+        streamer: BaseStreamer | None = None,
+        mode: str = 'unknown'
+    ) -> torch.Tensor:
+        """
+        Сгенерировать ответ, досчитав состояние внимания только для новых токенов промпта.
+        Началом служит состояние чата или общее состояние системного промпта.
+        После генерации состояние всей переписки вместе с ответом сохраняется в кэш.
+        Если есть включённая модель-черновик, то ответ генерируется спекулятивно.
+        :param chat_id: индефикатор чата, если не указан, то состояние не сохраняется.
+        :param input_ids: токены промпта размерности (1, длина).
+        :param streamer: стример, получающий токены по мере генерации.
+        :param mode: режим переписки для разметки метрик.
+        :return: токены промпта вместе с ответом.
+        """
+        model: LlamaModel = self._require_model()
+        if self.prefix_cache.shared_text != self._system_prefix:
+            self._build_system_prefix()
+
+        covered, past = self.prefix_cache.lookup(chat_id, input_ids[0])
+        if past is not None and covered < input_ids.shape[1] - 1:
+            # generate подаёт в модель только последний токен, остальные досчитываются здесь
+            past = model(
+                input_ids=input_ids[:, covered:-1],
+                attention_mask=torch.ones_like(input_ids[:, :-1]),
+                past_key_values=past,
+                use_cache=True
+            ).past_key_values
+
+        kwargs: dict[str, Any] = {}
+        if past is not None:
+            # Спекулятивное декодирование считает наличие ключа признаком готового состояния
+            kwargs['past_key_values'] = past
+        # Черновик читается один раз, дальше признаком спекулятивной генерации служит он сам
+        draft: DraftModel | None = self.draft
+        if draft is not None and not ((self.generation_config.num_beams or 1) == 1 and draft.acquire()):
+            draft = None
+        if draft is not None:
+            kwargs['assistant_model'] = draft.model
+
+        started: float = time.perf_counter()
+        with (
+            self._capture_past() as captured,
+            draft.track(self._base_model()) if draft is not None else nullcontext([0, 0]) as passes
+        ):
+            output_ids: torch.Tensor = model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                generation_config=self.generation_config,
+                pad_token_id=self.tokenizer.pad_token_id,
+                streamer=streamer,
+                **kwargs
+            )
+        elapsed: float = time.perf_counter() - started
+
+        generated: int = output_ids.shape[1] - input_ids.shape[1]
+        decoding: str = 'speculative' if draft is not None else 'plain'
+        GENERATION_TIME.labels(mode, decoding).observe(elapsed)
+        GENERATION_RATE.labels(mode, decoding).observe(generated / elapsed)
+        if draft is not None:
+            # Каждая проверка основной моделью добавляет один свой токен сверх принятых
+            proposed, checks = passes
+            draft.record(proposed, max(generated - checks, 0), mode)
+
+        # Последний сгенерированный токен ещё не проходил через модель. При спекулятивном
+        # декодировании в состоянии последней проверки остаются отвергнутые токены черновика
+        if captured and chat_id is not None:
+            self.prefix_cache.store(
+                chat_id,
+                output_ids[0, :-1],
+                truncate_past(captured[-1], output_ids.shape[1] - 1)
+            )
+        return output_ids
+
+    def _base_model(self) -> PreTrainedModel:
+        """
+        Модель без обёртки адаптера, которую generate вызывает на каждом шаге.
+        :param:
+        :return:
+        """
+        model: LlamaModel = self._require_model()
+        if isinstance(model, PeftModel):
+            return model.get_base_model()
+        return model
+
+    def _require_model(self) -> LlamaModel:
+        """
+        Загруженная модель.
+        :param:
+        :return:
+        """
+        if self.model is None:
+            raise WarmingUpError("Model is not loaded")
+        return self.model
+
+    @contextmanager
+    def _capture_past(self) -> Iterator[list[PastKeyValues]]:
+        """
+        Перехватывать состояние внимания, возвращаемое моделью на каждом шаге генерации.
+        :param:
+        :return: список, в конце которого лежит последнее состояние.
+        """
+        captured: list[PastKeyValues] = []
+
+        def hook(module: torch.nn.Module, args: tuple, output: ModelOutput) -> None:
+            if output.past_key_values is not None:
+                captured[:] = [output.past_key_values]
+
+        handle = self._base_model().register_forward_hook(hook)
+        try:
+            yield captured
+        finally:
+            handle.remove()
 
     @REQUEST_TIME.time()
-    def __call__(self, сonversation: Conversation) -> str:
+    def __call__(self, сonversation: Conversation, streamer: BaseStreamer | None = None) -> str:
         """
         Подготовить промпт для модели из истории диалога и запросить ответ.
         :param input: новый запрос от пользователя.
         :param chat_id: индефикатор чата, для различия пользователей.
+        :param streamer: стример, получающий токены по мере генерации.
         :return: ответ модели в формате строки.
         """
-        prompt = сonversation.get_prompt()
-        output = self.generate(prompt)
+        self._require_model()
+        input_ids = self.encode(сonversation)
+        output = self.generate(input_ids, streamer, сonversation.chat_id, сonversation.mode)
         return output
@@ -0,0 +1,327 @@
+import json
+import math
+import os
+import socket
+from typing import Any, AsyncIterator, Final
+
+import redis.asyncio as redis
+import torch
+from redis.typing import StreamIdT
+
+from hpc_bot.exceptions import BusyError, InferenceJobError, MemoryLimitError
+from hpc_bot.model.conversion import Conversation, Message, Role
+
+JOBS_STREAM: Final[str] = os.environ.get('JOBS_STREAM', 'inference_jobs')
+JOBS_GROUP: Final[str] = os.environ.get('JOBS_GROUP', 'inference_workers')
+JOBS_MAX_PENDING: Final[int] = int(os.environ.get('JOBS_MAX_PENDING', 256))
+JOB_TIMEOUT: Final[float] = float(os.environ.get('JOB_TIMEOUT', 300))
+JOB_RESULT_TTL: Final[int] = int(os.environ.get('JOB_RESULT_TTL', 600))
+JOB_CLAIM_IDLE: Final[int] = int(os.environ.get('JOB_CLAIM_IDLE', 60_000))
+JOB_MAX_DELIVERIES: Final[int] = int(os.environ.get('JOB_MAX_DELIVERIES', 3))
+WORKER_NAME: Final[str] = os.environ.get('WORKER_NAME', f'{socket.gethostname()}-{os.getpid()}')
+
+# Поставить задачу в поток, если в нём меньше заданного числа невыполненных задач.
+# Выполненные задачи удаляются из потока, поэтому его длина равна числу невыполненных.
+# KEYS: поток задач; ARGV: предел очереди, тело задачи
+PUBLISH_SCRIPT: Final[str] = """
+local length = redis.call('XLEN', KEYS[1])
+if length >= tonumber(ARGV[1]) then
+    return {0, length}
+end
+return {1, redis.call('XADD', KEYS[1], '*', 'job', ARGV[2])}
+"""
+
+
+class JobQueue:
+    """
+    Очередь задач генерации в потоке Redis с группой потребителей.
+    Фронтенд бота ставит задачи в поток и читает результат из списка задачи,
+    а процессы инференса, в том числе на других узлах, разбирают поток
+    через группу потребителей. Задача, которую взявший её процесс не
+    подтвердил за JOB_CLAIM_IDLE мс, забирается другим процессом.
+    """
+    RESULT_PATTERN: str = 'job_result:{job_id}'
+
+    __slots__ = (
+        'cache',
+        'stream',
+        'group',
+        'max_pending',
+        '_publish'
+    )
+
+    def __init__(
+        self,
+        cache: redis.Redis | None = None,
+        stream: str = JOBS_STREAM,
+        group: str = JOBS_GROUP,
+        max_pending: int = JOBS_MAX_PENDING
+    ) -> None:
+        self.cache: redis.Redis = cache or redis.Redis(
+            host=os.environ.get('CACHE_ADDRESS', 'localhost'),
+            port=6379,
+            decode_responses=True
+        )
+        self.stream: str = stream
+        self.group: str = group
+        self.max_pending: int = max_pending
+        self._publish = self.cache.register_script(PUBLISH_SCRIPT)
+
+    def result_key(self, job_id: str) -> str:
+        """
+        Ключ списка, в который пишется результат задачи.
+        :param job_id: индефикатор задачи в потоке.
+        :return: ключ в Redis.
+        """
+        return self.RESULT_PATTERN.format(job_id=job_id)
+
+    async def ensure_group(self) -> None:
+        """
+        Создать поток и группу потребителей, если их ещё нет.
+        :param:
+        :return:
+        """
+        try:
+            await self.cache.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise e
+
+    async def publish(self, job: dict[str, Any]) -> str:
+        """
+        Поставить задачу в поток.
+        При переполненной очереди сразу выбрасывается BusyError.
+        :param job: тело задачи.
+        :return: индефикатор задачи в потоке.
+        """
+        accepted, value = await self._publish(keys=[self.stream], args=[self.max_pending, json.dumps(job)])
+        if not accepted:
+            raise BusyError(int(value))
+        return value
+
+    async def cancel(self, job_id: str) -> None:
+        """
+        Убрать задачу из потока, если её результат больше не нужен.
+        :param job_id: индефикатор задачи в потоке.
+        :return:
+        """
+        await self.cache.xdel(self.stream, job_id)
+
+    async def read(self, consumer: str, count: int, block: int) -> list[tuple[str, dict[str, str]]]:
+        """
+        Получить новые задачи для потребителя.
+        :param consumer: имя процесса инференса.
+        :param count: максимальное число задач.
+        :param block: сколько мс ждать новых задач.
+        :return: пары из индефикатора и полей задачи.
+        """
+        response: list = await self.cache.xreadgroup(
+            self.group,
+            consumer,
+            {self.stream: '>'},
+            count=count,
+            block=block
+        )
+        return response[0][1] if response else []
+
+    async def claim(
+        self,
+        consumer: str,
+        count: int,
+        min_idle: int,
+        max_deliveries: int
+    ) -> tuple[list[tuple[str, dict[str, str]]], list[str]]:
+        """
+        Забрать задачи, которые взявшие их процессы давно не подтверждали.
+        :param consumer: имя процесса инференса, который забирает задачи.
+        :param count: максимальное число задач.
+        :param min_idle: сколько мс задача должна простаивать.
+        :param max_deliveries: после скольких выдач задача считается невыполнимой.
+        :return: забранные задачи и индефикаторы невыполнимых задач.
+        """
+        pending: list[dict] = await self.cache.xpending_range(
+            self.stream,
+            self.group,
+            min='-',
+            max='+',
+            count=count,
+            idle=min_idle
+        )
+        exhausted: list[str] = [
+            entry['message_id'] for entry in pending
+            if entry['times_delivered'] >= max_deliveries
+        ]
+        retry: list[StreamIdT] = [
+            entry['message_id'] for entry in pending
+            if entry['times_delivered'] < max_deliveries
+        ]
+        claimed: list[tuple[str, dict[str, str]]] = []
+        if retry:
+            claimed = await self.cache.xclaim(self.stream, self.group, consumer, min_idle, retry)
+        return claimed, exhausted
+
+    async def touch(self, consumer: str, job_id: str) -> None:
+        """
+        Отметить, что задача всё ещё выполняется, чтобы её не забрали.
+        :param consumer: имя процесса инференса, выполняющего задачу.
+        :param job_id: индефикатор задачи в потоке.
+        :return:
+        """
+        await self.cache.xclaim(self.stream, self.group, consumer, 0, [job_id], justid=True)
+
+    async def ack(self, job_id: str) -> None:
+        """
+        Подтвердить выполнение задачи и убрать её из потока.
+        :param job_id: индефикатор задачи в потоке.
+        :return:
+        """
+        async with self.cache.pipeline(transaction=True) as pipe:
+            pipe.xack(self.stream, self.group, job_id)
+            pipe.xdel(self.stream, job_id)
+            await pipe.execute()
+
+    async def push_result(self, job_id: str, **item: str) -> None:
+        """
+        Дописать кусок ответа, ответ или ошибку в результат задачи.
+        :param job_id: индефикатор задачи в потоке.
+        :param item: одно из полей chunk, done или error.
+        :return:
+        """
+        key: str = self.result_key(job_id)
+        async with self.cache.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, json.dumps(item))
+            pipe.expire(key, JOB_RESULT_TTL)
+            await pipe.execute()
+
+    async def results(self, job_id: str, timeout: float = JOB_TIMEOUT) -> AsyncIterator[dict[str, str]]:
+        """
+        Получать записи результата задачи до ответа или ошибки.
+        :param job_id: индефикатор задачи в потоке.
+        :param timeout: сколько секунд ждать очередной записи.
+        :return: записи результата.
+        """
+        key: str = self.result_key(job_id)
+        try:
+            while True:
+                # Ожидание BLPOP задаётся целыми секундами, дробная часть округляется вверх
+                response: tuple[str, str] | None = await self.cache.blpop([key], timeout=math.ceil(timeout))
+                if response is None:
+                    raise InferenceJobError(f'Задача {job_id} не выполнена за {timeout} с')
+                item: dict[str, str] = json.loads(response[1])
+                yield item
+                if 'chunk' not in item:
+                    return
+        finally:
+            await self.cache.delete(key)
+
+
+def dump_conversation(conversation: Conversation) -> dict[str, Any]:
+    """
+    Подготовить переписку для передачи в задаче.
+    :param conversation: переписка с пользователем.
+    :return: сериализуемое тело переписки.
+    """
+    return {
+        'chat_id': conversation.chat_id,
+        'mode': conversation.mode,
+        'messages': [[message.role.value, message.content] for message in conversation.messages],
+        'token_ids': conversation.token_ids,
+    }
+
+
+def load_conversation(body: dict[str, Any]) -> Conversation:
+    """
+    Восстановить переписку из тела задачи.
+    :param body: тело задачи.
+    :return: переписка с пользователем.
+    """
+    conversation: Conversation = Conversation(
+        messages=[Message(role=Role(role), content=content) for role, content in body['messages']],
+        chat_id=body['chat_id'],
+        mode=body['mode']
+    )
+    conversation.token_ids = body['token_ids']
+    return conversation
+
+
+class RemoteInference:
+    """
+    Инференс модели в отдельных процессах через очередь задач.
+    Повторяет интерфейс исполнителя инференса, поэтому менеджер моделей
+    не знает, где идёт генерация. Сброс состояния внимания чата передаётся
+    процессу инференса вместе со следующей задачей этого чата.
+    """
+
+    __slots__ = (
+        '_queue',
+        '_timeout',
+        '_invalidated'
+    )
+
+    def __init__(self, queue: JobQueue, timeout: float = JOB_TIMEOUT) -> None:
+        self._queue: JobQueue = queue
+        self._timeout: float = timeout
+        self._invalidated: set[int] = set()
+
+    async def __call__(self, conversation: Conversation) -> str:
+        """
+        Поставить задачу генерации и дождаться ответа модели.
+        :param conversation: переписка с пользователем.
+        :return: ответ модели в формате строки.
+        """
+        outputs: list[str] = [output async for output in self._run(conversation, stream=False)]
+        if not outputs:
+            raise InferenceJobError('Задача завершилась без ответа')
+        return outputs[0]
+
+    async def stream(self, conversation: Conversation) -> AsyncIterator[str]:
+        """
+        Поставить задачу генерации и получать ответ кусками по мере генерации.
+        :param conversation: переписка с пользователем.
+        :return: куски ответа модели.
+        """
+        async for chunk in self._run(conversation, stream=True):
+            yield chunk
+
+    async def invalidate(self, chat_id: int) -> None:
+        """
+        Сбросить сохранённое состояние внимания чата при следующей задаче.
+        :param chat_id: индефикатор чата.
+        :return:
+        """
+        self._invalidated.add(chat_id)
+
+    async def _run(self, conversation: Conversation, stream: bool) -> AsyncIterator[str]:
+        """
+        Выполнить задачу и отдавать куски ответа или ответ целиком.
+        :param conversation: переписка с пользователем.
+        :param stream: нужны ли куски ответа по мере генерации.
+        :return: куски ответа или единственный ответ.
+        """
+        reset: bool = conversation.chat_id in self._invalidated
+        job_id: str = await self._queue.publish({
+            **dump_conversation(conversation),
+            'stream': stream,
+            'reset': reset,
+        })
+        self._invalidated.discard(conversation.chat_id)
+
+        finished: bool = False
+        try:
+            async for item in self._queue.results(job_id, self._timeout):
+                if 'chunk' in item:
+                    yield item['chunk']
+                elif 'done' in item:
+                    finished = True
+                    if not stream:
+                        yield item['done']
+                else:
+                    finished = True
+                    if item.get('type') == 'OutOfMemoryError':
+                        raise torch.cuda.OutOfMemoryError(item['error'])
+                    if item.get('type') == 'MemoryLimitError':
+                        raise MemoryLimitError()
+                    raise InferenceJobError(item['error'])
+        finally:
+            if not finished:
+                await self._queue.cancel(job_id)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+from typing import Final
+
+from hpc_bot.exceptions import WarmingUpError
+from hpc_bot.metrics import MODEL_READY
+from hpc_bot.model.executor import InferenceExecutor
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+WARMUP_PROMPT: Final[str] = os.environ.get('WARMUP_PROMPT', 'Привет')
+WARMUP_TOKENS: Final[int] = int(os.environ.get('WARMUP_TOKENS', 8))
+WARMUP_WAIT: Final[float] = float(os.environ.get('WARMUP_WAIT', 0))
+
+
+class ModelLoader:
+    """
+    Фоновая загрузка и прогрев модели.
+    Бот начинает принимать обновления сразу, а веса загружаются и прогреваются
+    в потоке инференса, поэтому прогрев не пересекается с генерацией.
+    Пока модель не готова, запрос ждёт её не дольше `wait` секунд, после чего
+    пользователь получает ответ о прогреве. Пустой `prompt` отключает
+    прогревочную генерацию.
+    """
+
+    __slots__ = (
+        '_executor',
+        '_prompt',
+        '_max_new_tokens',
+        '_wait',
+        '_ready',
+        '_error',
+        '_task'
+    )
+
+    def __init__(
+        self,
+        executor: InferenceExecutor,
+        prompt: str = WARMUP_PROMPT,
+        max_new_tokens: int = WARMUP_TOKENS,
+        wait: float = WARMUP_WAIT
+    ) -> None:
+        self._executor: InferenceExecutor = executor
+        self._prompt: str = prompt
+        self._max_new_tokens: int = max_new_tokens
+        self._wait: float = wait
+        self._ready: asyncio.Event = asyncio.Event()
+        self._error: Exception | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def ready(self) -> bool:
+        """
+        Загружена и прогрета ли модель.
+        :param:
+        :return:
+        """
+        return self._ready.is_set() and self._error is None
+
+    def start(self) -> asyncio.Task:
+        """
+        Запустить загрузку модели в фоне.
+        :param:
+        :return: задача загрузки.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self.load())
+        return self._task
+
+    async def load(self) -> None:
+        """
+        Загрузить веса модели, если они ещё не загружены, и прогреть её.
+        :param:
+        :return:
+        """
+        MODEL_READY.set(0)
+        try:
+            if self._executor.inference.model is None:
+                await self._executor.submit(self._executor.inference.load_model)
+            if self._prompt:
+                await self._executor.submit(
+                    self._executor.inference.warm_up,
+                    self._prompt,
+                    self._max_new_tokens
+                )
+        except Exception as e:
+            _LOGGER.exception(e)
+            self._error = e
+            raise e
+        else:
+            MODEL_READY.set(1)
+            _LOGGER.info("Модель загружена и прогрета")
+        finally:
+            self._ready.set()
+
+    async def wait_ready(self) -> None:
+        """
+        Дождаться готовности модели.
+        :param:
+        :return:
+        """
+        if not self._ready.is_set():
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout=self._wait)
+            except asyncio.TimeoutError:
+                raise WarmingUpError()
+        if self._error is not None:
+            raise RuntimeError("Model failed to load") from self._error
@@ -0,0 +1,217 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Final, NamedTuple
+
+import torch
+
+from hpc_bot.metrics import (
+    KV_CACHE_BYTES,
+    KV_CACHE_EVICTIONS,
+    KV_CACHE_HITS,
+    KV_CACHE_MISSES,
+    SYSTEM_PREFIX_HITS,
+)
+
+KV_CACHE_BUDGET: Final[int] = int(os.environ.get('KV_CACHE_BUDGET', 2 * 1024 ** 3))
+
+PastKeyValues = tuple[tuple[torch.Tensor, ...], ...]
+
+
+class PrefixEntry(NamedTuple):
+    """
+    Сохранённое состояние внимания для префикса переписки.
+    """
+    ids: torch.Tensor
+    past: PastKeyValues
+    nbytes: int
+
+
+def past_size(past: PastKeyValues) -> int:
+    """
+    Посчитать объём памяти, занимаемый состоянием внимания.
+    :param past: ключи и значения внимания всех слоёв.
+    :return: размер в байтах.
+    """
+    return sum(tensor.numel() * tensor.element_size() for layer in past for tensor in layer)
+
+
+def truncate_past(past: PastKeyValues, length: int) -> PastKeyValues:
+    """
+    Обрезать состояние внимания до первых `length` токенов.
+    :param past: ключи и значения внимания всех слоёв.
+    :param length: количество токенов префикса.
+    :return: обрезанное состояние внимания.
+    """
+    return tuple(
+        tuple(tensor[:, :, :length] for tensor in layer)
+        for layer in past
+    )
+
+
+def common_prefix(left: torch.Tensor, right: torch.Tensor) -> int:
+    """
+    Найти длину общего префикса двух последовательностей токенов.
+    :param left: первая последовательность.
+    :param right: вторая последовательность.
+    :return: количество совпадающих токенов с начала.
+    """
+    length: int = min(len(left), len(right))
+    mismatch: torch.Tensor = (left[:length] != right[:length]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else length
+
+
+class PrefixCache:
+    """
+    Кэш состояний внимания (`past_key_values`) по чатам.
+    Позволяет на новом ходе диалога считать только новые токены,
+    а не всю переписку заново. Вытеснение LRU в рамках бюджета памяти.
+    """
+
+    __slots__ = (
+        '_budget',
+        '_entries',
+        '_size',
+        '_lock',
+        '_shared',
+        '_shared_text'
+    )
+
+    def __init__(self, budget: int = KV_CACHE_BUDGET) -> None:
+        self._budget: int = budget
+        self._entries: OrderedDict[int, PrefixEntry] = OrderedDict()
+        self._size: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._shared: PrefixEntry | None = None
+        self._shared_text: str = ""
+
+    def __len__(self) -> int:
+        """
+        Количество чатов с сохранённым состоянием.
+        :param:
+        :return:
+        """
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        """
+        Объём памяти всех сохранённых состояний в байтах.
+        :param:
+        :return:
+        """
+        return self._size
+
+    @property
+    def shared_text(self) -> str:
+        """
+        Текст общего префикса, для которого посчитано состояние.
+        :param:
+        :return:
+        """
+        return self._shared_text
+
+    def set_shared(self, text: str, input_ids: torch.Tensor | None, past: PastKeyValues | None) -> None:
+        """
+        Сохранить состояние общего для всех чатов префикса, например системного промпта.
+        Общий префикс не вытесняется и не учитывается в бюджете.
+        :param text: текст префикса.
+        :param input_ids: токены префикса.
+        :param past: ключи и значения внимания всех слоёв.
+        :return:
+        """
+        with self._lock:
+            self._shared_text = text
+            self._shared = None
+            if input_ids is not None and past is not None:
+                self._shared = PrefixEntry(ids=input_ids.cpu(), past=past, nbytes=past_size(past))
+
+    def lookup(self, chat_id: int | None, input_ids: torch.Tensor) -> tuple[int, PastKeyValues | None]:
+        """
+        Найти сохранённое состояние, покрывающее начало промпта.
+        Если состояние чата покрывает меньше общего префикса, то используется общий.
+        Последний токен промпта всегда остаётся непокрытым, так как генерация
+        должна начаться с него.
+        :param chat_id: индефикатор чата.
+        :param input_ids: токены промпта.
+        :return: количество покрытых токенов и состояние внимания для них.
+        """
+        entry: PrefixEntry | None = None
+        with self._lock:
+            # У переписки без чата нет своего состояния, но общий префикс к ней подходит
+            if chat_id is not None:
+                entry = self._entries.get(chat_id)
+                if entry is not None:
+                    self._entries.move_to_end(chat_id)
+            shared: PrefixEntry | None = self._shared
+
+        input_ids = input_ids.cpu()
+        covered: int = 0
+        if entry is not None:
+            covered = min(common_prefix(entry.ids, input_ids), len(input_ids) - 1)
+        if shared is not None:
+            shared_covered: int = min(common_prefix(shared.ids, input_ids), len(input_ids) - 1)
+            if shared_covered > covered:
+                covered, entry = shared_covered, shared
+
+        if not covered or entry is None:
+            KV_CACHE_MISSES.inc()
+            return 0, None
+
+        if entry is shared:
+            SYSTEM_PREFIX_HITS.inc()
+        else:
+            KV_CACHE_HITS.inc()
+        return covered, truncate_past(entry.past, covered)
+
+    def store(self, chat_id: int, input_ids: torch.Tensor, past: PastKeyValues) -> None:
+        """
+        Сохранить состояние внимания чата и вытеснить старые записи сверх бюджета.
+        :param chat_id: индефикатор чата.
+        :param input_ids: токены, которые покрывает состояние.
+        :param past: ключи и значения внимания всех слоёв.
+        :return:
+        """
+        nbytes: int = past_size(past)
+        with self._lock:
+            self._pop(chat_id)
+            if nbytes > self._budget:
+                return
+
+            self._entries[chat_id] = PrefixEntry(ids=input_ids.cpu(), past=past, nbytes=nbytes)
+            self._size += nbytes
+            while self._size > self._budget:
+                self._pop(next(iter(self._entries)))
+                KV_CACHE_EVICTIONS.inc()
+            KV_CACHE_BYTES.set(self._size)
+
+    def invalidate(self, chat_id: int) -> None:
+        """
+        Удалить состояние чата, например после сброса контекста.
+        :param chat_id: индефикатор чата.
+        :return:
+        """
+        with self._lock:
+            self._pop(chat_id)
+            KV_CACHE_BYTES.set(self._size)
+
+    def clear(self) -> None:
+        """
+        Удалить все сохранённые состояния.
+        :param:
+        :return:
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            KV_CACHE_BYTES.set(self._size)
+
+    def _pop(self, chat_id: int) -> None:
+        """
+        Удалить запись чата без блокировки.
+        :param chat_id: индефикатор чата.
+        :return:
+        """
+        entry: PrefixEntry | None = self._entries.pop(chat_id, None)
+        if entry is not None:
+            self._size -= entry.nbytes
@@ -0,0 +1,48 @@
+import asyncio
+from typing import AsyncIterator, Final
+
+from transformers import PreTrainedTokenizerBase, TextStreamer
+
+_END: Final[object] = object()
+
+
+class AsyncTextStreamer(TextStreamer):
+    """
+    Стример токенов из потока инференса в событийный цикл.
+    Генерация вызывает `put` в потоке исполнителя, а готовые куски текста
+    передаются в асинхронную очередь и читаются через `async for`.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, loop: asyncio.AbstractEventLoop) -> None:
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self._loop: asyncio.AbstractEventLoop = loop
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+        """
+        Передать готовый кусок текста в событийный цикл.
+        :param text: декодированный кусок ответа.
+        :param stream_end: признак окончания генерации.
+        :return:
+        """
+        if text:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, text)
+        if stream_end:
+            self.close()
+
+    def close(self) -> None:
+        """
+        Сообщить читателю, что кусков больше не будет.
+        :param:
+        :return:
+        """
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, _END)
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        """
+        Читать куски ответа по мере их генерации.
+        :param:
+        :return: куски ответа модели.
+        """
+        while (chunk := await self._queue.get()) is not _END:
+            yield chunk
@@ -0,0 +1,97 @@
+import time
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+
+class PhaseTimer(BaseStreamer):
+    """
+    Засекает фазы генерации по вызовам стримера.
+    `generate` сначала передаёт стримеру промпт, а затем каждый новый токен,
+    поэтому время второго вызова - конец предзаполнения и первый токен ответа.
+    Все вызовы пробрасываются во вложенный стример, если он есть.
+    """
+
+    def __init__(self, streamer: BaseStreamer | None = None) -> None:
+        self.started: float = time.perf_counter()
+        self.prefill_started: float = self.started
+        self.first_token: float | None = None
+        self.finished: float | None = None
+        self._streamer: BaseStreamer | None = streamer
+        self._calls: int = 0
+
+    def mark_prefill(self) -> None:
+        """
+        Отметить начало работы модели над промптом.
+        :param:
+        :return:
+        """
+        self.prefill_started = time.perf_counter()
+
+    def put(self, value: torch.Tensor) -> None:
+        """
+        Отметить очередной шаг генерации.
+        :param value: промпт или новые токены.
+        :return:
+        """
+        self._calls += 1
+        if self._calls == 2:
+            self.first_token = time.perf_counter()
+        if self._streamer is not None:
+            self._streamer.put(value)
+
+    def end(self) -> None:
+        """
+        Отметить конец генерации.
+        :param:
+        :return:
+        """
+        self.finished = time.perf_counter()
+        if self._streamer is not None:
+            self._streamer.end()
+
+    @property
+    def time_to_first_token(self) -> float:
+        """
+        Время от начала генерации до первого токена ответа.
+        :param:
+        :return: секунды.
+        """
+        return (self.first_token or self.finished or time.perf_counter()) - self.started
+
+    @property
+    def prefill_time(self) -> float:
+        """
+        Время обработки промпта моделью до первого токена ответа.
+        :param:
+        :return: секунды.
+        """
+        return self.started + self.time_to_first_token - self.prefill_started
+
+    @property
+    def decode_time(self) -> float:
+        """
+        Время генерации токенов после первого.
+        :param:
+        :return: секунды.
+        """
+        if self.first_token is None or self.finished is None:
+            return 0.0
+        return self.finished - self.first_token
+
+
+def generated_lengths(output_ids: torch.Tensor, eos_token_id: int | list[int] | None) -> list[int]:
+    """
+    Посчитать количество сгенерированных токенов каждого ответа.
+    Закончившиеся раньше других ответы дополняются паддингом, который не учитывается.
+    :param output_ids: токены ответов без промпта размерности (пакет, длина).
+    :param eos_token_id: токены конца ответа.
+    :return: количество токенов каждого ответа вместе с токеном конца.
+    """
+    length: int = output_ids.shape[1]
+    if eos_token_id is None:
+        return [length] * output_ids.shape[0]
+    eos: torch.Tensor = torch.tensor(eos_token_id, device=output_ids.device).view(-1)
+    finished: torch.Tensor = torch.isin(output_ids, eos)
+    first: torch.Tensor = torch.where(finished.any(dim=1), finished.int().argmax(dim=1) + 1, length)
+    return first.tolist()
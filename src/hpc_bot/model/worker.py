@@ -0,0 +1,185 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Final
+
+from hpc_bot.metrics import INFERENCE_JOBS, JOB_CLAIMS
+from hpc_bot.model.batching import BatchScheduler
+from hpc_bot.model.conversion import Conversation
+from hpc_bot.model.executor import InferenceExecutor
+from hpc_bot.model.inference import ModelInference
+from hpc_bot.model.jobs import (
+    JOB_CLAIM_IDLE,
+    JOB_MAX_DELIVERIES,
+    WORKER_NAME,
+    JobQueue,
+    load_conversation,
+)
+from hpc_bot.model.loader import ModelLoader
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+WORKER_CONCURRENCY: Final[int] = int(os.environ.get('WORKER_CONCURRENCY', 8))
+WORKER_BLOCK: Final[int] = int(os.environ.get('WORKER_BLOCK', 1000))
+
+
+class InferenceWorker:
+    """
+    Процесс инференса, разбирающий очередь задач генерации.
+    Одновременно выполняется не больше `concurrency` задач: новые задачи
+    читаются из потока только при свободных местах, поэтому лишние задачи
+    остаются в Redis и достаются другим процессам. Пока задача выполняется,
+    процесс периодически отмечает её, а задачи упавших процессов забирает
+    себе после JOB_CLAIM_IDLE мс простоя.
+    """
+
+    __slots__ = (
+        '_queue',
+        '_inference',
+        '_consumer',
+        '_concurrency',
+        '_claim_idle',
+        '_max_deliveries',
+        '_tasks',
+        '_claimed_at'
+    )
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        inference: InferenceExecutor | BatchScheduler,
+        consumer: str = WORKER_NAME,
+        concurrency: int = WORKER_CONCURRENCY,
+        claim_idle: int = JOB_CLAIM_IDLE,
+        max_deliveries: int = JOB_MAX_DELIVERIES
+    ) -> None:
+        self._queue: JobQueue = queue
+        self._inference: InferenceExecutor | BatchScheduler = inference
+        self._consumer: str = consumer
+        self._concurrency: int = concurrency
+        self._claim_idle: int = claim_idle
+        self._max_deliveries: int = max_deliveries
+        self._tasks: set[asyncio.Task] = set()
+        self._claimed_at: float = 0.0
+
+    async def run(self, block: int = WORKER_BLOCK) -> None:
+        """
+        Разбирать очередь задач, пока процесс не остановят.
+        :param block: сколько мс ждать новых задач за один запрос.
+        :return:
+        """
+        await self._queue.ensure_group()
+        try:
+            while True:
+                await self.poll(block)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def poll(self, block: int) -> None:
+        """
+        Дождаться свободного места и взять задачи: сначала брошенные, затем новые.
+        :param block: сколько мс ждать новых задач.
+        :return:
+        """
+        if len(self._tasks) >= self._concurrency:
+            await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+
+        jobs: list[tuple[str, dict[str, str] | None]] = []
+        if time.monotonic() - self._claimed_at >= self._claim_idle / 2000:
+            self._claimed_at = time.monotonic()
+            claimed, exhausted = await self._queue.claim(
+                self._consumer,
+                self._concurrency - len(self._tasks),
+                self._claim_idle,
+                self._max_deliveries
+            )
+            jobs.extend(claimed)
+            JOB_CLAIMS.inc(len(jobs))
+            for job_id in exhausted:
+                _LOGGER.warning(f"Задача {job_id} выдавалась {self._max_deliveries} раз и отброшена")
+                INFERENCE_JOBS.labels('dropped').inc()
+                await self._queue.push_result(job_id, error='Задача не выполнена ни одним процессом')
+                await self._queue.ack(job_id)
+
+        free: int = self._concurrency - len(self._tasks) - len(jobs)
+        if free > 0:
+            jobs += await self._queue.read(self._consumer, free, block)
+
+        for job_id, fields in jobs:
+            task: asyncio.Task = asyncio.create_task(self.process(job_id, fields))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def process(self, job_id: str, fields: dict[str, str] | None) -> None:
+        """
+        Выполнить задачу, записать результат и подтвердить её.
+        Задачи, удалённые фронтендом до выполнения, только подтверждаются.
+        :param job_id: индефикатор задачи в потоке.
+        :param fields: поля задачи.
+        :return:
+        """
+        if not fields:
+            await self._queue.ack(job_id)
+            return
+
+        heartbeat: asyncio.Task = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            body: dict[str, Any] = json.loads(fields['job'])
+            conversation: Conversation = load_conversation(body)
+            if body['reset'] and conversation.chat_id is not None:
+                await self._inference.invalidate(conversation.chat_id)
+
+            output: str
+            if body['stream']:
+                chunks: list[str] = []
+                async for chunk in self._inference.stream(conversation):
+                    chunks.append(chunk)
+                    await self._queue.push_result(job_id, chunk=chunk)
+                output = ''.join(chunks)
+            else:
+                output = await self._inference(conversation)
+            await self._queue.push_result(job_id, done=output)
+            INFERENCE_JOBS.labels('done').inc()
+        except asyncio.CancelledError:
+            # Задача остаётся неподтверждённой и достанется другому процессу
+            raise
+        except Exception as e:
+            _LOGGER.exception(e)
+            INFERENCE_JOBS.labels('failed').inc()
+            await self._queue.push_result(job_id, error=str(e), type=type(e).__name__)
+        finally:
+            heartbeat.cancel()
+        await self._queue.ack(job_id)
+
+    async def _heartbeat(self, job_id: str) -> None:
+        """
+        Отмечать выполняемую задачу, чтобы её не забрал другой процесс.
+        :param job_id: индефикатор задачи в потоке.
+        :return:
+        """
+        while True:
+            await asyncio.sleep(self._claim_idle / 3000)
+            try:
+                await self._queue.touch(self._consumer, job_id)
+            except Exception as e:
+                _LOGGER.warning(f"Не удалось продлить задачу {job_id}: {e}")
+
+
+async def main() -> None:
+    """
+    Запуск процесса инференса, разбирающего очередь задач генерации.
+    Задачи начинают читаться только после загрузки и прогрева модели.
+    :param:
+    :return:
+    """
+    executor: InferenceExecutor = InferenceExecutor(ModelInference.without_model())
+    await ModelLoader(executor).load()
+    worker: InferenceWorker = InferenceWorker(
+        queue=JobQueue(),
+        inference=BatchScheduler(executor)
+    )
+    await worker.run()
@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Final
+
+from hpc_bot.exceptions import BusyError, RateLimitError
+from hpc_bot.metrics import (
+    ADMISSION_QUEUE_DEPTH,
+    ADMISSION_REJECTIONS,
+    ADMISSION_WAIT_TIME,
+)
+from hpc_bot.telegram.cache import ConversationCache
+
+ADMISSION_ACTIVE: Final[int] = int(os.environ.get('ADMISSION_ACTIVE', 8))
+ADMISSION_QUEUE: Final[int] = int(os.environ.get('ADMISSION_QUEUE', 64))
+USER_RATE: Final[float] = float(os.environ.get('USER_RATE', 0.2))
+USER_BURST: Final[int] = int(os.environ.get('USER_BURST', 5))
+# Сколько символов сообщения стоят столько же, сколько один ход
+ADMISSION_COST_CHARS: Final[int] = int(os.environ.get('ADMISSION_COST_CHARS', 1000))
+
+
+class AdmissionController:
+    """
+    Допуск ходов к модели.
+    Частота сообщений каждого пользователя ограничена корзиной токенов в Redis.
+    Одновременно к модели допускается ограниченное число ходов, остальные ждут
+    в ограниченной очереди, а при её переполнении сразу отклоняются.
+    Очередь справедливая: ходы упорядочены по виртуальному времени окончания,
+    которое у каждого пользователя растёт со стоимостью его ходов, поэтому
+    один активный пользователь не может отодвинуть остальных.
+    Частота общая для всех процессов бота, а очередь и число допущенных ходов
+    свои у каждого процесса, поэтому при нескольких процессах лимиты нужно делить
+    между ними.
+    """
+
+    __slots__ = (
+        '_cache',
+        '_max_active',
+        '_max_pending',
+        '_rate',
+        '_burst',
+        '_active',
+        '_queue',
+        '_counter',
+        '_virtual_time',
+        '_finish'
+    )
+
+    def __init__(
+        self,
+        cache: ConversationCache,
+        max_active: int = ADMISSION_ACTIVE,
+        max_pending: int = ADMISSION_QUEUE,
+        rate: float = USER_RATE,
+        burst: int = USER_BURST
+    ) -> None:
+        self._cache: ConversationCache = cache
+        self._max_active: int = max_active
+        self._max_pending: int = max_pending
+        self._rate: float = rate
+        self._burst: int = burst
+        self._active: int = 0
+        self._queue: list[tuple[float, int, asyncio.Future]] = []
+        self._counter: itertools.count = itertools.count()
+        self._virtual_time: float = 0.0
+        self._finish: dict[int, float] = {}
+
+    @property
+    def pending(self) -> int:
+        """
+        Количество ходов в очереди.
+        :param:
+        :return:
+        """
+        return len(self._queue)
+
+    @property
+    def idle(self) -> bool:
+        """
+        Нет ни допущенных к модели, ни ожидающих ходов.
+        :param:
+        :return:
+        """
+        return self._active == 0 and not self._queue
+
+    async def check_rate(self, user_id: int) -> None:
+        """
+        Проверить, что пользователь не превысил частоту сообщений.
+        :param user_id: индефикатор пользователя в Telegram.
+        :return:
+        """
+        wait: float = await self._cache.take_rate_token(user_id, self._rate, self._burst)
+        if wait > 0:
+            ADMISSION_REJECTIONS.labels('rate').inc()
+            raise RateLimitError(wait)
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, cost: float = 1.0) -> AsyncIterator[None]:
+        """
+        Занять место у модели на время хода.
+        :param user_id: индефикатор пользователя в Telegram.
+        :param cost: стоимость хода, например по длине сообщения.
+        :return:
+        """
+        started: float = time.perf_counter()
+        if self._active >= self._max_active or self._queue:
+            await self._wait(user_id, cost)
+        else:
+            # Без очереди делить нечего, стоимость хода не учитывается
+            self._active += 1
+        ADMISSION_WAIT_TIME.observe(time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self._active -= 1
+            self._dispatch()
+
+    async def _wait(self, user_id: int, cost: float) -> None:
+        """
+        Встать в очередь и дождаться своей очереди.
+        :param user_id: индефикатор пользователя в Telegram.
+        :param cost: стоимость хода.
+        :return:
+        """
+        if len(self._queue) >= self._max_pending:
+            ADMISSION_REJECTIONS.labels('queue').inc()
+            raise BusyError(len(self._queue) + 1)
+
+        finish: float = max(self._virtual_time, self._finish.get(user_id, 0.0)) + cost
+        self._finish[user_id] = finish
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (finish, next(self._counter), future))
+        ADMISSION_QUEUE_DEPTH.set(len(self._queue))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Место уже выдано, его нужно передать следующему
+                self._active -= 1
+                self._dispatch()
+            else:
+                self._queue = [item for item in self._queue if item[2] is not future]
+                heapq.heapify(self._queue)
+                ADMISSION_QUEUE_DEPTH.set(len(self._queue))
+            raise
+
+    def _dispatch(self) -> None:
+        """
+        Допустить к модели ходы с наименьшим виртуальным временем окончания.
+        :param:
+        :return:
+        """
+        while self._queue and self._active < self._max_active:
+            finish, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self._virtual_time = finish
+            self._active += 1
+            future.set_result(None)
+        ADMISSION_QUEUE_DEPTH.set(len(self._queue))
+        # Пользователи, отставшие от виртуального времени, ничем не отличаются от новых
+        stale: list[int] = [
+            user_id for user_id, finish in self._finish.items()
+            if finish <= self._virtual_time
+        ]
+        for user_id in stale:
+            del self._finish[user_id]
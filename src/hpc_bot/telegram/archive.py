@@ -0,0 +1,138 @@
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from typing import Final, NamedTuple
+
+ARCHIVE_PATH: Final[str] = os.environ.get('ARCHIVE_PATH', '')
+ARCHIVE_LEVEL: Final[int] = int(os.environ.get('ARCHIVE_LEVEL', 6))
+
+RECORD_LENGTH: Final[struct.Struct] = struct.Struct('>I')
+
+SCHEMA: Final[str] = """
+CREATE TABLE IF NOT EXISTS conversations (
+    chat_id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    head INTEGER NOT NULL,
+    records BLOB NOT NULL,
+    archived REAL NOT NULL
+)
+"""
+
+
+class ArchivedConversation(NamedTuple):
+    """
+    Переписка, выгруженная из Redis: записи сообщений в формате кэша
+    вместе с поколением и сквозным номером начала списка.
+    """
+    username: str
+    epoch: int
+    head: int
+    records: list[bytes]
+
+
+def pack_records(records: list[bytes], level: int = ARCHIVE_LEVEL) -> bytes:
+    """
+    Склеить записи сообщений с префиксами длины и сжать.
+    :param records: записи сообщений.
+    :param level: уровень сжатия zlib.
+    :return: сжатый блок.
+    """
+    return zlib.compress(b''.join(RECORD_LENGTH.pack(len(record)) + record for record in records), level)
+
+
+def unpack_records(data: bytes) -> list[bytes]:
+    """
+    Разобрать сжатый блок на записи сообщений.
+    :param data: сжатый блок.
+    :return: записи сообщений.
+    """
+    raw: bytes = zlib.decompress(data)
+    records: list[bytes] = []
+    offset: int = 0
+    while offset < len(raw):
+        (length,) = RECORD_LENGTH.unpack_from(raw, offset)
+        offset += RECORD_LENGTH.size
+        records.append(raw[offset:offset + length])
+        offset += length
+    return records
+
+
+class ConversationArchive:
+    """
+    Архив холодных переписок в SQLite на диске.
+    Переписка хранится одной строкой со сжатым блоком записей, поэтому
+    выгрузка и возврат в Redis - одна запись и одно чтение. Методы
+    блокирующие и вызываются из пула потоков.
+    """
+
+    __slots__ = (
+        '_connection',
+        '_lock'
+    )
+
+    def __init__(self, path: str = ARCHIVE_PATH) -> None:
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(SCHEMA)
+        self._connection.commit()
+        self._lock: threading.Lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """
+        Количество переписок в архиве.
+        :param:
+        :return:
+        """
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+
+    def save(self, chat_id: int, conversation: ArchivedConversation) -> None:
+        """
+        Сохранить переписку, заменив предыдущую версию.
+        :param chat_id: индефикатор чата в Telegram.
+        :param conversation: переписка.
+        :return:
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    chat_id,
+                    conversation.username,
+                    conversation.epoch,
+                    conversation.head,
+                    pack_records(conversation.records),
+                    time.time(),
+                )
+            )
+
+    def load(self, chat_id: int) -> ArchivedConversation | None:
+        """
+        Прочитать переписку.
+        :param chat_id: индефикатор чата в Telegram.
+        :return: переписка или None, если её нет в архиве.
+        """
+        with self._lock:
+            row: tuple | None = self._connection.execute(
+                'SELECT username, epoch, head, records FROM conversations WHERE chat_id = ?',
+                (chat_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        username, epoch, head, data = row
+        return ArchivedConversation(username, epoch, head, unpack_records(data))
+
+    def delete(self, chat_id: int) -> None:
+        """
+        Удалить переписку из архива.
+        :param chat_id: индефикатор чата в Telegram.
+        :return:
+        """
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM conversations WHERE chat_id = ?', (chat_id,))
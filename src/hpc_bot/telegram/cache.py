@@ -1,23 +1,334 @@
+import asyncio
+import hashlib
 import os
+import time
+from typing import Final
 
 import redis.asyncio as redis
 
+from hpc_bot.metrics import ARCHIVE_OPERATIONS, ARCHIVE_TIME, CONVERSATION_DEPTH
 from hpc_bot.model.conversion import Message
 from hpc_bot.singleton import Singleton
+from hpc_bot.telegram.archive import (
+    ARCHIVE_PATH,
+    ArchivedConversation,
+    ConversationArchive,
+)
+from hpc_bot.telegram.codec import decode_message, encode_message, is_legacy
+from hpc_bot.telegram.history_cache import HistoryCache, HistoryEntry
+
+TOKENS_TTL: Final[int] = int(os.environ.get('TOKENS_TTL', 7 * 24 * 60 * 60))
+METRIC_SCAN_BATCH: Final[int] = int(os.environ.get('METRIC_SCAN_BATCH', 500))
+# Время жизни переписки без обращений, продлевается каждым ходом; 0 - без ограничения.
+# Действует только с архивом, без него переписки не истекают.
+CONVERSATION_TTL: Final[int] = int(os.environ.get('CONVERSATION_TTL', 7 * 24 * 60 * 60))
+
+# Прочитать из списка только хвост после сохранённой в процессе истории.
+# KEYS: список сообщений, служебный хэш чата; ARGV: поколение и конец сохранённой истории
+FETCH_TAIL: Final[str] = """
+local meta = redis.call('HMGET', KEYS[2], 'epoch', 'head')
+local epoch = tonumber(meta[1]) or 0
+local head = tonumber(meta[2]) or 0
+local length = redis.call('LLEN', KEYS[1])
+local start = head
+local cached = tonumber(ARGV[2])
+if tonumber(ARGV[1]) == epoch and cached >= head and cached <= head + length then
+    start = cached
+end
+local tail = redis.call('LRANGE', KEYS[1], start - head, -1)
+"""
+HISTORY_SCRIPT: Final[str] = FETCH_TAIL + """
+return {epoch, head, start, tail}
+"""
+# Функции жизненного цикла переписки.
+# touch отмечает обращение к чату и продлевает время жизни списка сообщений.
+# Служебный хэш времени жизни не имеет, чтобы поколение не терялось вместе со списком.
+# reset_lost сдвигает поколение, если список истёк или вытеснен из памяти,
+# чтобы процессы не склеили сохранённую историю с новыми сообщениями.
+LIFECYCLE: Final[str] = """
+local function touch(list, activity, chat_id, now, ttl)
+    redis.call('ZADD', activity, now, chat_id)
+    if tonumber(ttl) > 0 then
+        redis.call('EXPIRE', list, ttl)
+    end
+end
+local function reset_lost(list, meta)
+    if redis.call('EXISTS', list) == 0 then
+        redis.call('HINCRBY', meta, 'epoch', 1)
+        redis.call('HSET', meta, 'head', 0)
+    end
+end
+"""
+# Проверить чат, прочитать историю и дописать сообщение пользователя за один запрос.
+# Для выгруженной в архив переписки возвращается 0, чтобы её сначала вернули в Redis.
+OPEN_TURN_SCRIPT: Final[str] = LIFECYCLE + """
+if redis.call('HEXISTS', KEYS[3], ARGV[3]) == 0 then
+    return false
+end
+if redis.call('HEXISTS', KEYS[2], 'archived') == 1 then
+    return 0
+end
+reset_lost(KEYS[1], KEYS[2])
+""" + FETCH_TAIL + """
+local pushed = redis.call('RPUSH', KEYS[1], ARGV[4])
+touch(KEYS[1], KEYS[4], ARGV[3], ARGV[5], ARGV[6])
+return {epoch, head, start, tail, pushed}
+"""
+# Перезаписать старые записи в новом формате, если их никто не успел изменить.
+# ARGV: тройки из сквозного номера, старой и новой записи
+MIGRATE_SCRIPT: Final[str] = """
+local head = tonumber(redis.call('HGET', KEYS[2], 'head')) or 0
+local migrated = 0
+for i = 1, #ARGV, 3 do
+    local index = tonumber(ARGV[i]) - head
+    if index >= 0 and redis.call('LINDEX', KEYS[1], index) == ARGV[i + 1] then
+        redis.call('LSET', KEYS[1], index, ARGV[i + 2])
+        migrated = migrated + 1
+    end
+end
+return migrated
+"""
+# Дописать сообщение и выбросить первые сообщения, сдвинув сквозной номер начала списка
+CLOSE_TURN_SCRIPT: Final[str] = LIFECYCLE + """
+local pushed = 0
+reset_lost(KEYS[1], KEYS[2])
+if ARGV[1] ~= '' then
+    pushed = redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+local count = math.min(tonumber(ARGV[2]), redis.call('LLEN', KEYS[1]))
+if count > 0 then
+    redis.call('LTRIM', KEYS[1], count, -1)
+    redis.call('HINCRBY', KEYS[2], 'head', count)
+end
+touch(KEYS[1], KEYS[3], ARGV[3], ARGV[4], ARGV[5])
+return {pushed, count}
+"""
+# Удалить выгруженную в архив переписку, если к чату не обращались после чтения.
+# Чат остаётся в списке чатов пользователей, а служебный хэш с поколением
+# отмечается флагом archived.
+# KEYS: список сообщений, служебный хэш чата, время обращений, блокировка хода;
+# ARGV: индефикатор чата, время последнего обращения при чтении
+DEMOTE_SCRIPT: Final[str] = """
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    return 0
+end
+if tonumber(redis.call('ZSCORE', KEYS[3], ARGV[1])) ~= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[2], 'archived', 1)
+redis.call('ZREM', KEYS[3], ARGV[1])
+return 1
+"""
+# Вернуть переписку из архива, если её не вернул другой процесс и чат не сброшен.
+# Поколение сдвигается, чтобы процессы не склеили возвращённую историю с сохранённой до выгрузки.
+# KEYS: список сообщений, служебный хэш чата, время обращений;
+# ARGV: индефикатор чата, текущее время в мс, время жизни в с, поколение,
+# сквозной номер начала, записи сообщений
+REHYDRATE_SCRIPT: Final[str] = LIFECYCLE + """
+if redis.call('HEXISTS', KEYS[2], 'archived') == 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 6, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+local epoch = math.max(tonumber(redis.call('HGET', KEYS[2], 'epoch')) or 0, tonumber(ARGV[4])) + 1
+redis.call('HSET', KEYS[2], 'epoch', epoch, 'head', ARGV[5])
+redis.call('HDEL', KEYS[2], 'archived')
+touch(KEYS[1], KEYS[3], ARGV[1], ARGV[2], ARGV[3])
+return 1
+"""
+# Заменить первые сообщения пересказом, если чат не менялся с чтения и ход никем не занят.
+# Поколение меняется, чтобы процессы перечитали историю, а не склеили её со старой.
+# KEYS: список сообщений, служебный хэш чата, блокировка хода;
+# ARGV: поколение и сквозной номер начала при чтении, количество сообщений, пересказ
+COMPACT_SCRIPT: Final[str] = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+local meta = redis.call('HMGET', KEYS[2], 'epoch', 'head')
+if (tonumber(meta[1]) or 0) ~= tonumber(ARGV[1]) or (tonumber(meta[2]) or 0) ~= tonumber(ARGV[2]) then
+    return 0
+end
+local count = tonumber(ARGV[3])
+if redis.call('LLEN', KEYS[1]) < count then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], count, -1)
+redis.call('LPUSH', KEYS[1], ARGV[4])
+redis.call('HINCRBY', KEYS[2], 'epoch', 1)
+redis.call('HINCRBY', KEYS[2], 'head', count - 1)
+return 1
+"""
+# Положить сообщение во входящие чата и попытаться занять ход.
+# KEYS: входящие, блокировка хода; ARGV: текст, токен владельца, время жизни в мс
+ENQUEUE_SCRIPT: Final[str] = """
+redis.call('RPUSH', KEYS[1], ARGV[1])
+return redis.call('SET', KEYS[2], ARGV[2], 'NX', 'PX', ARGV[3]) and 1 or 0
+"""
+# Забрать все входящие сообщения чата
+TAKE_SCRIPT: Final[str] = """
+local messages = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+return messages
+"""
+# Освободить ход, если входящих не осталось или если освобождение принудительное
+RELEASE_SCRIPT: Final[str] = """
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return 1
+end
+if ARGV[2] == '0' and redis.call('LLEN', KEYS[1]) > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+return 1
+"""
+# Продлить ход, если он всё ещё принадлежит владельцу
+REFRESH_SCRIPT: Final[str] = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+# Корзина токенов пользователя: вернуть 0, если сообщение разрешено, иначе сколько мс ждать.
+# ARGV: скорость пополнения в токенах в секунду, ёмкость корзины, текущее время в мс
+RATE_LIMIT_SCRIPT: Final[str] = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local wait = 0
+if tokens < 1 then
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+else
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return wait
+"""
+
+# Сохранить ответ модели и вытеснить самые старые ответы сверх предела.
+# KEYS: ключ ответа, индекс ответов; ARGV: текст, секунды генерации, время жизни в с,
+# предел числа ответов, текущее время в мс
+PUT_RESPONSE_SCRIPT: Final[str] = """
+redis.call('HSET', KEYS[1], 'text', ARGV[1], 'seconds', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[5], KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[5]) - tonumber(ARGV[3]) * 1000)
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local evicted = redis.call('ZPOPMIN', KEYS[2], excess)
+    for i = 1, #evicted, 2 do
+        redis.call('DEL', evicted[i])
+    end
+end
+return excess
+"""
 
 
 class ConversationCache(metaclass=Singleton):
     """
-    Кэш для хранения переписок с моделью
+    Кэш для хранения переписок с моделью.
+    Перед Redis стоит кэш историй в памяти процесса, поэтому на каждом
+    ходе из Redis читаются только новые сообщения чата.
+    Сообщения хранятся в компактном двоичном формате, старые записи в JSON
+    читаются прозрачно и перезаписываются при первом чтении.
+    Клиенты Redis с декодированием ответов и без него можно передать
+    готовыми, иначе они подключаются к CACHE_ADDRESS.
     """
     KEY_PATTERN: str = 'conversation:{chat_id}'
+    META_PATTERN: str = 'conversation_meta:{chat_id}'
     USER_CHAT: str = 'active_chats_users'
+    TOKENS_PATTERN: str = 'tokens:{version}:{digest}'
+    INBOX_PATTERN: str = 'inbox:{chat_id}'
+    LOCK_PATTERN: str = 'turn_lock:{chat_id}'
+    RATE_PATTERN: str = 'rate:{user_id}'
+    RESPONSE_PATTERN: str = 'response:{digest}'
+    RESPONSE_INDEX: str = 'responses'
+    ACTIVITY: str = 'conversation_activity'
 
-    __slots__ = ('cache',)
+    __slots__ = (
+        'cache',
+        'raw',
+        'history',
+        'archive',
+        'ttl',
+        '_history_script',
+        '_open_turn',
+        '_close_turn',
+        '_migrate',
+        '_compact',
+        '_demote',
+        '_rehydrate',
+        '_enqueue',
+        '_take',
+        '_release',
+        '_refresh',
+        '_rate_limit',
+        '_put_response'
+    )
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        cache: redis.Redis | None = None,
+        raw: redis.Redis | None = None,
+        archive: ConversationArchive | None = None
+    ) -> None:
         cache_host: str = os.environ.get('CACHE_ADDRESS', 'localhost')
-        self.cache = redis.Redis(host=cache_host, port=6379, decode_responses=True)
+        self.cache = cache or redis.Redis(host=cache_host, port=6379, decode_responses=True)
+        # Переписки хранятся в двоичном виде, поэтому читаются без декодирования ответов
+        self.raw = raw or redis.Redis(host=cache_host, port=6379, decode_responses=False)
+        self.history: HistoryCache = HistoryCache()
+        # Без пути к архиву холодные переписки не выгружаются и истекают по времени жизни
+        if archive is None and ARCHIVE_PATH:
+            archive = ConversationArchive(ARCHIVE_PATH)
+        self.archive: ConversationArchive | None = archive
+        self.ttl: int = CONVERSATION_TTL if archive is not None else 0
+        self._history_script = self.raw.register_script(HISTORY_SCRIPT)
+        self._open_turn = self.raw.register_script(OPEN_TURN_SCRIPT)
+        self._close_turn = self.raw.register_script(CLOSE_TURN_SCRIPT)
+        self._migrate = self.raw.register_script(MIGRATE_SCRIPT)
+        self._compact = self.raw.register_script(COMPACT_SCRIPT)
+        self._demote = self.raw.register_script(DEMOTE_SCRIPT)
+        self._rehydrate = self.raw.register_script(REHYDRATE_SCRIPT)
+        self._enqueue = self.cache.register_script(ENQUEUE_SCRIPT)
+        self._take = self.cache.register_script(TAKE_SCRIPT)
+        self._release = self.cache.register_script(RELEASE_SCRIPT)
+        self._refresh = self.cache.register_script(REFRESH_SCRIPT)
+        self._rate_limit = self.cache.register_script(RATE_LIMIT_SCRIPT)
+        self._put_response = self.cache.register_script(PUT_RESPONSE_SCRIPT)
+
+    def chat_keys(self, chat_id: int) -> list[str]:
+        """
+        Ключи списка сообщений и служебного хэша чата.
+        :param chat_id: индефикатор чата в Telegram.
+        :return: ключи в Redis.
+        """
+        return [self.KEY_PATTERN.format(chat_id=chat_id), self.META_PATTERN.format(chat_id=chat_id)]
+
+    def touch_args(self, chat_id: int) -> list[str | int]:
+        """
+        Аргументы отметки обращения к чату.
+        :param chat_id: индефикатор чата в Telegram.
+        :return: индефикатор чата, текущее время в мс и время жизни переписки.
+        """
+        return [str(chat_id), int(time.time() * 1000), self.ttl]
+
+    def cached_position(self, chat_id: int) -> list[int]:
+        """
+        Поколение и конец сохранённой в процессе истории чата.
+        :param chat_id: индефикатор чата в Telegram.
+        :return: аргументы для чтения хвоста истории.
+        """
+        entry: HistoryEntry | None = self.history.get(chat_id)
+        if entry is None:
+            return [-1, -1]
+        return [entry.epoch, entry.end]
 
     async def start_conversation(self, chat_id: int, username: str) -> None:
         """
@@ -27,11 +338,10 @@ class ConversationCache(metaclass=Singleton):
         :param message: сообщение заданного формата.
         :return:
         """
-        await self.cache.hset(
-            self.USER_CHAT,
-            str(chat_id),
-            username
-        )
+        async with self.cache.pipeline(transaction=True) as pipe:
+            pipe.hset(self.USER_CHAT, str(chat_id), username)
+            pipe.zadd(self.ACTIVITY, {str(chat_id): int(time.time() * 1000)})
+            await pipe.execute()
 
     async def put_message(self, chat_id: int, message: Message) -> None:
 
@@ -41,10 +351,10 @@ class ConversationCache(metaclass=Singleton):
         :param message: сообщение заданного формата.
         :return:
         """
-        await self.cache.rpush(
-            self.KEY_PATTERN.format(chat_id=chat_id),
-            message.model_dump_json()
-        )
+        data: bytes = encode_message(message)
+        length: int = await self.raw.rpush(self.KEY_PATTERN.format(chat_id=chat_id), data)
+        self.history.append(chat_id, message, len(data), length)
+        CONVERSATION_DEPTH.observe(length)
 
     async def clear_conversion(self, chat_id: int) -> None:
         """
@@ -52,7 +362,16 @@ class ConversationCache(metaclass=Singleton):
         :param chat_id: индефикатор чата в Telegram
         :return:
         """
-        await self.cache.delete(self.KEY_PATTERN.format(chat_id=chat_id))
+        key, meta = self.chat_keys(chat_id)
+        async with self.cache.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.hincrby(meta, 'epoch', 1)
+            pipe.hset(meta, 'head', 0)
+            pipe.hdel(meta, 'archived')
+            await pipe.execute()
+        self.history.invalidate(chat_id)
+        if self.archive is not None:
+            await asyncio.to_thread(self.archive.delete, chat_id)
 
     async def pop_first_message(self, chat_id: int) -> None:
         """
@@ -60,7 +379,79 @@ class ConversationCache(metaclass=Singleton):
         :param chat_id: индефикатор чата в Telegram
         :return:
         """
-        await self.cache.lpop(self.KEY_PATTERN.format(chat_id=chat_id))
+        await self.trim_conversation(chat_id, 1)
+
+    async def trim_conversation(self, chat_id: int, count: int) -> None:
+        """
+        Выбросить несколько первых сообщений из переписки одной командой
+        :param chat_id: индефикатор чата в Telegram
+        :param count: количество сообщений
+        :return:
+        """
+        _, trimmed = await self._close_turn(
+            keys=[*self.chat_keys(chat_id), self.ACTIVITY],
+            args=['', count, *self.touch_args(chat_id)]
+        )
+        self.history.trim(chat_id, trimmed)
+
+    async def pop_last_message(self, chat_id: int) -> None:
+        """
+        Выбросить последнее сообщение из переписки
+        :param chat_id: индефикатор чата в Telegram
+        :return:
+        """
+        key, meta = self.chat_keys(chat_id)
+        async with self.cache.pipeline(transaction=True) as pipe:
+            pipe.rpop(key)
+            pipe.hincrby(meta, 'epoch', 1)
+            await pipe.execute()
+        self.history.invalidate(chat_id)
+
+    async def open_turn(self, chat_id: int, message: Message) -> list[Message] | None:
+        """
+        Начать ход пользователя за один запрос к Redis.
+        Атомарно проверяет, что чат существует, читает новые сообщения истории
+        и дописывает в неё сообщение пользователя. Выгруженная в архив
+        переписка сначала возвращается в Redis.
+        :param chat_id: индефикатор чата в Telegram.
+        :param message: сообщение пользователя.
+        :return: история до сообщения пользователя или None, если чата нет.
+        """
+        data: bytes = encode_message(message)
+        result: list | int | None = None
+        for _ in range(2):
+            result = await self._open_turn(
+                keys=[*self.chat_keys(chat_id), self.USER_CHAT, self.ACTIVITY],
+                args=[*self.cached_position(chat_id), str(chat_id), data, *self.touch_args(chat_id)[1:]]
+            )
+            if result != 0 or not await self.rehydrate(chat_id):
+                break
+        if not isinstance(result, list):
+            return None
+        epoch, head, start, tail, length = result
+        await self.migrate(chat_id, start, tail)
+        history: list[Message] = self.history.merge(chat_id, epoch, head, start, tail)
+        self.history.append(chat_id, message, len(data), length)
+        CONVERSATION_DEPTH.observe(length)
+        return history
+
+    async def close_turn(self, chat_id: int, message: Message, drop: int = 0) -> None:
+        """
+        Закончить ход за один запрос к Redis.
+        Атомарно дописывает ответ бота и выбрасывает первые сообщения.
+        :param chat_id: индефикатор чата в Telegram.
+        :param message: ответ бота.
+        :param drop: количество первых сообщений, которые нужно выбросить.
+        :return:
+        """
+        data: bytes = encode_message(message)
+        length, trimmed = await self._close_turn(
+            keys=[*self.chat_keys(chat_id), self.ACTIVITY],
+            args=[data, drop, *self.touch_args(chat_id)]
+        )
+        self.history.append(chat_id, message, len(data), length)
+        self.history.trim(chat_id, trimmed)
+        CONVERSATION_DEPTH.observe(length - trimmed)
 
     async def get_correspondence(self, chat_id: int) -> list[Message]:
         """
@@ -68,16 +459,307 @@ class ConversationCache(metaclass=Singleton):
         :param chat_id: индефикатор чата в Telegram
         :return: список всех сообщений
         """
-        messages: list[str] = await self.cache.lrange(
-            self.KEY_PATTERN.format(chat_id=chat_id),
-            0,
-            -1
+        _, _, messages = await self.snapshot(chat_id)
+        return messages
+
+    async def snapshot(self, chat_id: int) -> tuple[int, int, list[Message]]:
+        """
+        Получить переписку вместе с её поколением и сквозным номером начала.
+        :param chat_id: индефикатор чата в Telegram.
+        :return: поколение, сквозной номер первого сообщения и все сообщения.
+        """
+        epoch, head, start, tail = await self._history_script(
+            keys=self.chat_keys(chat_id),
+            args=self.cached_position(chat_id)
         )
+        await self.migrate(chat_id, start, tail)
+        return epoch, head, self.history.merge(chat_id, epoch, head, start, tail)
+
+    async def compact_conversation(
+        self,
+        chat_id: int,
+        epoch: int,
+        head: int,
+        count: int,
+        memory: Message
+    ) -> bool:
+        """
+        Заменить первые сообщения переписки одним сообщением с их пересказом.
+        Замена не выполняется, если с чтения переписки её начало изменилось
+        или в чате идёт ход.
+        :param chat_id: индефикатор чата в Telegram.
+        :param epoch: поколение переписки при чтении.
+        :param head: сквозной номер первого сообщения при чтении.
+        :param count: количество заменяемых сообщений.
+        :param memory: сообщение с пересказом.
+        :return: выполнена ли замена.
+        """
+        replaced: int = await self._compact(
+            keys=[*self.chat_keys(chat_id), self.LOCK_PATTERN.format(chat_id=chat_id)],
+            args=[epoch, head, count, encode_message(memory)]
+        )
+        if replaced:
+            self.history.invalidate(chat_id)
+        return bool(replaced)
+
+    async def idle_chats(self, before: int, limit: int) -> list[int]:
+        """
+        Чаты, к которым не обращались с заданного момента.
+        :param before: время последнего обращения в мс.
+        :param limit: максимальное количество чатов.
+        :return: индефикаторы чатов, начиная с самых давних.
+        """
+        chats: list[str] = await self.cache.zrangebyscore(self.ACTIVITY, '-inf', before, start=0, num=limit)
+        return [int(chat_id) for chat_id in chats]
+
+    async def backfill_activity(self, batch: int = METRIC_SCAN_BATCH) -> int:
+        """
+        Отметить обращение к чатам, созданным до учёта обращений.
+        Время уже отмеченных чатов не меняется, выгруженные в архив пропускаются.
+        :param batch: размер пачки чатов.
+        :return: количество чатов, которым добавлена отметка.
+        """
+        added: int = 0
+        cursor: int = 0
+        while True:
+            cursor, chats = await self.cache.hscan(self.USER_CHAT, cursor, count=batch)
+            if chats:
+                async with self.cache.pipeline(transaction=False) as pipe:
+                    for chat_id in chats:
+                        pipe.hexists(self.META_PATTERN.format(chat_id=chat_id), 'archived')
+                    archived: list[bool] = await pipe.execute()
+                now: int = int(time.time() * 1000)
+                active: dict[str, int] = {
+                    chat_id: now
+                    for chat_id, flag in zip(chats, archived)
+                    if not flag
+                }
+                if active:
+                    added += await self.cache.zadd(self.ACTIVITY, active, nx=True)
+            if not cursor:
+                return added
+
+    async def demote(self, chat_id: int) -> bool:
+        """
+        Выгрузить переписку в архив и удалить её сообщения из Redis.
+        Переписка удаляется, только если после чтения к чату не обращались
+        и в нём не идёт ход, иначе запись в архиве отменяется. Сам чат
+        остаётся в Redis, поэтому команды чата работают и без возврата переписки.
+        :param chat_id: индефикатор чата в Telegram.
+        :return: выгружена ли переписка.
+        """
+        if self.archive is None:
+            return False
+        started: float = time.perf_counter()
+        key, meta = self.chat_keys(chat_id)
+        async with self.raw.pipeline(transaction=True) as pipe:
+            pipe.hget(self.USER_CHAT, str(chat_id))
+            pipe.zscore(self.ACTIVITY, str(chat_id))
+            pipe.hmget(meta, ['epoch', 'head', 'archived'])
+            pipe.lrange(key, 0, -1)
+            username, touched, (epoch, head, archived), records = await pipe.execute()
+        if username is None or touched is None or archived is not None:
+            # Чат удалён или уже в архиве, убирать из Redis нечего
+            await self.cache.zrem(self.ACTIVITY, str(chat_id))
+            return False
+
+        conversation = ArchivedConversation(username.decode(), int(epoch or 0), int(head or 0), records)
+        await asyncio.to_thread(self.archive.save, chat_id, conversation)
+        demoted: int = await self._demote(
+            keys=[key, meta, self.ACTIVITY, self.LOCK_PATTERN.format(chat_id=chat_id)],
+            args=[str(chat_id), int(touched)]
+        )
+        if not demoted:
+            await asyncio.to_thread(self.archive.delete, chat_id)
+            ARCHIVE_OPERATIONS.labels('conflict').inc()
+            return False
+        self.history.invalidate(chat_id)
+        ARCHIVE_OPERATIONS.labels('demoted').inc()
+        ARCHIVE_TIME.labels('demote').observe(time.perf_counter() - started)
+        return True
+
+    async def rehydrate(self, chat_id: int) -> bool:
+        """
+        Вернуть переписку из архива в Redis.
+        :param chat_id: индефикатор чата в Telegram.
+        :return: была ли переписка в архиве.
+        """
+        if self.archive is None:
+            return False
+        started: float = time.perf_counter()
+        conversation: ArchivedConversation | None = await asyncio.to_thread(self.archive.load, chat_id)
+        if conversation is None:
+            return False
+        # Переписку, возвращённую другим процессом или сброшенную после выгрузки, скрипт не трогает
+        await self._rehydrate(
+            keys=[*self.chat_keys(chat_id), self.ACTIVITY],
+            args=[
+                *self.touch_args(chat_id),
+                conversation.epoch,
+                conversation.head,
+                *conversation.records
+            ]
+        )
+        await asyncio.to_thread(self.archive.delete, chat_id)
+        self.history.invalidate(chat_id)
+        ARCHIVE_OPERATIONS.labels('rehydrated').inc()
+        ARCHIVE_TIME.labels('rehydrate').observe(time.perf_counter() - started)
+        return True
+
+    async def migrate(self, chat_id: int, start: int, tail: list[bytes]) -> None:
+        """
+        Перезаписать прочитанные записи старого формата JSON в двоичном формате.
+        Запрос к Redis делается, только если такие записи нашлись.
+        :param chat_id: индефикатор чата в Telegram.
+        :param start: сквозной номер первой прочитанной записи.
+        :param tail: прочитанные записи.
+        :return:
+        """
+        args: list[int | bytes] = []
+        for index, data in enumerate(tail, start):
+            if is_legacy(data):
+                args += [index, data, encode_message(decode_message(data))]
+        if args:
+            await self._migrate(keys=self.chat_keys(chat_id), args=args)
+
+    def turn_keys(self, chat_id: int) -> list[str]:
+        """
+        Ключи входящих сообщений и блокировки хода чата.
+        :param chat_id: индефикатор чата в Telegram.
+        :return: ключи в Redis.
+        """
+        return [self.INBOX_PATTERN.format(chat_id=chat_id), self.LOCK_PATTERN.format(chat_id=chat_id)]
+
+    async def enqueue_message(self, chat_id: int, text: str, token: str, ttl: int) -> bool:
+        """
+        Положить сообщение пользователя во входящие и попытаться занять ход чата.
+        :param chat_id: индефикатор чата в Telegram.
+        :param text: текст сообщения.
+        :param token: токен владельца хода.
+        :param ttl: время жизни блокировки в миллисекундах.
+        :return: занят ли ход этим владельцем.
+        """
+        return bool(await self._enqueue(keys=self.turn_keys(chat_id), args=[text, token, ttl]))
+
+    async def take_messages(self, chat_id: int) -> list[str]:
+        """
+        Забрать все входящие сообщения чата в порядке поступления.
+        :param chat_id: индефикатор чата в Telegram.
+        :return: тексты сообщений.
+        """
+        return await self._take(keys=self.turn_keys(chat_id))
+
+    async def release_turn(self, chat_id: int, token: str, force: bool = False) -> bool:
+        """
+        Освободить ход чата.
+        Если во входящих появились сообщения, то ход не освобождается,
+        и владелец должен обработать их сам.
+        :param chat_id: индефикатор чата в Telegram.
+        :param token: токен владельца хода.
+        :param force: освободить ход даже при непустых входящих.
+        :return: освобождён ли ход или он уже не принадлежит владельцу.
+        """
+        return bool(await self._release(keys=self.turn_keys(chat_id), args=[token, int(force)]))
+
+    async def refresh_turn(self, chat_id: int, token: str, ttl: int) -> bool:
+        """
+        Продлить блокировку хода чата.
+        :param chat_id: индефикатор чата в Telegram.
+        :param token: токен владельца хода.
+        :param ttl: время жизни блокировки в миллисекундах.
+        :return: принадлежит ли ход владельцу.
+        """
+        return bool(await self._refresh(keys=self.turn_keys(chat_id)[1:], args=[token, ttl]))
+
+    async def take_rate_token(self, user_id: int, rate: float, burst: int) -> float:
+        """
+        Взять токен из корзины пользователя.
+        Корзина общая для всех процессов бота и пополняется с заданной скоростью.
+        :param user_id: индефикатор пользователя в Telegram.
+        :param rate: скорость пополнения в сообщениях в секунду.
+        :param burst: ёмкость корзины.
+        :return: 0, если токен взят, иначе сколько секунд ждать следующего.
+        """
+        wait: int = await self._rate_limit(
+            keys=[self.RATE_PATTERN.format(user_id=user_id)],
+            args=[rate, burst, int(time.time() * 1000)]
+        )
+        return wait / 1000
+
+    async def get_response(self, digest: str) -> tuple[str, float] | None:
+        """
+        Получить сохранённый ответ модели на промпт.
+        :param digest: хэш промпта и параметров генерации.
+        :return: текст ответа и время, которое заняла его генерация, или None.
+        """
+        values: list[str | None] = await self.cache.hmget(
+            self.RESPONSE_PATTERN.format(digest=digest),
+            ['text', 'seconds']
+        )
+        if values[0] is None:
+            return None
+        return values[0], float(values[1] or 0)
+
+    async def put_response(
+        self,
+        digest: str,
+        text: str,
+        seconds: float,
+        ttl: int,
+        max_entries: int
+    ) -> None:
+        """
+        Сохранить ответ модели на промпт.
+        Сверх `max_entries` ответов вытесняются самые старые.
+        :param digest: хэш промпта и параметров генерации.
+        :param text: текст ответа.
+        :param seconds: время генерации ответа.
+        :param ttl: время жизни ответа в секундах.
+        :param max_entries: предельное число сохранённых ответов.
+        :return:
+        """
+        await self._put_response(
+            keys=[self.RESPONSE_PATTERN.format(digest=digest), self.RESPONSE_INDEX],
+            args=[text, seconds, ttl, max_entries, int(time.time() * 1000)]
+        )
+
+    def tokens_key(self, version: str, text: str) -> str:
+        """
+        Ключ токенов текста сообщения.
+        Ключ зависит от версии токенизатора и самого текста, поэтому смена
+        токенизатора или шаблона промпта не подхватит устаревшие токены.
+        :param version: версия токенизатора.
+        :param text: текст сообщения по шаблону промпта.
+        :return: ключ в Redis.
+        """
+        digest: str = hashlib.sha1(text.encode()).hexdigest()
+        return self.TOKENS_PATTERN.format(version=version, digest=digest)
+
+    async def get_token_ids(self, version: str, texts: list[str]) -> list[list[int] | None]:
+        """
+        Получить сохранённые токены сообщений одним запросом.
+        :param version: версия токенизатора.
+        :param texts: тексты сообщений по шаблону промпта.
+        :return: токены каждого сообщения или None, если их нет в кэше.
+        """
+        values: list[str | None] = await self.cache.mget([self.tokens_key(version, text) for text in texts])
         return [
-            Message.model_validate_json(message)
-            for message in messages
+            None if value is None else [int(token) for token in value.split(',') if token]
+            for value in values
         ]
 
+    async def put_token_ids(self, version: str, tokens: dict[str, list[int]]) -> None:
+        """
+        Сохранить токены сообщений одним запросом.
+        :param version: версия токенизатора.
+        :param tokens: токены по текстам сообщений.
+        :return:
+        """
+        async with self.cache.pipeline(transaction=False) as pipe:
+            for text, ids in tokens.items():
+                pipe.set(self.tokens_key(version, text), ','.join(map(str, ids)), ex=TOKENS_TTL)
+            await pipe.execute()
+
     async def metric_depth_correspondence(self, chat_id: int) -> int:
         """
         Получить глубину переписки
@@ -86,6 +768,26 @@ class ConversationCache(metaclass=Singleton):
         """
         return await self.cache.llen(self.KEY_PATTERN.format(chat_id=chat_id))
 
+    async def metric_depths(self, batch: int = METRIC_SCAN_BATCH) -> list[int]:
+        """
+        Получить глубину всех переписок пачками.
+        Чаты перебираются через HSCAN, а глубины каждой пачки читаются
+        одним конвейером, поэтому число запросов растёт с числом пачек, а не чатов.
+        :param batch: размер пачки чатов.
+        :return: глубины переписок.
+        """
+        depths: list[int] = []
+        cursor: int = 0
+        while True:
+            cursor, chats = await self.cache.hscan(self.USER_CHAT, cursor, count=batch)
+            if chats:
+                async with self.cache.pipeline(transaction=False) as pipe:
+                    for chat_id in chats:
+                        pipe.llen(self.KEY_PATTERN.format(chat_id=chat_id))
+                    depths += await pipe.execute()
+            if not cursor:
+                return depths
+
     async def metric_chat_counts(self) -> int:
         """
         Получить количество текущих чатов
@@ -0,0 +1,84 @@
+import os
+from typing import Final
+
+from hpc_bot.model.conversion import Message, Role
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - сжатие необязательно
+    zstandard = None  # type: ignore[assignment]
+
+COMPRESS_THRESHOLD: Final[int] = int(os.environ.get('COMPRESS_THRESHOLD', 1024))
+COMPRESS_LEVEL: Final[int] = int(os.environ.get('COMPRESS_LEVEL', 3))
+
+# Первый байт записи: код роли в младших битах и флаг сжатия содержимого
+ROLE_CODES: Final[dict[Role, int]] = {Role.SYSTEM: 1, Role.USER: 2, Role.BOT: 3}
+CODE_ROLES: Final[dict[int, Role]] = {code: role for role, code in ROLE_CODES.items()}
+COMPRESSED: Final[int] = 0x80
+# Старые записи хранились в JSON и всегда начинаются с фигурной скобки
+LEGACY_PREFIX: Final[int] = ord('{')
+
+MESSAGE_FIELDS: Final[set[str]] = set(Message.model_fields)
+
+_COMPRESSOR = zstandard.ZstdCompressor(level=COMPRESS_LEVEL) if zstandard is not None else None
+_DECOMPRESSOR = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+
+def encode_message(message: Message) -> bytes:
+    """
+    Упаковать сообщение: байт роли и содержимое в UTF-8.
+    Длинное содержимое сжимается zstd, если библиотека установлена.
+    :param message: сообщение пользователя или бота.
+    :return: запись для Redis.
+    """
+    tag: int = ROLE_CODES[message.role]
+    content: bytes = message.content.encode()
+    if _COMPRESSOR is not None and len(content) > COMPRESS_THRESHOLD:
+        compressed: bytes = _COMPRESSOR.compress(content)
+        if len(compressed) < len(content):
+            return bytes((tag | COMPRESSED,)) + compressed
+    return bytes((tag,)) + content
+
+
+def is_legacy(data: bytes) -> bool:
+    """
+    Проверить, что запись хранится в старом формате JSON.
+    :param data: запись из Redis.
+    :return:
+    """
+    return data[0] == LEGACY_PREFIX
+
+
+def decode_message(data: bytes) -> Message:
+    """
+    Распаковать сообщение.
+    Записи собственного формата собираются без полной валидации pydantic,
+    старые записи в JSON проверяются как раньше.
+    :param data: запись из Redis.
+    :return: сообщение пользователя или бота.
+    """
+    tag: int = data[0]
+    if tag == LEGACY_PREFIX:
+        return Message.model_validate_json(data)
+    content: bytes = data[1:]
+    if tag & COMPRESSED:
+        if _DECOMPRESSOR is None:
+            raise RuntimeError('Для чтения сжатых сообщений нужен пакет zstandard')
+        content = _DECOMPRESSOR.decompress(content)
+    return build_message(CODE_ROLES[tag & ~COMPRESSED], content.decode())
+
+
+def build_message(role: Role, content: str) -> Message:
+    """
+    Собрать сообщение из заведомо корректных полей без валидации.
+    Быстрее `Message.model_construct`, так как не перебирает поля модели.
+    :param role: роль автора.
+    :param content: текст сообщения.
+    :return: сообщение.
+    """
+    message: Message = Message.__new__(Message)
+    object.__setattr__(message, '__dict__', {'role': role, 'content': content})
+    object.__setattr__(message, '__pydantic_fields_set__', MESSAGE_FIELDS)
+    object.__setattr__(message, '__pydantic_extra__', None)
+    object.__setattr__(message, '__pydantic_private__', None)
+    return message
@@ -1,49 +1,103 @@
 import logging
+import math
 from typing import Final
 
-import torch
 from aiogram import Router
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 
-from hpc_bot.exceptions import NoExistChatError
+from hpc_bot.exceptions import (
+    BusyError,
+    ContextOverflowError,
+    NoExistChatError,
+    RateLimitError,
+    TooLongMessageError,
+    WarmingUpError,
+)
+from hpc_bot.model.backend import OUT_OF_MEMORY
 from hpc_bot.telegram.manager import ModelManager
 from hpc_bot.telegram.messages import (
+    BUSY_TEXT,
     CONFUSED_TEXT,
     NO_EXIST_CHAT_TEXT,
     NO_STATE_TEXT,
     OUT_MEMORY_ERROR_TEXT,
+    RATE_LIMIT_TEXT,
     TO_HARD_TEXT,
+    TOO_LONG_TEXT,
+    WARMING_UP_TEXT,
 )
+from hpc_bot.telegram.streaming import STREAM_ANSWERS, stream_answer
 
 _LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
 
 common_router: Router = Router(name='common_router')
 
 
+async def answer_error(message: Message, error: Exception) -> None:
+    """
+    Ответить пользователю на ошибку обработки хода.
+    :param message: сообщение от пользователя.
+    :param error: ошибка обработки.
+    :return:
+    """
+    if isinstance(error, RateLimitError):
+        await message.answer(RATE_LIMIT_TEXT.format(seconds=math.ceil(error.retry_after)))
+    elif isinstance(error, BusyError):
+        await message.answer(BUSY_TEXT.format(position=error.position))
+    elif isinstance(error, OUT_OF_MEMORY + (ContextOverflowError,)):
+        await message.answer(OUT_MEMORY_ERROR_TEXT)
+    elif isinstance(error, TooLongMessageError):
+        await message.answer(TOO_LONG_TEXT)
+    elif isinstance(error, WarmingUpError):
+        await message.answer(WARMING_UP_TEXT)
+    elif isinstance(error, RuntimeError):
+        await message.answer(TO_HARD_TEXT)
+    elif isinstance(error, NoExistChatError):
+        await message.answer(NO_EXIST_CHAT_TEXT)
+    else:
+        await message.answer(CONFUSED_TEXT)
+        _LOGGER.exception(error)
+
+
 @common_router.message()
 async def conversation_handler(message: Message, manager: ModelManager, state: FSMContext) -> None:
     """
     Задать вопрос LLM модели.
+    Сообщения, пришедшие пока модель отвечает в этом чате, получают один общий ответ.
+    Частота проверяется для хода, а не для сообщения, поэтому склеенные сообщения
+    считаются одним запросом. Слишком частые ходы и ходы сверх очереди к модели
+    отклоняются сразу.
     :param message: сообщение от пользователя.
     :param manager: менеджер управления инференсом модели.
     :param state: состояние конечного автомата пользователя.
     :return:
     """
-    state: str = await state.get_state()
-    if not state:
+    mode: str | None = await state.get_state()
+    if not mode:
         await message.answer(NO_STATE_TEXT)
         return
+    if message.text is None:
+        # Стикеры, фото и прочие сообщения без текста модель не читает
+        await message.answer(CONFUSED_TEXT)
+        return
+
+    # Сообщения каналов приходят без отправителя, тогда частота считается для чата
+    user_id: int = message.from_user.id if message.from_user is not None else message.chat.id
+
+    async def reply(text: str) -> None:
+        try:
+            await manager.check_rate(user_id)
+            async with manager.admit(user_id, text):
+                if STREAM_ANSWERS:
+                    await stream_answer(message, manager.answer_stream(message.chat.id, text, mode))
+                else:
+                    model_answer: str = await manager.answer(message.chat.id, text, mode)
+                    await message.answer(model_answer)
+        except Exception as e:
+            await answer_error(message, e)
 
     try:
-        model_answer: str = await manager.answer(message.chat.id, message.text, state)
-        await message.answer(model_answer)
-    except torch.cuda.OutOfMemoryError:
-        await message.answer(OUT_MEMORY_ERROR_TEXT)
-    except RuntimeError:
-        await message.answer(TO_HARD_TEXT)
-    except NoExistChatError:
-        await message.answer(NO_EXIST_CHAT_TEXT)
+        await manager.serialize(message.chat.id, message.text, reply)
     except Exception as e:
-        await message.answer(CONFUSED_TEXT)
-        _LOGGER.exception(e)
+        await answer_error(message, e)
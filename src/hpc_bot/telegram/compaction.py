@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Final
+
+from hpc_bot.exceptions import TooLongMessageError
+from hpc_bot.metrics import COMPACTION_SAVED_TOKENS, COMPACTION_TIME, COMPACTIONS
+from hpc_bot.model.batching import BatchScheduler
+from hpc_bot.model.budget import ContextBudget
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.executor import InferenceExecutor
+from hpc_bot.model.jobs import RemoteInference
+from hpc_bot.model.loader import ModelLoader
+from hpc_bot.telegram.admission import AdmissionController
+from hpc_bot.telegram.cache import ConversationCache
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+COMPACTION_TOKENS: Final[int] = int(os.environ.get('COMPACTION_TOKENS', 0))
+COMPACTION_KEEP: Final[int] = int(os.environ.get('COMPACTION_KEEP', 4))
+COMPACTION_IDLE_POLL: Final[float] = float(os.environ.get('COMPACTION_IDLE_POLL', 1))
+COMPACTION_MAX_DEFER: Final[float] = float(os.environ.get('COMPACTION_MAX_DEFER', 60))
+COMPACTION_PROMPT: Final[str] = (
+    "Ты пересказываешь переписку пользователя с ассистентом. Сохрани факты, имена, "
+    "числа, договорённости и открытые вопросы. Пиши кратко, без вступлений."
+)
+MEMORY_TEMPLATE: Final[str] = "Краткое содержание предыдущей переписки:\n{summary}"
+ROLE_NAMES: Final[dict[Role, str]] = {
+    Role.SYSTEM: 'Контекст',
+    Role.USER: 'Пользователь',
+    Role.BOT: 'Ассистент',
+}
+
+
+class HistoryCompactor:
+    """
+    Фоновое сжатие истории чатов пересказом.
+    Когда история чата превышает `threshold` токенов, чат ставится в очередь.
+    Очередь разбирается по одному чату, пока модель свободна, но не дольше
+    `max_defer` секунд ожидания, чтобы при постоянной нагрузке сжатие не
+    откладывалось бесконечно. Старые сообщения, кроме последних `keep`,
+    пересказываются моделью, и пересказ заменяет их в кэше переписок одним
+    системным сообщением. С бюджетом контекста `budget` за раз пересказывается
+    только начало истории, которое помещается в контекст модели, а остаток
+    сжимается следующими проходами. Следующее сжатие пересказывает и предыдущий
+    пересказ, поэтому длина промпта остаётся ограниченной, а старый контекст
+    не теряется целиком, как при вытеснении.
+    """
+
+    __slots__ = (
+        '_inference',
+        '_cache',
+        '_count_tokens',
+        '_threshold',
+        '_keep',
+        '_admission',
+        '_loader',
+        '_poll',
+        '_budget',
+        '_max_defer',
+        '_queue',
+        '_queued',
+        '_task'
+    )
+
+    def __init__(
+        self,
+        inference: InferenceExecutor | BatchScheduler | RemoteInference,
+        cache: ConversationCache,
+        count_tokens: Callable[[str], int],
+        threshold: int = COMPACTION_TOKENS,
+        keep: int = COMPACTION_KEEP,
+        admission: AdmissionController | None = None,
+        loader: ModelLoader | None = None,
+        poll: float = COMPACTION_IDLE_POLL,
+        budget: ContextBudget | None = None,
+        max_defer: float = COMPACTION_MAX_DEFER
+    ) -> None:
+        self._inference: InferenceExecutor | BatchScheduler | RemoteInference = inference
+        self._cache: ConversationCache = cache
+        self._count_tokens: Callable[[str], int] = count_tokens
+        self._threshold: int = threshold
+        self._keep: int = keep
+        self._admission: AdmissionController | None = admission
+        self._loader: ModelLoader | None = loader
+        self._poll: float = poll
+        self._budget: ContextBudget | None = budget
+        self._max_defer: float = max_defer
+        self._queue: asyncio.Queue[int] = asyncio.Queue()
+        self._queued: set[int] = set()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def ready(self) -> bool:
+        """
+        Загружена ли модель.
+        :param:
+        :return:
+        """
+        return self._loader is None or self._loader.ready
+
+    @property
+    def idle(self) -> bool:
+        """
+        Готова ли модель и нет ли ходов пользователей.
+        :param:
+        :return:
+        """
+        return self.ready and (self._admission is None or self._admission.idle)
+
+    def observe(self, conversation: Conversation) -> None:
+        """
+        Поставить чат в очередь на сжатие, если его история стала слишком длинной.
+        Токены уже посчитанных сообщений переписки повторно не считаются.
+        :param conversation: переписка хода, начинающаяся с системного сообщения.
+        :return:
+        """
+        chat_id: int | None = conversation.chat_id
+        if chat_id is None or chat_id in self._queued:
+            return
+        # Системное сообщение в кэше переписок не хранится и не сжимается
+        if sum(conversation.count_tokens(self._count_tokens)[1:]) <= self._threshold:
+            return
+        self._queued.add(chat_id)
+        self._queue.put_nowait(chat_id)
+
+    def start(self) -> asyncio.Task:
+        """
+        Запустить разбор очереди в фоне.
+        :param:
+        :return: задача разбора очереди.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self) -> None:
+        """
+        Сжимать чаты из очереди по одному, дожидаясь простоя модели.
+        Простоя ждут не дольше `max_defer` секунд, загрузки модели - без ограничения.
+        :param:
+        :return:
+        """
+        while True:
+            chat_id: int = await self._queue.get()
+            deadline: float = time.monotonic() + self._max_defer
+            while not self.ready or (not self.idle and time.monotonic() < deadline):
+                await asyncio.sleep(self._poll)
+            try:
+                await self.compact(chat_id)
+            except Exception as e:
+                _LOGGER.exception(e)
+                COMPACTIONS.labels('failed').inc()
+            finally:
+                self._queued.discard(chat_id)
+
+    async def compact(self, chat_id: int) -> bool:
+        """
+        Пересказать старые сообщения чата и заменить их пересказом.
+        :param chat_id: индефикатор чата.
+        :return: заменена ли история.
+        """
+        epoch, head, history = await self._cache.snapshot(chat_id)
+        count: int = len(history) - self._keep
+        if count < 2:
+            return False
+        tokens: list[int] = Conversation(messages=history).count_tokens(self._count_tokens)
+        if sum(tokens) <= self._threshold:
+            return False
+
+        count = self._fit(history, count)
+        if count < 2:
+            COMPACTIONS.labels('oversized').inc()
+            return False
+
+        request: Conversation = self._request(history[:count])
+        started: float = time.perf_counter()
+        summary: str = await self._inference(request)
+        COMPACTION_TIME.observe(time.perf_counter() - started)
+
+        summary = summary.strip()
+        memory: Message = Message(role=Role.SYSTEM, content=MEMORY_TEMPLATE.format(summary=summary))
+        memory_tokens: int = Conversation(messages=[memory]).count_tokens(self._count_tokens)[0]
+        saved: int = sum(tokens[:count]) - memory_tokens
+        if not summary or saved <= 0:
+            COMPACTIONS.labels('useless').inc()
+            return False
+        if not await self._cache.compact_conversation(chat_id, epoch, head, count, memory):
+            # Пока шёл пересказ, в чате начался ход или история изменилась
+            COMPACTIONS.labels('stale').inc()
+            return False
+
+        await self._inference.invalidate(chat_id)
+        COMPACTIONS.labels('done').inc()
+        COMPACTION_SAVED_TOKENS.inc(saved)
+        _LOGGER.info(f"История чата {chat_id} сжата: {count} сообщений, сэкономлено {saved} токенов")
+        return True
+
+    def _request(self, messages: list[Message]) -> Conversation:
+        """
+        Собрать запрос пересказа сообщений.
+        :param messages: пересказываемые сообщения.
+        :return: переписка с просьбой пересказать сообщения.
+        """
+        transcript: str = '\n'.join(
+            f'{ROLE_NAMES[message.role]}: {message.content}'
+            for message in messages
+        )
+        request: Conversation = Conversation(system_prompt=COMPACTION_PROMPT, mode='compaction')
+        request.append(Message(role=Role.USER, content=transcript))
+        return request
+
+    def _fit(self, history: list[Message], count: int) -> int:
+        """
+        Посчитать, сколько первых сообщений поместится в один запрос пересказа.
+        Сначала число оценивается по сумме токенов строк пересказа, затем
+        запрос проверяется бюджетом контекста и при переполнении укорачивается.
+        :param history: история чата.
+        :param count: сколько сообщений нужно пересказать.
+        :return: сколько сообщений пересказать за этот проход.
+        """
+        if self._budget is None:
+            return count
+        available: int = self._budget.limit - self._count_tokens(self._request([]).get_prompt())
+        fit: int = 0
+        for message in history[:count]:
+            available -= self._count_tokens(f'{ROLE_NAMES[message.role]}: {message.content}\n')
+            if available < 0:
+                break
+            fit += 1
+        while fit >= 2:
+            try:
+                self._budget.plan(self._request(history[:fit]))
+                return fit
+            except TooLongMessageError:
+                fit -= 1
+        return fit
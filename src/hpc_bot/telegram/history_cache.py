@@ -0,0 +1,177 @@
+import os
+from collections import OrderedDict
+from typing import Final, NamedTuple
+
+from hpc_bot.metrics import (
+    HISTORY_CACHE_BYTES_SAVED,
+    HISTORY_CACHE_HITS,
+    HISTORY_CACHE_MISSES,
+)
+from hpc_bot.model.conversion import Message
+from hpc_bot.telegram.codec import decode_message
+
+HISTORY_CACHE_BYTES: Final[int] = int(os.environ.get('HISTORY_CACHE_BYTES', 64 * 1024 ** 2))
+
+
+class HistoryEntry(NamedTuple):
+    """
+    Сохранённая в процессе история чата.
+    `head` - сквозной номер первого сообщения в списке Redis, `epoch` - номер
+    поколения списка, который меняется при любом изменении кроме дописывания
+    в конец и выбрасывания из начала.
+    """
+    epoch: int
+    head: int
+    messages: list[Message]
+    sizes: list[int]
+    nbytes: int
+
+    @property
+    def end(self) -> int:
+        """
+        Сквозной номер сообщения, следующего за последним сохранённым.
+        :param:
+        :return:
+        """
+        return self.head + len(self.messages)
+
+
+class HistoryCache:
+    """
+    Кэш историй чатов в памяти процесса перед Redis.
+    Согласованность между процессами бота держится на номере поколения
+    и сквозных номерах сообщений чата, которые хранятся в Redis: при
+    совпадении поколения из Redis догружается только новый хвост.
+    Вытеснение LRU в рамках бюджета памяти.
+    """
+
+    __slots__ = (
+        '_budget',
+        '_entries',
+        '_size'
+    )
+
+    def __init__(self, budget: int = HISTORY_CACHE_BYTES) -> None:
+        self._budget: int = budget
+        self._entries: OrderedDict[int, HistoryEntry] = OrderedDict()
+        self._size: int = 0
+
+    def __len__(self) -> int:
+        """
+        Количество чатов с сохранённой историей.
+        :param:
+        :return:
+        """
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        """
+        Объём записей сохранённых сообщений в байтах.
+        :param:
+        :return:
+        """
+        return self._size
+
+    def get(self, chat_id: int) -> HistoryEntry | None:
+        """
+        Получить сохранённую историю чата.
+        :param chat_id: индефикатор чата.
+        :return: история или None, если её нет.
+        """
+        entry: HistoryEntry | None = self._entries.get(chat_id)
+        if entry is not None:
+            self._entries.move_to_end(chat_id)
+        return entry
+
+    def merge(
+        self,
+        chat_id: int,
+        epoch: int,
+        head: int,
+        start: int,
+        tail: list[bytes]
+    ) -> list[Message]:
+        """
+        Собрать историю чата из сохранённой части и хвоста, прочитанного из Redis.
+        :param chat_id: индефикатор чата.
+        :param epoch: поколение списка в Redis.
+        :param head: сквозной номер первого сообщения списка в Redis.
+        :param start: сквозной номер первого сообщения хвоста.
+        :param tail: записи сообщений хвоста.
+        :return: вся история чата.
+        """
+        entry: HistoryEntry | None = self._entries.get(chat_id)
+        messages: list[Message] = [decode_message(message) for message in tail]
+        sizes: list[int] = [len(message) for message in tail]
+        if entry is not None and entry.epoch == epoch and entry.end == start and head >= entry.head:
+            HISTORY_CACHE_HITS.inc()
+            skip: int = head - entry.head
+            HISTORY_CACHE_BYTES_SAVED.inc(sum(entry.sizes[skip:]))
+            messages = entry.messages[skip:] + messages
+            sizes = entry.sizes[skip:] + sizes
+        else:
+            HISTORY_CACHE_MISSES.inc()
+        self._put(chat_id, HistoryEntry(epoch, head, messages, sizes, sum(sizes)))
+        return list(messages)
+
+    def append(self, chat_id: int, message: Message, size: int, length: int) -> None:
+        """
+        Дописать сообщение в сохранённую историю вслед за записью в Redis.
+        Если длина списка в Redis не совпала с ожидаемой, то в чат писал
+        другой процесс и история выбрасывается.
+        :param chat_id: индефикатор чата.
+        :param message: записанное сообщение.
+        :param size: размер записи сообщения в байтах.
+        :param length: длина списка в Redis после записи.
+        :return:
+        """
+        entry: HistoryEntry | None = self._entries.get(chat_id)
+        if entry is None:
+            return
+        if len(entry.messages) + 1 != length:
+            self.invalidate(chat_id)
+            return
+        self._put(chat_id, entry._replace(
+            messages=entry.messages + [message],
+            sizes=entry.sizes + [size],
+            nbytes=entry.nbytes + size
+        ))
+
+    def trim(self, chat_id: int, count: int) -> None:
+        """
+        Выбросить первые сообщения из сохранённой истории вслед за Redis.
+        :param chat_id: индефикатор чата.
+        :param count: количество сообщений.
+        :return:
+        """
+        entry: HistoryEntry | None = self._entries.get(chat_id)
+        if entry is None or not count:
+            return
+        count = min(count, len(entry.messages))
+        self._put(chat_id, entry._replace(
+            head=entry.head + count,
+            messages=entry.messages[count:],
+            sizes=entry.sizes[count:],
+            nbytes=entry.nbytes - sum(entry.sizes[:count])
+        ))
+
+    def invalidate(self, chat_id: int) -> None:
+        """
+        Выбросить историю чата.
+        :param chat_id: индефикатор чата.
+        :return:
+        """
+        entry: HistoryEntry | None = self._entries.pop(chat_id, None)
+        if entry is not None:
+            self._size -= entry.nbytes
+
+    def _put(self, chat_id: int, entry: HistoryEntry) -> None:
+        self.invalidate(chat_id)
+        if entry.nbytes > self._budget:
+            return
+        self._entries[chat_id] = entry
+        self._size += entry.nbytes
+        while self._size > self._budget:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.nbytes
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Final
+
+from hpc_bot.telegram.cache import ConversationCache
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+ARCHIVE_IDLE: Final[int] = int(os.environ.get('ARCHIVE_IDLE', 24 * 60 * 60))
+ARCHIVE_INTERVAL: Final[float] = float(os.environ.get('ARCHIVE_INTERVAL', 60))
+ARCHIVE_BATCH: Final[int] = int(os.environ.get('ARCHIVE_BATCH', 100))
+
+
+class ConversationArchiver:
+    """
+    Фоновая выгрузка холодных переписок из Redis в архив на диске.
+    Раз в `interval` секунд переписки чатов, к которым не обращались
+    дольше `idle` секунд, выгружаются пачками по `batch` чатов. В Redis
+    остаются только активные переписки, а выгруженная возвращается
+    из архива при следующем обращении к чату. При запуске чатам, созданным
+    до учёта обращений, ставится отметка обращения, чтобы они тоже выгружались.
+    """
+
+    __slots__ = (
+        '_cache',
+        '_idle',
+        '_interval',
+        '_batch',
+        '_task'
+    )
+
+    def __init__(
+        self,
+        cache: ConversationCache,
+        idle: int = ARCHIVE_IDLE,
+        interval: float = ARCHIVE_INTERVAL,
+        batch: int = ARCHIVE_BATCH
+    ) -> None:
+        self._cache: ConversationCache = cache
+        self._idle: int = idle
+        self._interval: float = interval
+        self._batch: int = batch
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> asyncio.Task:
+        """
+        Запустить выгрузку в фоне.
+        :param:
+        :return: задача выгрузки.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self) -> None:
+        """
+        Выгружать холодные переписки, пока процесс не остановят.
+        :param:
+        :return:
+        """
+        try:
+            added: int = await self._cache.backfill_activity()
+            if added:
+                _LOGGER.info(f"Отмечено обращение к {added} чатам, созданным до учёта обращений")
+        except Exception as e:
+            _LOGGER.exception(e)
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                _LOGGER.exception(e)
+            await asyncio.sleep(self._interval)
+
+    async def sweep(self) -> int:
+        """
+        Выгрузить все переписки, простаивающие дольше `idle` секунд.
+        :param:
+        :return: количество выгруженных переписок.
+        """
+        before: int = int((time.time() - self._idle) * 1000)
+        demoted: int = 0
+        while True:
+            chats: list[int] = await self._cache.idle_chats(before, self._batch)
+            batch: int = 0
+            for chat_id in chats:
+                batch += await self._cache.demote(chat_id)
+            demoted += batch
+            # Чаты с идущим ходом остаются в выборке, поэтому пачка без выгрузок завершает проход
+            if len(chats) < self._batch or not batch:
+                return demoted
@@ -1,13 +1,29 @@
+import contextlib
 import gc
 import logging
-from typing import Final
+import time
+from typing import AsyncContextManager, AsyncIterator, Awaitable, Callable, Final
 
 import torch
 
-from hpc_bot.exceptions import ExistChatError, NoExistChatError
+from hpc_bot.exceptions import (
+    ContextOverflowError,
+    ExistChatError,
+    NoExistChatError,
+)
+from hpc_bot.model.backend import OUT_OF_MEMORY
+from hpc_bot.model.batching import BatchScheduler
+from hpc_bot.model.budget import ContextBudget
 from hpc_bot.model.conversion import DEFAULT_SYSTEM_PROMPT, Conversation, Message, Role
-from hpc_bot.model.inference import ModelInference
+from hpc_bot.model.encoder import PromptEncoder
+from hpc_bot.model.executor import InferenceExecutor
+from hpc_bot.model.jobs import RemoteInference
+from hpc_bot.model.loader import ModelLoader
+from hpc_bot.telegram.admission import ADMISSION_COST_CHARS, AdmissionController
 from hpc_bot.telegram.cache import ConversationCache
+from hpc_bot.telegram.compaction import HistoryCompactor
+from hpc_bot.telegram.response_cache import ResponseCache
+from hpc_bot.telegram.serializer import ChatSerializer
 
 _LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
 
@@ -19,16 +35,91 @@ class ModelManager:
 
     __slots__ = (
         '_inference',
-        '_cache'
+        '_cache',
+        '_budget',
+        '_encoder',
+        '_serializer',
+        '_admission',
+        '_loader',
+        '_responses',
+        '_compactor'
     )
 
     def __init__(
         self,
-        inference: ModelInference,
-        cache: ConversationCache
+        inference: InferenceExecutor | BatchScheduler | RemoteInference,
+        cache: ConversationCache,
+        budget: ContextBudget | None = None,
+        encoder: PromptEncoder | None = None,
+        serializer: ChatSerializer | None = None,
+        admission: AdmissionController | None = None,
+        loader: ModelLoader | None = None,
+        responses: ResponseCache | None = None,
+        compactor: HistoryCompactor | None = None
     ) -> None:
-        self._inference: ModelInference = inference
+        self._inference: InferenceExecutor | BatchScheduler | RemoteInference = inference
         self._cache: ConversationCache = cache
+        self._budget: ContextBudget | None = budget
+        self._encoder: PromptEncoder | None = encoder
+        self._serializer: ChatSerializer | None = serializer
+        self._admission: AdmissionController | None = admission
+        self._loader: ModelLoader | None = loader
+        self._responses: ResponseCache | None = responses
+        self._compactor: HistoryCompactor | None = compactor
+
+    @property
+    def inference(self) -> InferenceExecutor | BatchScheduler | RemoteInference:
+        """
+        Исполнитель инференса модели.
+        :param:
+        :return:
+        """
+        return self._inference
+
+    @property
+    def cache(self) -> ConversationCache:
+        """
+        Кэш переписок с моделью.
+        :param:
+        :return:
+        """
+        return self._cache
+
+    async def serialize(self, chat_id: int, message: str, handle: Callable[[str], Awaitable[None]]) -> None:
+        """
+        Обработать сообщение пользователя, не допуская параллельных ходов в одном чате.
+        Сообщения, пришедшие во время генерации, склеиваются в один следующий ход.
+        Без сериализатора ход обрабатывается сразу.
+        :param chat_id: индефикатор чата, для различия пользователей.
+        :param message: сообщение от пользователя.
+        :param handle: обработчик хода, получающий текст для модели.
+        :return:
+        """
+        if self._serializer is None:
+            await handle(message)
+        else:
+            await self._serializer.run(chat_id, message, handle)
+
+    async def check_rate(self, user_id: int) -> None:
+        """
+        Проверить частоту ходов пользователя до постановки в очередь к модели.
+        :param user_id: индефикатор пользователя.
+        :return:
+        """
+        if self._admission is not None:
+            await self._admission.check_rate(user_id)
+
+    def admit(self, user_id: int, message: str) -> AsyncContextManager[None]:
+        """
+        Дождаться допуска хода к модели.
+        При переполненной очереди сразу выбрасывается BusyError.
+        :param user_id: индефикатор пользователя.
+        :param message: текст хода, по длине которого считается его стоимость.
+        :return: контекст, на время которого ход занимает место у модели.
+        """
+        if self._admission is None:
+            return contextlib.nullcontext()
+        return self._admission.slot(user_id, cost=1 + len(message) / ADMISSION_COST_CHARS)
 
     @property
     def start_message(self) -> Message:
@@ -60,14 +151,15 @@ class ModelManager:
     ) -> None:
         """
         Вытеснять первые сообщения из списка переписки.
+        В кэше сообщения выбрасываются вместе с записью ответа бота.
         :param conversation: объект переписки.
         :param chat_id: индефикатор чата к которому относится переписка.
         :param max_size: предельное число символов.
                          Если не указывать, то будет выброшено только одно сообщение.
         """
+        await self._inference.invalidate(chat_id)
         max_size = max_size or (conversation.size - 1)
         while conversation.size > max_size and len(conversation) > 1:
-            await self._cache.pop_first_message(chat_id)
             conversation.pop_first_message()
 
         if len(conversation) < 2:
@@ -96,9 +188,9 @@ class ModelManager:
         """
         while True:
             try:
-                output: str = self._inference(conversation)
+                output: str = await self._inference(conversation)
                 break
-            except torch.cuda.OutOfMemoryError:
+            except OUT_OF_MEMORY:
                 _LOGGER.warning(
                     f"Закончилась память, длина контекста - {conversation.size}, чат - {chat_id}"
                 )
@@ -119,8 +211,8 @@ class ModelManager:
         :return: ответ модели.
         """
         try:
-            output: str = self._inference(conversation)
-        except torch.cuda.OutOfMemoryError as e:
+            output: str = await self._inference(conversation)
+        except OUT_OF_MEMORY as e:
             _LOGGER.warning(
                 f"Закончилась память, длина контекста - {conversation.size}, чат - {chat_id}"
             )
@@ -133,37 +225,163 @@ class ModelManager:
 
         return output
 
+    async def prepare_conversation(self, chat_id: int, message: str, state: str) -> Conversation:
+        """
+        Собрать переписку из истории чата и нового сообщения пользователя.
+        Пока модель загружается, запрос ждёт её или сразу отклоняется
+        с WarmingUpError, не оставляя следов в истории чата.
+        Проверка чата, чтение истории и запись сообщения пользователя
+        выполняются одним запросом к кэшу.
+        Если задан сборщик токенов, то токены промпта собираются из кэша.
+        Если задан бюджет контекста, то в режиме скользящего окна старые сообщения
+        выбрасываются заранее, а в линейном режиме переполнение
+        контекста сообщается до генерации.
+        :param chat_id: индефикатор чата, для различия пользователей.
+        :param message: сообщение от пользователя.
+        :param state: режим переписки пользователя.
+        :return: переписка с пользователем.
+        """
+        if self._loader is not None:
+            await self._loader.wait_ready()
+
+        user_message: Message = Message(role=Role.USER, content=message)
+        history: list[Message] | None = await self._cache.open_turn(chat_id, user_message)
+        if history is None:
+            raise NoExistChatError()
+
+        conversation: Conversation = Conversation(
+            messages=[self.start_message, *history, user_message],
+            chat_id=chat_id,
+            mode=state.removeprefix('UserMode:')
+        )
+
+        if self._budget is not None:
+            drop: int = self._budget.plan(conversation)
+            if drop and state == 'UserMode:inline':
+                await self._cache.pop_last_message(chat_id)
+                raise ContextOverflowError()
+            if drop:
+                await self._inference.invalidate(chat_id)
+                conversation.pop_first_messages(drop)
+
+        if self._encoder is not None:
+            conversation.token_ids = await self._encoder.encode(conversation)
+
+        return conversation
+
+    async def cached_answer(self, conversation: Conversation) -> str | None:
+        """
+        Найти готовый ответ на промпт переписки в кэше ответов.
+        :param conversation: переписка с пользователем.
+        :return: ответ модели или None.
+        """
+        if self._responses is None:
+            return None
+        return await self._responses.get(conversation)
+
+    async def remember_answer(self, conversation: Conversation, output: str, seconds: float) -> None:
+        """
+        Сохранить ответ модели в кэш ответов.
+        Ошибка кэша не мешает отдать ответ пользователю.
+        :param conversation: переписка с пользователем.
+        :param output: ответ модели.
+        :param seconds: время генерации ответа.
+        :return:
+        """
+        if self._responses is None:
+            return
+        try:
+            await self._responses.put(conversation, output, seconds)
+        except Exception as e:
+            _LOGGER.warning(f"Не удалось сохранить ответ в кэш: {e}")
+
+    async def close_turn(self, conversation: Conversation, chat_id: int, output: str) -> None:
+        """
+        Сохранить ответ модели в историю чата.
+        Если задано сжатие истории, то длинная история ставится в очередь на пересказ.
+        :param conversation: переписка хода.
+        :param chat_id: индефикатор чата, для различия пользователей.
+        :param output: ответ модели.
+        :return:
+        """
+        bot_message: Message = Message(role=Role.BOT, content=output)
+        await self._cache.close_turn(chat_id, bot_message, conversation.dropped)
+        if self._compactor is not None:
+            conversation.append(bot_message)
+            self._compactor.observe(conversation)
+
     async def answer(self, chat_id: int, message: str, state: str) -> str:
         """
         Получить ответ от модели.
+        Если задан кэш ответов, то ответ на уже встречавшийся промпт берётся из него.
         :param chat_id: индефикатор чата, для различия пользователей.
         :param message: сообщение от пользователя.
         :return: сообщение от модели.
         """
-        exist: bool = await self._cache.exist_chat(chat_id)
-        if not exist:
-            raise NoExistChatError()
+        conversation: Conversation = await self.prepare_conversation(chat_id, message, state)
 
-        messages: list[Message] = [self.start_message]
-        messages += await self._cache.get_correspondence(chat_id)
+        output: str | None = await self.cached_answer(conversation)
+        if output is None:
+            started: float = time.perf_counter()
+            if state == 'UserMode:window':
+                output = await self.slide_window_asnwer(conversation, chat_id)
+            elif state == 'UserMode:inline':
+                output = await self.inline_answer(conversation, chat_id)
+            else:
+                raise RuntimeError("Can't determine state")
+            await self.remember_answer(conversation, output, time.perf_counter() - started)
 
-        user_message: Message = Message(role=Role.USER, content=message)
-        messages.append(user_message)
-        await self._cache.put_message(chat_id, user_message)
+        await self.close_turn(conversation, chat_id, output)
 
-        conversation: Conversation = Conversation(messages=messages)
+        return output
 
-        if state == 'UserMode:window':
-            output: str = await self.slide_window_asnwer(conversation, chat_id)
-        elif state == 'UserMode:inline':
-            output: str = await self.inline_answer(conversation, chat_id)
-        else:
+    async def answer_stream(self, chat_id: int, message: str, state: str) -> AsyncIterator[str]:
+        """
+        Получать ответ от модели кусками по мере генерации.
+        В режиме скользящего окна при нехватке памяти до первого куска
+        старые сообщения вытесняются и генерация повторяется.
+        Итоговый ответ сохраняется в кэш после окончания генерации.
+        Ответ из кэша ответов отдаётся одним куском.
+        :param chat_id: индефикатор чата, для различия пользователей.
+        :param message: сообщение от пользователя.
+        :param state: режим переписки пользователя.
+        :return: куски ответа модели.
+        """
+        if state not in ('UserMode:window', 'UserMode:inline'):
             raise RuntimeError("Can't determine state")
 
-        bot_message: Message = Message(role=Role.BOT, content=output)
-        await self._cache.put_message(chat_id, bot_message)
+        conversation: Conversation = await self.prepare_conversation(chat_id, message, state)
 
-        return output
+        cached: str | None = await self.cached_answer(conversation)
+        if cached is not None:
+            yield cached
+            await self.close_turn(conversation, chat_id, cached)
+            return
+
+        started: float = time.perf_counter()
+        chunks: list[str] = []
+        while True:
+            try:
+                async for chunk in self._inference.stream(conversation):
+                    chunks.append(chunk)
+                    yield chunk
+                break
+            except OUT_OF_MEMORY as e:
+                _LOGGER.warning(
+                    f"Закончилась память, длина контекста - {conversation.size}, чат - {chat_id}"
+                )
+                if state != 'UserMode:window' or chunks:
+                    raise e
+                await self.compress_conversation(conversation, chat_id)
+            except Exception as e:
+                _LOGGER.exception(e)
+                raise e
+            finally:
+                self.clean_mem()
+
+        output: str = ''.join(chunks).strip()
+        await self.remember_answer(conversation, output, time.perf_counter() - started)
+        await self.close_turn(conversation, chat_id, output)
 
     async def reset_context(self, chat_id: int) -> None:
         """
@@ -172,3 +390,4 @@ class ModelManager:
         :return:
         """
         await self._cache.clear_conversion(chat_id)
+        await self._inference.invalidate(chat_id)
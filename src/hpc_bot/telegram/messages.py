@@ -23,3 +23,15 @@ CURRENT_STATE_TEXT: Final[str] = "Сейчас включен режим {state}
 OUT_MEMORY_ERROR_TEXT: Final[str] = "У меня закончилась память, больше не могу отвечать, выбери режим window или сбрось контекст"  # noqa
 
 NO_STATE_TEXT: Final[str] = "Не задан режим диалога, выбери один из режимов переписки"
+
+PLACEHOLDER_TEXT: Final[str] = "Думаю..."
+
+EMPTY_ANSWER_TEXT: Final[str] = "Мне нечего на это ответить, попробуй переформулировать вопрос"
+
+TOO_LONG_TEXT: Final[str] = "Сообщение слишком длинное, я не смогу его прочитать. Попробуй сократить его"
+
+BUSY_TEXT: Final[str] = "Сейчас слишком много запросов, твоё место в очереди было бы {position}. Попробуй чуть позже"  # noqa
+
+RATE_LIMIT_TEXT: Final[str] = "Слишком много сообщений подряд, подожди {seconds} с. и напиши снова"
+
+WARMING_UP_TEXT: Final[str] = "Я только что проснулся и ещё загружаюсь, напиши мне через минуту"
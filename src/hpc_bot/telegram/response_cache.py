@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import os
+from typing import Final
+
+from transformers import GenerationConfig
+
+from hpc_bot.metrics import (
+    RESPONSE_CACHE_HITS,
+    RESPONSE_CACHE_MISSES,
+    RESPONSE_CACHE_SAVED_SECONDS,
+)
+from hpc_bot.model.conversion import Conversation
+from hpc_bot.telegram.cache import ConversationCache
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+RESPONSE_CACHE: Final[bool] = os.environ.get('RESPONSE_CACHE', '0') == '1'
+RESPONSE_CACHE_TTL: Final[int] = int(os.environ.get('RESPONSE_CACHE_TTL', 24 * 60 * 60))
+RESPONSE_CACHE_ENTRIES: Final[int] = int(os.environ.get('RESPONSE_CACHE_ENTRIES', 10_000))
+RESPONSE_CACHE_MAX_CHARS: Final[int] = int(os.environ.get('RESPONSE_CACHE_MAX_CHARS', 4096))
+RESPONSE_CACHE_MAX_MESSAGES: Final[int] = int(os.environ.get('RESPONSE_CACHE_MAX_MESSAGES', 2))
+
+
+class ResponseCache:
+    """
+    Кэш ответов модели на побайтно совпадающие промпты.
+    Ключ строится из хэша промпта, модели и конфига генерации, поэтому смена
+    модели, бэкенда или параметров генерации не подхватит старые ответы.
+    Кэш работает только для детерминированной генерации без сэмплирования
+    и только для коротких переписок, в которых совпадения вероятны:
+    по умолчанию системный промпт и первое сообщение пользователя.
+    """
+
+    __slots__ = (
+        '_cache',
+        '_namespace',
+        '_enabled',
+        '_ttl',
+        '_max_entries',
+        '_max_chars',
+        '_max_messages'
+    )
+
+    def __init__(
+        self,
+        cache: ConversationCache,
+        model_id: str,
+        generation_config: GenerationConfig,
+        ttl: int = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_ENTRIES,
+        max_chars: int = RESPONSE_CACHE_MAX_CHARS,
+        max_messages: int = RESPONSE_CACHE_MAX_MESSAGES
+    ) -> None:
+        self._cache: ConversationCache = cache
+        self._namespace: str = hashlib.sha256(
+            (model_id + '\0' + generation_config.to_json_string(use_diff=False)).encode()
+        ).hexdigest()
+        self._enabled: bool = not generation_config.do_sample
+        if not self._enabled:
+            _LOGGER.warning("Генерация с сэмплированием, кэш ответов отключён")
+        self._ttl: int = ttl
+        self._max_entries: int = max_entries
+        self._max_chars: int = max_chars
+        self._max_messages: int = max_messages
+
+    def eligible(self, conversation: Conversation) -> bool:
+        """
+        Можно ли брать ответ на переписку из кэша.
+        :param conversation: переписка с пользователем.
+        :return:
+        """
+        return self._enabled and len(conversation) <= self._max_messages
+
+    def key(self, conversation: Conversation) -> str:
+        """
+        Хэш промпта переписки вместе с моделью и конфигом генерации.
+        :param conversation: переписка с пользователем.
+        :return: шестнадцатеричная строка.
+        """
+        return hashlib.sha256((self._namespace + conversation.get_prompt()).encode()).hexdigest()
+
+    async def get(self, conversation: Conversation) -> str | None:
+        """
+        Получить сохранённый ответ на промпт переписки.
+        :param conversation: переписка с пользователем.
+        :return: ответ модели или None.
+        """
+        if not self.eligible(conversation):
+            return None
+        stored: tuple[str, float] | None = await self._cache.get_response(self.key(conversation))
+        if stored is None:
+            RESPONSE_CACHE_MISSES.labels(conversation.mode).inc()
+            return None
+        output, seconds = stored
+        RESPONSE_CACHE_HITS.labels(conversation.mode).inc()
+        RESPONSE_CACHE_SAVED_SECONDS.labels(conversation.mode).inc(seconds)
+        return output
+
+    async def put(self, conversation: Conversation, output: str, seconds: float) -> None:
+        """
+        Сохранить ответ на промпт переписки.
+        :param conversation: переписка с пользователем.
+        :param output: ответ модели.
+        :param seconds: время генерации ответа.
+        :return:
+        """
+        if not output or len(output) > self._max_chars or not self.eligible(conversation):
+            return
+        await self._cache.put_response(
+            self.key(conversation),
+            output,
+            seconds,
+            self._ttl,
+            self._max_entries
+        )
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Final
+
+from hpc_bot.metrics import COALESCED_MESSAGES
+from hpc_bot.telegram.cache import ConversationCache
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+TURN_LOCK_TTL: Final[float] = float(os.environ.get('TURN_LOCK_TTL', 60))
+COALESCE_SEPARATOR: Final[str] = '\n'
+
+
+class ChatSerializer:
+    """
+    Последовательная обработка сообщений одного чата.
+    Сообщение сначала кладётся во входящие чата в Redis. Обработчик, занявший
+    ход, забирает все накопившиеся входящие и отвечает на них одним ходом,
+    пока входящие не опустеют. Остальные обработчики только оставляют
+    сообщение, поэтому на чат в любой момент идёт не больше одной генерации,
+    в том числе при нескольких процессах бота.
+    """
+
+    __slots__ = (
+        '_cache',
+        '_ttl'
+    )
+
+    def __init__(self, cache: ConversationCache, ttl: float = TURN_LOCK_TTL) -> None:
+        self._cache: ConversationCache = cache
+        self._ttl: int = int(ttl * 1000)
+
+    async def run(self, chat_id: int, text: str, handle: Callable[[str], Awaitable[None]]) -> bool:
+        """
+        Передать сообщение в очередь чата и обработать ход, если он свободен.
+        :param chat_id: индефикатор чата в Telegram.
+        :param text: текст сообщения пользователя.
+        :param handle: обработчик хода, получающий склеенные сообщения.
+        :return: обработан ли ход здесь или сообщение досталось текущему владельцу хода.
+        """
+        token: str = uuid.uuid4().hex
+        if not await self._cache.enqueue_message(chat_id, text, token, self._ttl):
+            return False
+
+        heartbeat: asyncio.Task = asyncio.create_task(self._heartbeat(chat_id, token))
+        released: bool = False
+        try:
+            while not released:
+                texts: list[str] = await self._cache.take_messages(chat_id)
+                if texts:
+                    COALESCED_MESSAGES.inc(len(texts) - 1)
+                    await handle(COALESCE_SEPARATOR.join(texts))
+                released = await self._cache.release_turn(chat_id, token)
+        finally:
+            heartbeat.cancel()
+            if not released:
+                await self._cache.release_turn(chat_id, token, force=True)
+        return True
+
+    async def _heartbeat(self, chat_id: int, token: str) -> None:
+        """
+        Продлевать блокировку хода, пока идёт генерация.
+        :param chat_id: индефикатор чата в Telegram.
+        :param token: токен владельца хода.
+        :return:
+        """
+        while True:
+            await asyncio.sleep(self._ttl / 3000)
+            if not await self._cache.refresh_turn(chat_id, token, self._ttl):
+                _LOGGER.warning(f"Блокировка хода чата {chat_id} потеряна")
+                return
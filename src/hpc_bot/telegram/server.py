@@ -9,22 +9,79 @@ from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.fsm.strategy import FSMStrategy
 
 from hpc_bot.metrics import start_tracking
+from hpc_bot.model.batching import BatchScheduler
+from hpc_bot.model.budget import ContextBudget
+from hpc_bot.model.encoder import PromptEncoder
+from hpc_bot.model.executor import InferenceExecutor
 from hpc_bot.model.inference import ModelInference
+from hpc_bot.model.jobs import JobQueue, RemoteInference
+from hpc_bot.model.loader import ModelLoader
 from hpc_bot.settings import BOT_TOKEN
+from hpc_bot.telegram.admission import (
+    ADMISSION_ACTIVE,
+    ADMISSION_QUEUE,
+    AdmissionController,
+)
+from hpc_bot.telegram.archive import ARCHIVE_PATH
 from hpc_bot.telegram.cache import ConversationCache
 from hpc_bot.telegram.command_hadlers import command_router
 from hpc_bot.telegram.common_handlers import common_router
+from hpc_bot.telegram.compaction import COMPACTION_TOKENS, HistoryCompactor
+from hpc_bot.telegram.lifecycle import ConversationArchiver
 from hpc_bot.telegram.manager import ModelManager
+from hpc_bot.telegram.response_cache import RESPONSE_CACHE, ResponseCache
+from hpc_bot.telegram.serializer import ChatSerializer
+from hpc_bot.telegram.webhook import BOT_MODE, run_webhook
 
 TOKEN: Final[str] = BOT_TOKEN
+INFERENCE_BACKEND: Final[str] = os.environ.get('INFERENCE_BACKEND', 'local')
+# Сколько процессов бота принимают обновления, лимиты допуска делятся между ними
+BOT_PROCESSES: Final[int] = int(os.environ.get('BOT_PROCESSES', 1))
 
 
 async def main() -> None:
     """
     Запуск бота и его метрик.
+    Обновления принимаются long polling или вебхуком, в зависимости от BOT_MODE.
+    Веса модели загружаются в фоне уже после старта приёма обновлений.
+    При INFERENCE_BACKEND=remote модель не загружается: задачи генерации
+    ставятся в очередь Redis, которую разбирают процессы src/worker.py.
+    При RESPONSE_CACHE=1 ответы на повторяющиеся промпты берутся из кэша ответов.
+    При COMPACTION_TOKENS>0 длинные истории чатов пересказываются в фоне.
+    При заданном ARCHIVE_PATH переписки простаивающих чатов выгружаются в архив на диске.
+    Очередь допуска к модели у каждого процесса своя, поэтому при BOT_PROCESSES>1
+    её лимиты делятся между процессами.
     :param:
     :return:
     """
+    inference: ModelInference = ModelInference.without_model()
+    loader: ModelLoader | None = None
+    executor: RemoteInference | BatchScheduler
+    if INFERENCE_BACKEND == 'remote':
+        executor = RemoteInference(JobQueue())
+    else:
+        inference_executor: InferenceExecutor = InferenceExecutor(inference)
+        loader = ModelLoader(inference_executor)
+        executor = BatchScheduler(inference_executor)
+    admission: AdmissionController = AdmissionController(
+        ConversationCache(),
+        max_active=max(1, ADMISSION_ACTIVE // BOT_PROCESSES),
+        max_pending=max(1, ADMISSION_QUEUE // BOT_PROCESSES)
+    )
+    budget: ContextBudget = ContextBudget(
+        inference.count_tokens,
+        inference.generation_config.max_new_tokens or 0
+    )
+    compactor: HistoryCompactor | None = None
+    if COMPACTION_TOKENS > 0:
+        compactor = HistoryCompactor(
+            executor,
+            ConversationCache(),
+            inference.count_tokens,
+            admission=admission,
+            loader=loader,
+            budget=budget
+        )
     dp: Final[Dispatcher] = Dispatcher(
         storage=RedisStorage(
             redis=redis.Redis(
@@ -35,14 +92,38 @@ async def main() -> None:
         ),
         fsm_strategy=FSMStrategy.USER_IN_CHAT,
         manager=ModelManager(
-            inference=ModelInference(),
-            cache=ConversationCache()
+            inference=executor,
+            cache=ConversationCache(),
+            budget=budget,
+            encoder=PromptEncoder(
+                inference.tokenize,
+                inference.tokenizer_version,
+                ConversationCache()
+            ),
+            serializer=ChatSerializer(ConversationCache()),
+            admission=admission,
+            loader=loader,
+            responses=ResponseCache(
+                ConversationCache(),
+                inference.model_id,
+                inference.generation_config
+            ) if RESPONSE_CACHE else None,
+            compactor=compactor
         )
     )
     dp.include_routers(command_router, common_router)
 
     loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
     start_tracking(loop, ConversationCache())
+    if loader is not None:
+        loader.start()
+    if compactor is not None:
+        compactor.start()
+    if ARCHIVE_PATH:
+        ConversationArchiver(ConversationCache()).start()
 
     bot = Bot(TOKEN, parse_mode=ParseMode.HTML)
-    await dp.start_polling(bot)
+    if BOT_MODE == 'webhook':
+        await run_webhook(dp, bot)
+    else:
+        await dp.start_polling(bot)
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import time
+from contextlib import suppress
+from typing import AsyncIterator, Final
+
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from hpc_bot.metrics import FIRST_VISIBLE_TOKEN_TIME
+from hpc_bot.telegram.messages import EMPTY_ANSWER_TEXT, PLACEHOLDER_TEXT
+
+STREAM_ANSWERS: Final[bool] = os.environ.get('STREAM_ANSWERS', '1') == '1'
+EDIT_INTERVAL: Final[float] = float(os.environ.get('EDIT_INTERVAL', 1.0))
+
+
+async def edit_message(message: Message, text: str, final: bool = False) -> bool:
+    """
+    Отредактировать сообщение бота.
+    Промежуточные правки при превышении лимитов Telegram пропускаются,
+    а финальная правка повторяется после указанной паузы.
+    :param message: сообщение бота.
+    :param text: новый текст сообщения.
+    :param final: признак финальной правки.
+    :return: удалось ли отредактировать сообщение.
+    """
+    while True:
+        try:
+            await message.edit_text(text)
+            return True
+        except TelegramRetryAfter as e:
+            if not final:
+                return False
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest:
+            # Текст не изменился
+            return False
+
+
+async def stream_answer(
+    message: Message,
+    chunks: AsyncIterator[str],
+    edit_interval: float = EDIT_INTERVAL
+) -> str:
+    """
+    Отправить ответ модели по мере генерации.
+    Сначала отправляется заглушка, затем она редактируется не чаще,
+    чем раз в `edit_interval` секунд, чтобы не упираться в лимиты Telegram.
+    Пустой ответ заменяет заглушку на сообщение об этом, а при ошибке
+    заглушка удаляется.
+    :param message: сообщение от пользователя.
+    :param chunks: куски ответа модели.
+    :param edit_interval: минимальный интервал между правками в секундах.
+    :return: итоговый текст ответа.
+    """
+    started: float = time.perf_counter()
+    placeholder: Message = await message.answer(PLACEHOLDER_TEXT)
+
+    text: str = ""
+    shown: str = ""
+    last_edit: float = 0.0
+    answered: bool = False
+    try:
+        async for chunk in chunks:
+            text += chunk
+            visible: str = text.strip()
+            if not visible or time.monotonic() - last_edit < edit_interval:
+                continue
+            if await edit_message(placeholder, visible):
+                if not shown:
+                    FIRST_VISIBLE_TOKEN_TIME.observe(time.perf_counter() - started)
+                shown = visible
+            last_edit = time.monotonic()
+
+        text = text.strip()
+        if not text:
+            answered = await edit_message(placeholder, EMPTY_ANSWER_TEXT, final=True)
+        elif text != shown:
+            if not shown:
+                FIRST_VISIBLE_TOKEN_TIME.observe(time.perf_counter() - started)
+            answered = await edit_message(placeholder, text, final=True)
+        else:
+            answered = True
+    finally:
+        # Заглушка не должна оставаться в чате, ошибку пользователю сообщает обработчик
+        if not answered:
+            with suppress(TelegramAPIError):
+                await placeholder.delete()
+    return text
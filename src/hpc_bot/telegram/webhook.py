@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import os
+from typing import Any, Final
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from hpc_bot.metrics import WEBHOOK_QUEUE_DEPTH, WEBHOOK_REJECTIONS
+
+_LOGGER: Final[logging.Logger] = logging.getLogger(__name__)
+
+BOT_MODE: Final[str] = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL: Final[str] = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_PATH: Final[str] = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET: Final[str | None] = os.environ.get('WEBHOOK_SECRET') or None
+WEBHOOK_HOST: Final[str] = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT: Final[int] = int(os.environ.get('WEBHOOK_PORT', 8080))
+WEBHOOK_WORKERS: Final[int] = int(os.environ.get('WEBHOOK_WORKERS', 32))
+WEBHOOK_QUEUE: Final[int] = int(os.environ.get('WEBHOOK_QUEUE', 1024))
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """
+    Приём обновлений Telegram через вебхук с ограниченной обработкой.
+    Обновление кладётся в очередь, и Telegram сразу получает ответ 200,
+    а обработкой занимается фиксированное число задач. Если очередь полна,
+    то возвращается 503, и Telegram повторит доставку позже.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        secret_token: str | None = WEBHOOK_SECRET,
+        workers: int = WEBHOOK_WORKERS,
+        max_pending: int = WEBHOOK_QUEUE,
+        **data: Any
+    ) -> None:
+        super().__init__(
+            dispatcher=dispatcher,
+            bot=bot,
+            handle_in_background=True,
+            secret_token=secret_token,
+            **data
+        )
+        self.workers: int = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._tasks: list[asyncio.Task] = []
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        """
+        Зарегистрировать обработчик и запуск задач обработки вместе с приложением.
+        :param app: приложение aiohttp.
+        :param path: путь вебхука.
+        :return:
+        """
+        app.on_startup.append(self._start_workers)
+        super().register(app, path=path, **kwargs)
+
+    async def _start_workers(self, app: web.Application) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self) -> None:
+        """
+        Обрабатывать обновления из очереди.
+        :param:
+        :return:
+        """
+        while True:
+            bot, update = await self.queue.get()
+            WEBHOOK_QUEUE_DEPTH.set(self.queue.qsize())
+            try:
+                await self._background_feed_update(bot=bot, update=update)
+            except Exception as e:
+                _LOGGER.exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        """
+        Поставить обновление в очередь и сразу ответить Telegram.
+        :param bot: бот, которому пришло обновление.
+        :param request: запрос Telegram.
+        :return: ответ Telegram.
+        """
+        update: dict[str, Any] = await request.json(loads=bot.session.json_loads)
+        try:
+            self.queue.put_nowait((bot, update))
+        except asyncio.QueueFull:
+            WEBHOOK_REJECTIONS.inc()
+            return web.Response(status=503)
+        WEBHOOK_QUEUE_DEPTH.set(self.queue.qsize())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        """
+        Остановить задачи обработки и закрыть сессию бота.
+        :param:
+        :return:
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await super().close()
+
+
+def build_application(dispatcher: Dispatcher, bot: Bot, **kwargs: Any) -> web.Application:
+    """
+    Собрать приложение aiohttp для приёма обновлений через вебхук.
+    :param dispatcher: диспетчер aiogram.
+    :param bot: бот.
+    :param kwargs: параметры обработчика вебхука.
+    :return: приложение aiohttp.
+    """
+    app: web.Application = web.Application()
+    QueuedRequestHandler(dispatcher=dispatcher, bot=bot, **kwargs).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=bot)
+    return app
+
+
+async def run_webhook(dispatcher: Dispatcher, bot: Bot) -> None:
+    """
+    Запустить приём обновлений через вебхук на WEBHOOK_PORT.
+    :param dispatcher: диспетчер aiogram.
+    :param bot: бот.
+    :return:
+    """
+    runner: web.AppRunner = web.AppRunner(build_application(dispatcher, bot))
+    await runner.setup()
+    await web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
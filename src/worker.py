@@ -0,0 +1,13 @@
+import asyncio
+import logging
+import os
+import sys
+
+from prometheus_client import start_http_server
+
+from hpc_bot.model.worker import main
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    start_http_server(int(os.environ.get('WORKER_METRICS_PORT', 8001)))
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import (
+    GenerationConfig,
+    LlamaConfig,
+    LlamaForCausalLM,
+    PreTrainedTokenizerFast,
+)
+
+from hpc_bot.model.inference import ModelInference
+
+SPECIAL_TOKENS: list[str] = ['<unk>', '<s>', '</s>']
+
+
+def build_tiny_tokenizer() -> PreTrainedTokenizerFast:
+    """
+    Байтовый токенизатор без слияний, понимающий любой текст.
+    """
+    alphabet: list[str] = pre_tokenizers.ByteLevel.alphabet()
+    vocab: dict[str, int] = {token: i for i, token in enumerate(SPECIAL_TOKENS + sorted(alphabet))}
+    tokenizer: Tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token='<unk>',
+        bos_token='<s>',
+        eos_token='</s>',
+        pad_token='<unk>',
+        model_input_names=['input_ids', 'attention_mask']
+    )
+
+
+def build_tiny_model(vocab_size: int, seed: int = 0, num_hidden_layers: int = 2) -> LlamaForCausalLM:
+    """
+    Крошечная случайная Llama для прогона на CPU.
+    """
+    torch.manual_seed(seed)
+    return LlamaForCausalLM(LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+        max_position_embeddings=4096,
+        bos_token_id=1,
+        eos_token_id=2,
+        pad_token_id=0
+    ))
+
+
+@pytest.fixture(scope='session')
+def tiny_inference() -> ModelInference:
+    tokenizer: PreTrainedTokenizerFast = build_tiny_tokenizer()
+    return ModelInference.from_components(
+        tokenizer=tokenizer,
+        model=build_tiny_model(len(tokenizer)),
+        generation_config=GenerationConfig(
+            max_new_tokens=8,
+            do_sample=False,
+            bos_token_id=1,
+            eos_token_id=2,
+            pad_token_id=0
+        )
+    )
@@ -0,0 +1,76 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+
+from hpc_bot.exceptions import BusyError, RateLimitError
+from hpc_bot.telegram.admission import AdmissionController
+
+
+def make_controller(max_active: int = 1, max_pending: int = 10) -> AdmissionController:
+    cache: AsyncMock = AsyncMock(name='mock-cache')
+    cache.take_rate_token.return_value = 0
+    return AdmissionController(cache, max_active=max_active, max_pending=max_pending)
+
+
+@pytest.mark.asyncio
+async def test_rate_limit() -> None:
+    controller: AdmissionController = make_controller()
+    await controller.check_rate(1)
+
+    controller._cache.take_rate_token.return_value = 2.5
+    with pytest.raises(RateLimitError) as error:
+        await controller.check_rate(1)
+    assert error.value.retry_after == 2.5
+
+
+@pytest.mark.asyncio
+async def test_fair_order() -> None:
+    controller: AdmissionController = make_controller()
+    order: list[str] = []
+    release: asyncio.Event = asyncio.Event()
+
+    async def turn(user_id: int, name: str) -> None:
+        async with controller.slot(user_id):
+            order.append(name)
+            if name == 'first':
+                await release.wait()
+
+    first: asyncio.Task = asyncio.create_task(turn(1, 'first'))
+    await asyncio.sleep(0)
+    # Активный пользователь присылает много ходов раньше остальных
+    tasks: list[asyncio.Task] = [asyncio.create_task(turn(1, f'heavy{i}')) for i in range(3)]
+    await asyncio.sleep(0)
+    tasks += [asyncio.create_task(turn(2, 'light2')), asyncio.create_task(turn(3, 'light3'))]
+    await asyncio.sleep(0)
+    assert controller.pending == 5
+
+    release.set()
+    await asyncio.gather(first, *tasks)
+    assert order[:2] == ['first', 'heavy0']
+    assert set(order[2:4]) == {'light2', 'light3'}
+    assert order[4:] == ['heavy1', 'heavy2']
+
+
+@pytest.mark.asyncio
+async def test_queue_overflow_rejected() -> None:
+    controller: AdmissionController = make_controller(max_active=1, max_pending=1)
+    release: asyncio.Event = asyncio.Event()
+
+    async def turn(user_id: int) -> None:
+        async with controller.slot(user_id):
+            await release.wait()
+
+    tasks: list[asyncio.Task] = [asyncio.create_task(turn(1)), asyncio.create_task(turn(2))]
+    await asyncio.sleep(0)
+    with pytest.raises(BusyError) as error:
+        async with controller.slot(3):
+            pass
+    assert error.value.position == 2
+
+    # Отменённый в очереди ход освобождает место
+    tasks[1].cancel()
+    await asyncio.sleep(0)
+    assert controller.pending == 0
+    release.set()
+    await tasks[0]
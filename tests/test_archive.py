@@ -0,0 +1,145 @@
+import time
+from pathlib import Path
+
+import fakeredis
+import pytest
+
+from hpc_bot.model.conversion import Message, Role
+from hpc_bot.telegram.archive import (
+    ArchivedConversation,
+    ConversationArchive,
+    pack_records,
+    unpack_records,
+)
+from hpc_bot.telegram.cache import ConversationCache
+from hpc_bot.telegram.lifecycle import ConversationArchiver
+
+
+@pytest.fixture
+def cache(tmp_path: Path) -> ConversationCache:
+    server = fakeredis.FakeServer()
+    # Кэш переписок - одиночка, поэтому для каждого теста собирается в обход метакласса
+    cache: ConversationCache = object.__new__(ConversationCache)
+    cache.__init__(
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=True),
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=False),
+        ConversationArchive(str(tmp_path / 'archive.sqlite'))
+    )
+    return cache
+
+
+def test_records_round_trip(tmp_path: Path) -> None:
+    records: list[bytes] = [b'', b'\x00\x01', 'Привет'.encode() * 100]
+    assert unpack_records(pack_records(records)) == records
+    assert unpack_records(pack_records([])) == []
+
+    archive = ConversationArchive(str(tmp_path / 'nested' / 'archive.sqlite'))
+    conversation = ArchivedConversation('user', 3, 10, records)
+    archive.save(1, conversation)
+    archive.save(1, conversation._replace(head=12))
+    assert len(archive) == 1
+    assert archive.load(1) == conversation._replace(head=12)
+    archive.delete(1)
+    assert archive.load(1) is None
+
+
+@pytest.mark.asyncio
+async def test_idle_chat_is_archived_and_restored(cache: ConversationCache) -> None:
+    await cache.start_conversation(1, 'user')
+    first = Message(role=Role.USER, content='Как поставить задачу в очередь?')
+    answer = Message(role=Role.BOT, content='Командой sbatch.')
+    assert await cache.open_turn(1, first) == []
+    await cache.close_turn(1, answer)
+    key, meta = cache.chat_keys(1)
+    assert await cache.raw.ttl(key) > 0
+    # Служебный хэш с поколением не истекает и не вытесняется
+    assert await cache.raw.ttl(meta) == -1
+
+    # Чат с идущим ходом не выгружается
+    await cache.cache.set(cache.LOCK_PATTERN.format(chat_id=1), 'token')
+    archiver = ConversationArchiver(cache, idle=0, batch=1)
+    assert await archiver.sweep() == 0
+    await cache.cache.delete(cache.LOCK_PATTERN.format(chat_id=1))
+
+    assert await archiver.sweep() == 1
+    assert not await cache.raw.exists(key)
+    assert len(cache.archive) == 1
+    # Чат остаётся известным, а повторная отметка обращений его не возвращает в выборку
+    assert await cache.exist_chat(1)
+    assert await cache.backfill_activity() == 0
+    assert await archiver.sweep() == 0
+
+    # Переписка возвращается при следующем ходе с новым поколением
+    second = Message(role=Role.USER, content='А как посмотреть очередь?')
+    assert await cache.open_turn(1, second) == [first, answer]
+    assert await cache.get_correspondence(1) == [first, answer, second]
+    assert int(await cache.cache.hget(meta, 'epoch')) == 2
+    assert not await cache.cache.hexists(meta, 'archived')
+    assert len(cache.archive) == 0
+    assert await cache.idle_chats(int(time.time() * 1000) + 1, 10) == [1]
+
+
+@pytest.mark.asyncio
+async def test_demote_conflict_keeps_chat(cache: ConversationCache) -> None:
+    await cache.start_conversation(1, 'user')
+    await cache.open_turn(1, Message(role=Role.USER, content='Привет'))
+    # Обращение к чату после чтения отменяет выгрузку
+    await cache.cache.zadd(cache.ACTIVITY, {'1': 1})
+    original = cache._demote
+
+    async def touched(**kwargs) -> int:
+        await cache.cache.zadd(cache.ACTIVITY, {'1': 2})
+        return await original(**kwargs)
+
+    cache._demote = touched
+    assert not await cache.demote(1)
+    assert await cache.exist_chat(1)
+    assert len(cache.archive) == 0
+    assert not await cache.rehydrate(2)
+
+
+@pytest.mark.asyncio
+async def test_reset_archived_chat(cache: ConversationCache) -> None:
+    await cache.start_conversation(1, 'user')
+    await cache.open_turn(1, Message(role=Role.USER, content='Привет'))
+    await ConversationArchiver(cache, idle=0).sweep()
+
+    await cache.clear_conversion(1)
+    assert len(cache.archive) == 0
+    message = Message(role=Role.USER, content='Новый вопрос')
+    assert await cache.open_turn(1, message) == []
+    assert await cache.get_correspondence(1) == [message]
+
+
+@pytest.mark.asyncio
+async def test_lost_list_resets_history_cache(cache: ConversationCache) -> None:
+    await cache.start_conversation(1, 'user')
+    old = [Message(role=Role.USER, content=f'Старый вопрос {i}') for i in range(2)]
+    new = [Message(role=Role.USER, content=f'Новый вопрос {i}') for i in range(3)]
+    for message in old:
+        await cache.open_turn(1, message)
+
+    # Список истёк или вытеснен, и другой процесс успел записать столько же сообщений
+    await cache.raw.delete(cache.KEY_PATTERN.format(chat_id=1))
+    other: ConversationCache = object.__new__(ConversationCache)
+    other.__init__(cache.cache, cache.raw, cache.archive)
+    for message in new[:2]:
+        await other.open_turn(1, message)
+
+    assert await cache.open_turn(1, new[2]) == new[:2]
+    assert await cache.get_correspondence(1) == new
+
+
+@pytest.mark.asyncio
+async def test_backfill_and_ttl_without_archive(cache: ConversationCache) -> None:
+    # Чат, созданный до учёта обращений
+    await cache.cache.hset(cache.USER_CHAT, '1', 'user')
+    assert await cache.backfill_activity() == 1
+    assert await cache.idle_chats(int(time.time() * 1000) + 1, 10) == [1]
+
+    # Без архива переписки не истекают
+    plain: ConversationCache = object.__new__(ConversationCache)
+    plain.__init__(cache.cache, cache.raw)
+    assert plain.archive is None and plain.ttl == 0
+    await plain.open_turn(1, Message(role=Role.USER, content='Привет'))
+    assert await plain.raw.ttl(plain.KEY_PATTERN.format(chat_id=1)) == -1
@@ -0,0 +1,63 @@
+from unittest.mock import AsyncMock
+
+import pytest
+import torch
+from conftest import build_tiny_model
+
+from hpc_bot.exceptions import MemoryLimitError
+from hpc_bot.model.backend import (
+    CpuBackend,
+    CudaBackend,
+    allocation_guard,
+    select_backend,
+)
+from hpc_bot.model.conversion import Message, Role
+from hpc_bot.model.inference import ModelInference
+from hpc_bot.telegram.manager import ModelManager
+
+
+def test_select_backend() -> None:
+    assert isinstance(select_backend('cpu'), CpuBackend)
+    assert isinstance(select_backend('cuda'), CudaBackend)
+    with pytest.raises(ValueError):
+        select_backend('tpu')
+
+
+def test_int8_keeps_outputs_close() -> None:
+    torch.manual_seed(0)
+    model: torch.nn.Module = build_tiny_model(300).eval()
+    input_ids: torch.Tensor = torch.tensor([[1, 10, 20, 30]])
+    with torch.inference_mode():
+        expected: torch.Tensor = model(input_ids=input_ids).logits
+
+    quantized: torch.nn.Module = CpuBackend(precision='int8').prepare(model)
+    assert any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in quantized.modules())
+    with torch.inference_mode():
+        actual: torch.Tensor = quantized(input_ids=input_ids).logits
+    assert torch.allclose(actual, expected, atol=0.1)
+
+
+def test_memory_limit(tiny_inference: ModelInference) -> None:
+    backend: CpuBackend = CpuBackend(precision='fp32', memory_limit=1)
+    with pytest.raises(MemoryLimitError) as error:
+        backend.check_memory(tiny_inference.model, batch=1, tokens=16)
+    assert error.value.available < 0
+
+    with pytest.raises(MemoryLimitError), allocation_guard():
+        raise RuntimeError("DefaultCPUAllocator: can't allocate memory")
+    with pytest.raises(ValueError), allocation_guard():
+        raise ValueError('not memory')
+
+
+@pytest.mark.asyncio
+async def test_window_compresses_on_memory_limit() -> None:
+    inference: AsyncMock = AsyncMock(name='mock-inference')
+    inference.side_effect = [MemoryLimitError(), 'answer']
+    cache: AsyncMock = AsyncMock(name='mock-cache')
+    cache.open_turn.return_value = [
+        Message(role=Role.USER, content='Старый вопрос'),
+        Message(role=Role.BOT, content='Старый ответ')
+    ]
+    manager: ModelManager = ModelManager(inference=inference, cache=cache)
+    assert await manager.answer(1, 'Привет', 'UserMode:window') == 'answer'
+    assert inference.invalidate.await_count == 1
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+
+import pytest
+
+from hpc_bot.model.batching import BatchScheduler
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.executor import InferenceExecutor
+from hpc_bot.model.inference import ModelInference
+
+
+class FakeInference:
+    """
+    Модель, которая отвечает длиной промпта и запоминает пакеты.
+    """
+
+    def __init__(self, fail_on: str | None = None) -> None:
+        self.batches: list[list[str]] = []
+        self.fail_on: str | None = fail_on
+        self.encoded_in: set[int] = set()
+
+    def encode(self, conversation: Conversation) -> str:
+        self.encoded_in.add(threading.get_ident())
+        return conversation.get_prompt()
+
+    def generate_batch(
+        self,
+        prompts: list[str],
+        streamer: None = None,
+        chat_ids: list[int | None] | None = None,
+        modes: list[str] | None = None
+    ) -> list[str]:
+        self.batches.append(prompts)
+        if self.fail_on and any(self.fail_on in prompt for prompt in prompts):
+            raise RuntimeError('broken prompt')
+        return [str(len(prompt)) for prompt in prompts]
+
+
+def make_conversation(content: str) -> Conversation:
+    return Conversation(messages=[Message(role=Role.USER, content=content)])
+
+
+@pytest.mark.asyncio
+async def test_requests_are_batched() -> None:
+    inference: FakeInference = FakeInference()
+    scheduler: BatchScheduler = BatchScheduler(
+        InferenceExecutor(inference),
+        batch_window=0.05,
+        max_batch_size=4,
+        bucket_size=1000
+    )
+    conversations: list[Conversation] = [make_conversation('a' * i) for i in range(1, 5)]
+    outputs: list[str] = await asyncio.gather(*(scheduler(conversation) for conversation in conversations))
+
+    assert outputs == [str(len(conversation.get_prompt())) for conversation in conversations]
+    assert len(inference.batches) == 1
+    assert scheduler.pending == 0
+    # Промпты токенизируются в потоке инференса, а не в событийном цикле
+    assert threading.get_ident() not in inference.encoded_in
+
+
+@pytest.mark.asyncio
+async def test_batches_respect_limits() -> None:
+    inference: FakeInference = FakeInference()
+    scheduler: BatchScheduler = BatchScheduler(
+        InferenceExecutor(inference),
+        batch_window=0.05,
+        max_batch_size=2,
+        bucket_size=1000
+    )
+    await asyncio.gather(*(scheduler(make_conversation('a')) for _ in range(5)))
+    assert [len(batch) for batch in inference.batches] == [2, 2, 1]
+
+    inference.batches.clear()
+    prompt_tokens: int = len(make_conversation('a').get_prompt())
+    scheduler = BatchScheduler(
+        InferenceExecutor(inference),
+        batch_window=0.05,
+        max_batch_size=8,
+        max_batch_tokens=prompt_tokens * 3,
+        bucket_size=1000
+    )
+    await asyncio.gather(*(scheduler(make_conversation('a')) for _ in range(4)))
+    assert [len(batch) for batch in inference.batches] == [3, 1]
+
+
+@pytest.mark.asyncio
+async def test_batches_grouped_by_length() -> None:
+    inference: FakeInference = FakeInference()
+    scheduler: BatchScheduler = BatchScheduler(
+        InferenceExecutor(inference),
+        batch_window=0.05,
+        max_batch_size=8,
+        bucket_size=100
+    )
+    short: list[Conversation] = [make_conversation('a') for _ in range(2)]
+    long: list[Conversation] = [make_conversation('a' * 500) for _ in range(2)]
+    await asyncio.gather(*(scheduler(conversation) for conversation in short + long))
+
+    assert len(inference.batches) == 2
+    for batch in inference.batches:
+        assert len({len(prompt) for prompt in batch}) == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_isolated() -> None:
+    inference: FakeInference = FakeInference(fail_on='broken')
+    scheduler: BatchScheduler = BatchScheduler(
+        InferenceExecutor(inference),
+        batch_window=0.05,
+        bucket_size=1000
+    )
+    results: list = await asyncio.gather(
+        scheduler(make_conversation('good')),
+        scheduler(make_conversation('broken')),
+        return_exceptions=True
+    )
+    assert results[0] == str(len(make_conversation('good').get_prompt()))
+    assert isinstance(results[1], RuntimeError)
+
+
+@pytest.mark.asyncio
+async def test_tiny_model_batch(tiny_inference: ModelInference) -> None:
+    scheduler: BatchScheduler = BatchScheduler(
+        InferenceExecutor(tiny_inference),
+        batch_window=0.05,
+        bucket_size=4096
+    )
+    conversations: list[Conversation] = [
+        make_conversation('Привет'),
+        make_conversation('Как дела у модели на CPU?')
+    ]
+    outputs: list[str] = await asyncio.gather(*(scheduler(conversation) for conversation in conversations))
+
+    assert len(outputs) == 2
+    assert all(isinstance(output, str) for output in outputs)
+    prompts: list[str] = [conversation.get_prompt() for conversation in conversations]
+    assert tiny_inference.generate_batch(prompts) == outputs
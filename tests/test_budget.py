@@ -0,0 +1,63 @@
+import pytest
+
+from hpc_bot.exceptions import TooLongMessageError
+from hpc_bot.model.budget import ContextBudget
+from hpc_bot.model.conversion import Conversation, Message, Role
+
+
+def make_conversation(*contents: str) -> Conversation:
+    return Conversation(messages=[
+        Message(role=Role.SYSTEM, content='s'),
+        *(Message(role=Role.USER, content=content) for content in contents)
+    ])
+
+
+def test_plan_drops_oldest_messages() -> None:
+    conversation: Conversation = make_conversation('a' * 10, 'b' * 10, 'c' * 10)
+    message_size: int = len(conversation.render_message(conversation.messages[1]))
+    response_size: int = len(conversation.response_template)
+    system_size: int = len(conversation.system_prefix)
+
+    fits: int = system_size + message_size * 3 + response_size
+    assert ContextBudget(len, max_new_tokens=0, max_context=fits).plan(conversation) == 0
+    assert ContextBudget(len, max_new_tokens=1, max_context=fits).plan(conversation) == 1
+    assert ContextBudget(len, max_new_tokens=message_size + 1, max_context=fits).plan(conversation) == 2
+
+
+def test_plan_rejects_oversized_message() -> None:
+    conversation: Conversation = make_conversation('a', 'b' * 1000)
+    with pytest.raises(TooLongMessageError):
+        ContextBudget(len, max_new_tokens=10, max_context=500).plan(conversation)
+
+
+def test_tokens_counted_once() -> None:
+    calls: list[str] = []
+
+    def count_tokens(text: str) -> int:
+        calls.append(text)
+        return len(text)
+
+    budget: ContextBudget = ContextBudget(count_tokens, max_new_tokens=0, max_context=10_000)
+    conversation: Conversation = make_conversation('a', 'b')
+    budget.plan(conversation)
+    first_calls: int = len(calls)
+    conversation.append(Message(role=Role.USER, content='c'))
+    budget.plan(conversation)
+    assert len(calls) == first_calls + 1
+
+
+def test_conversation_keeps_token_counts() -> None:
+    conversation: Conversation = make_conversation('a' * 10, 'b' * 10)
+    assert conversation.tokens is None
+    tokens: list[int] = conversation.count_tokens(len)
+    assert conversation.tokens == sum(tokens)
+
+    conversation.append(Message(role=Role.BOT, content='c' * 10))
+    assert conversation.tokens is None
+    assert conversation.count_tokens(lambda text: 1)[:-1] == tokens
+
+    conversation.pop_first_messages(2)
+    assert len(conversation) == 2
+    assert conversation.messages[0].role == Role.SYSTEM
+    assert conversation.tokens == tokens[0] + 1
+    assert conversation.get_prompt() == "".join(conversation.get_prompt_parts())
@@ -0,0 +1,53 @@
+from pathlib import Path
+
+import pytest
+import torch
+from conftest import build_tiny_model, build_tiny_tokenizer
+from peft import LoraConfig, PeftModel, get_peft_model
+from transformers import AutoModelForCausalLM, GenerationConfig, PreTrainedModel
+
+from hpc_bot.model.checkpoint import load_merged, merge_adapter, read_manifest
+
+
+@pytest.fixture
+def adapter_path(tmp_path: Path) -> str:
+    tokenizer = build_tiny_tokenizer()
+    torch.manual_seed(0)
+    base: PreTrainedModel = build_tiny_model(len(tokenizer))
+    base.save_pretrained(tmp_path / 'base')
+
+    model: PeftModel = get_peft_model(base, LoraConfig(r=4, target_modules=['q_proj', 'v_proj']))
+    # Адаптер после инициализации ничего не меняет, поэтому его веса заполняются случайно
+    for name, param in model.named_parameters():
+        if 'lora_B' in name:
+            torch.nn.init.normal_(param)
+    model.peft_config['default'].base_model_name_or_path = str(tmp_path / 'base')
+    model.save_pretrained(tmp_path / 'adapter')
+    tokenizer.save_pretrained(tmp_path / 'adapter')
+    GenerationConfig(max_new_tokens=8).save_pretrained(tmp_path / 'adapter')
+    return str(tmp_path / 'adapter')
+
+
+def test_merged_checkpoint_matches_adapter(adapter_path: str, tmp_path: Path) -> None:
+    output: Path = tmp_path / 'merged'
+    manifest: dict = merge_adapter(adapter_path, output, dtype='float32')
+    assert manifest['quantization'] == 'none'
+    assert manifest['files']
+    assert read_manifest(output, adapter_path) == manifest
+    assert read_manifest(output, 'other/adapter') is None
+    assert read_manifest(tmp_path / 'missing', adapter_path) is None
+
+    merged: PreTrainedModel = load_merged(output, manifest)
+    adapted: PeftModel = PeftModel.from_pretrained(
+        AutoModelForCausalLM.from_pretrained(manifest['base_model']),
+        adapter_path
+    ).eval()
+    input_ids: torch.Tensor = torch.tensor([[1, 10, 20, 30, 40]])
+    with torch.no_grad():
+        expected: torch.Tensor = adapted(input_ids=input_ids).logits
+        actual: torch.Tensor = merged(input_ids=input_ids).logits
+    assert torch.allclose(actual, expected, atol=1e-4)
+
+    # Чекпоинт без части весов не используется
+    (output / next(iter(manifest['files']))).unlink()
+    assert read_manifest(output, adapter_path) is None
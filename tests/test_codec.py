@@ -0,0 +1,30 @@
+from hpc_bot.model.conversion import Message, Role
+from hpc_bot.telegram.codec import (
+    COMPRESS_THRESHOLD,
+    decode_message,
+    encode_message,
+    is_legacy,
+)
+
+
+def test_roundtrip() -> None:
+    for role in Role:
+        message: Message = Message(role=role, content='Привет, кластер!')
+        data: bytes = encode_message(message)
+        assert not is_legacy(data)
+        assert len(data) == len(message.content.encode()) + 1
+        assert decode_message(data) == message
+
+
+def test_long_content_compressed() -> None:
+    message: Message = Message(role=Role.BOT, content='ответ ' * COMPRESS_THRESHOLD)
+    data: bytes = encode_message(message)
+    assert len(data) < len(message.content.encode())
+    assert decode_message(data) == message
+
+
+def test_legacy_json() -> None:
+    message: Message = Message(role=Role.USER, content='{"старый": "формат"}')
+    data: bytes = message.model_dump_json().encode()
+    assert is_legacy(data)
+    assert decode_message(data) == message
@@ -0,0 +1,151 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import fakeredis
+import pytest
+
+from hpc_bot.model.budget import ContextBudget
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.telegram.cache import ConversationCache
+from hpc_bot.telegram.compaction import HistoryCompactor
+
+
+class SummaryInference:
+    """
+    Инференс, пересказывающий переписку одним словом.
+    """
+
+    def __init__(self) -> None:
+        self.requests: list[Conversation] = []
+        self.invalidated: list[int] = []
+
+    async def __call__(self, conversation: Conversation) -> str:
+        self.requests.append(conversation)
+        return 'Пользователь спрашивал про кластер.'
+
+    async def invalidate(self, chat_id: int) -> None:
+        self.invalidated.append(chat_id)
+
+
+@pytest.fixture
+def cache() -> ConversationCache:
+    server = fakeredis.FakeServer()
+    # Кэш переписок - одиночка, поэтому для каждого теста собирается в обход метакласса
+    cache: ConversationCache = object.__new__(ConversationCache)
+    cache.__init__(
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=True),
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=False)
+    )
+    return cache
+
+
+def make_history(count: int) -> list[Message]:
+    return [
+        Message(role=Role.USER if i % 2 == 0 else Role.BOT, content=f'Сообщение {i} про очередь задач')
+        for i in range(count)
+    ]
+
+
+async def fill_chat(cache: ConversationCache, chat_id: int, messages: list[Message]) -> None:
+    await cache.start_conversation(chat_id, 'user')
+    for message in messages:
+        await cache.put_message(chat_id, message)
+
+
+@pytest.mark.asyncio
+async def test_compaction_replaces_old_messages(cache: ConversationCache) -> None:
+    inference: SummaryInference = SummaryInference()
+    compactor: HistoryCompactor = HistoryCompactor(inference, cache, len, threshold=100, keep=2)
+    history: list[Message] = make_history(10)
+    await fill_chat(cache, 1, history)
+
+    assert await compactor.compact(1)
+    compacted: list[Message] = await cache.get_correspondence(1)
+    assert len(compacted) == 3
+    assert compacted[0].role == Role.SYSTEM
+    assert 'кластер' in compacted[0].content
+    assert compacted[1:] == history[-2:]
+    assert 'Сообщение 0' in inference.requests[0].messages[-1].content
+    assert inference.invalidated == [1]
+
+    # История после сжатия продолжает дописываться и читается другим процессом
+    await cache.close_turn(1, Message(role=Role.BOT, content='Новый ответ'))
+    cache.history.invalidate(1)
+    assert len(await cache.get_correspondence(1)) == 4
+
+    # История не длиннее порога не сжимается
+    assert not await HistoryCompactor(SummaryInference(), cache, len, threshold=10_000).compact(1)
+
+
+@pytest.mark.asyncio
+async def test_compaction_skips_changed_chat(cache: ConversationCache) -> None:
+    compactor: HistoryCompactor = HistoryCompactor(SummaryInference(), cache, len, threshold=100, keep=2)
+    await fill_chat(cache, 1, make_history(10))
+
+    # Ход, начавшийся во время пересказа, отменяет замену
+    await cache.enqueue_message(1, 'Новый вопрос', 'token', 60_000)
+    assert not await compactor.compact(1)
+    await cache.release_turn(1, 'token', force=True)
+
+    epoch, head, _ = await cache.snapshot(1)
+    await cache.trim_conversation(1, 2)
+    memory: Message = Message(role=Role.SYSTEM, content='Пересказ')
+    assert not await cache.compact_conversation(1, epoch, head, 4, memory)
+    assert len(await cache.get_correspondence(1)) == 8
+
+
+def test_observe_queues_long_chats() -> None:
+    compactor: HistoryCompactor = HistoryCompactor(SummaryInference(), AsyncMock(), len, threshold=100)
+    short: Conversation = Conversation(messages=[*Conversation().messages, *make_history(2)], chat_id=1)
+    compactor.observe(short)
+    long: Conversation = Conversation(messages=[*Conversation().messages, *make_history(10)], chat_id=2)
+    compactor.observe(long)
+    compactor.observe(long)
+    assert compactor._queued == {2}
+    assert compactor._queue.qsize() == 1
+
+
+@pytest.mark.asyncio
+async def test_compaction_request_fits_budget(cache: ConversationCache) -> None:
+    inference: SummaryInference = SummaryInference()
+    budget: ContextBudget = ContextBudget(len, max_new_tokens=100, max_context=1000)
+    compactor: HistoryCompactor = HistoryCompactor(
+        inference, cache, len, threshold=100, keep=2, budget=budget
+    )
+    await fill_chat(cache, 1, make_history(40))
+
+    # За проход пересказывается только помещающееся в контекст начало истории
+    assert await compactor.compact(1)
+    assert len(inference.requests[0].get_prompt()) <= budget.limit
+    compacted: list[Message] = await cache.get_correspondence(1)
+    assert 3 < len(compacted) < 40
+    assert compacted[0].role == Role.SYSTEM
+
+    # Следующий проход пересказывает и предыдущий пересказ
+    assert await compactor.compact(1)
+    assert 'кластер' in inference.requests[1].messages[-1].content
+    assert len(await cache.get_correspondence(1)) < len(compacted)
+
+
+@pytest.mark.asyncio
+async def test_compaction_is_not_deferred_forever(cache: ConversationCache) -> None:
+    inference: SummaryInference = SummaryInference()
+    compactor: HistoryCompactor = HistoryCompactor(
+        inference,
+        cache,
+        len,
+        threshold=100,
+        keep=2,
+        admission=MagicMock(idle=False),
+        poll=0.01,
+        max_defer=0.05
+    )
+    await fill_chat(cache, 1, make_history(10))
+    compactor.observe(Conversation(messages=[*Conversation().messages, *make_history(10)], chat_id=1))
+    task: asyncio.Task = compactor.start()
+    await asyncio.sleep(0.3)
+    task.cancel()
+    # Модель всё время занята, но чат сжат по истечении max_defer
+    assert len(inference.requests) == 1
+    assert len(await cache.get_correspondence(1)) == 3
+    assert not compactor._queued
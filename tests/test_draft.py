@@ -0,0 +1,76 @@
+import copy
+
+import pytest
+from conftest import build_tiny_model, build_tiny_tokenizer
+from transformers import GenerationConfig, PreTrainedModel, PreTrainedTokenizerFast
+
+from hpc_bot.model.backend import CpuBackend
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.draft import DraftModel
+from hpc_bot.model.inference import ModelInference
+
+
+def build_inference(draft: DraftModel | None) -> ModelInference:
+    tokenizer: PreTrainedTokenizerFast = build_tiny_tokenizer()
+    return ModelInference.from_components(
+        tokenizer=tokenizer,
+        model=build_tiny_model(len(tokenizer)),
+        generation_config=GenerationConfig(
+            max_new_tokens=16,
+            do_sample=False,
+            bos_token_id=1,
+            eos_token_id=2,
+            pad_token_id=0
+        ),
+        backend=CpuBackend(precision='fp32'),
+        draft=draft
+    )
+
+
+def ask(inference: ModelInference, chat_id: int, question: str) -> str:
+    conversation: Conversation = Conversation(chat_id=chat_id)
+    conversation.append(Message(role=Role.USER, content=question))
+    return inference(conversation)
+
+
+@pytest.fixture(scope='module')
+def vocab_size() -> int:
+    return len(build_tiny_tokenizer())
+
+
+def test_speculative_matches_greedy(vocab_size: int) -> None:
+    plain: ModelInference = build_inference(None)
+    draft: DraftModel = DraftModel(build_tiny_model(vocab_size, seed=1, num_hidden_layers=1), window=1000)
+    speculative: ModelInference = build_inference(draft)
+
+    for chat_id, question in enumerate(('Привет', 'Что такое KV кэш?', 'Спасибо')):
+        assert ask(speculative, chat_id, question) == ask(plain, chat_id, question)
+    # Повторный ход чата начинается с сохранённого после спекулятивной генерации состояния
+    assert ask(speculative, 0, 'Привет!') == ask(plain, 0, 'Привет!')
+
+
+def test_identical_draft_is_accepted() -> None:
+    inference: ModelInference = build_inference(None)
+    inference.draft = DraftModel(copy.deepcopy(inference.model), window=1000)
+
+    ask(inference, 1, 'Привет')
+    # Отвергаются только предложения сверх max_new_tokens
+    assert inference.draft.acceptance > 0.5
+    assert inference.draft.active
+
+
+def test_low_acceptance_falls_back(vocab_size: int) -> None:
+    model: PreTrainedModel = build_tiny_model(vocab_size, seed=2, num_hidden_layers=1)
+    draft: DraftModel = DraftModel(model, min_acceptance=1.1, window=2, cooldown=1)
+    inference: ModelInference = build_inference(draft)
+
+    ask(inference, 1, 'Привет')
+    assert draft.active
+    ask(inference, 2, 'Привет')
+    assert not draft.active
+
+    # Пока черновик отключён, генерация идёт без него
+    ask(inference, 3, 'Привет')
+    assert not draft.active
+    assert draft.acquire()
+    assert draft.active
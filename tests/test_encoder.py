@@ -0,0 +1,66 @@
+import pytest
+
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.encoder import PromptEncoder
+from hpc_bot.model.inference import ModelInference
+
+
+class DictTokenCache:
+    """
+    Хранилище токенов сообщений в словаре вместо Redis.
+    """
+
+    def __init__(self) -> None:
+        self.storage: dict[tuple[str, str], list[int]] = {}
+
+    async def get_token_ids(self, version: str, texts: list[str]) -> list[list[int] | None]:
+        return [self.storage.get((version, text)) for text in texts]
+
+    async def put_token_ids(self, version: str, tokens: dict[str, list[int]]) -> None:
+        for text, ids in tokens.items():
+            self.storage[(version, text)] = ids
+
+
+@pytest.mark.asyncio
+async def test_encode_matches_tokenizer(tiny_inference: ModelInference) -> None:
+    tokenized: list[list[str]] = []
+
+    def tokenize(texts: list[str]) -> list[list[int]]:
+        tokenized.append(texts)
+        return tiny_inference.tokenize(texts)
+
+    encoder: PromptEncoder = PromptEncoder(tokenize, tiny_inference.tokenizer_version, DictTokenCache())
+    conversation: Conversation = Conversation()
+    for question in ('Привет', 'Как дела?'):
+        conversation.append(Message(role=Role.USER, content=question))
+        input_ids: list[int] = await encoder.encode(conversation)
+        assert input_ids == tiny_inference.tokenize([conversation.get_prompt()])[0]
+        conversation.append(Message(role=Role.BOT, content='Хорошо'))
+
+    # На втором ходе токенизируются только новые сообщения
+    assert len(tokenized) == 2
+    assert set(tokenized[1]) == {
+        conversation.render_message(conversation.messages[2]),
+        conversation.render_message(conversation.messages[3]),
+    }
+
+
+@pytest.mark.asyncio
+async def test_inference_uses_prepared_tokens(tiny_inference: ModelInference) -> None:
+    encoder: PromptEncoder = PromptEncoder(
+        tiny_inference.tokenize,
+        tiny_inference.tokenizer_version,
+        DictTokenCache()
+    )
+    conversation: Conversation = Conversation(messages=[
+        *Conversation().messages,
+        Message(role=Role.USER, content='Привет')
+    ])
+    expected: str = tiny_inference(conversation)
+
+    conversation.token_ids = await encoder.encode(conversation)
+    assert tiny_inference.encode(conversation) is conversation.token_ids
+    assert tiny_inference(conversation) == expected
+
+    conversation.pop_first_message()
+    assert conversation.token_ids is None
@@ -0,0 +1,68 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock
+
+import pytest
+
+from hpc_bot.model.conversion import Conversation
+from hpc_bot.model.executor import InferenceExecutor
+from hpc_bot.telegram.command_hadlers import command_current_mode, command_help_handler
+from hpc_bot.telegram.manager import ModelManager
+
+GENERATION_TIME: float = 0.5
+
+
+def slow_model(conversation: Conversation) -> str:
+    time.sleep(GENERATION_TIME)
+    return 'slow answer'
+
+
+@pytest.fixture
+def slow_manager() -> ModelManager:
+    cache: AsyncMock = AsyncMock(name='mock-cache')
+    cache.open_turn.return_value = []
+    return ModelManager(
+        inference=InferenceExecutor(slow_model),
+        cache=cache
+    )
+
+
+@pytest.mark.asyncio
+async def test_executor_result() -> None:
+    executor: InferenceExecutor = InferenceExecutor(slow_model)
+    assert await executor(Conversation()) == 'slow answer'
+    assert await executor.submit(sum, [1, 2, 3]) == 6
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_executor_exception() -> None:
+    def broken_model(conversation: Conversation) -> str:
+        raise RuntimeError('broken')
+
+    executor: InferenceExecutor = InferenceExecutor(broken_model)
+    with pytest.raises(RuntimeError):
+        await executor(Conversation())
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_handlers_respond_during_generation(slow_manager: ModelManager) -> None:
+    answer_task: asyncio.Task = asyncio.create_task(slow_manager.answer(1, 'Hello', 'UserMode:window'))
+    await asyncio.sleep(0.05)
+
+    help_message: AsyncMock = AsyncMock(name='help-message')
+    started: float = time.perf_counter()
+    await asyncio.wait_for(command_help_handler(help_message), timeout=GENERATION_TIME / 5)
+    assert help_message.answer.called
+
+    state: AsyncMock = AsyncMock(name='fsm-state')
+    state.get_state.return_value = 'UserMode:window'
+    mode_message: AsyncMock = AsyncMock(name='mode-message')
+    await asyncio.wait_for(command_current_mode(mode_message, state), timeout=GENERATION_TIME / 5)
+    assert mode_message.answer.called
+    assert time.perf_counter() - started < GENERATION_TIME
+    assert not answer_task.done()
+
+    assert await answer_task == 'slow answer'
+    slow_manager.inference.shutdown()
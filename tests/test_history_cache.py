@@ -0,0 +1,50 @@
+from hpc_bot.model.conversion import Message, Role
+from hpc_bot.telegram.codec import encode_message
+from hpc_bot.telegram.history_cache import HistoryCache
+
+
+def dump(*contents: str) -> list[bytes]:
+    return [encode_message(Message(role=Role.USER, content=content)) for content in contents]
+
+
+def test_merge_fetches_only_tail() -> None:
+    cache: HistoryCache = HistoryCache()
+    history: list[Message] = cache.merge(1, epoch=0, head=0, start=0, tail=dump('a', 'b'))
+    assert [message.content for message in history] == ['a', 'b']
+
+    # Redis отдал хвост после сохранённой истории, начало которой уже выброшено
+    history = cache.merge(1, epoch=0, head=1, start=2, tail=dump('c'))
+    assert [message.content for message in history] == ['b', 'c']
+    assert cache.get(1).head == 1
+
+    # Другое поколение: история прочитана целиком заново
+    history = cache.merge(1, epoch=1, head=0, start=0, tail=dump('d'))
+    assert [message.content for message in history] == ['d']
+
+
+def test_write_through() -> None:
+    cache: HistoryCache = HistoryCache()
+    cache.merge(1, epoch=0, head=0, start=0, tail=dump('a'))
+    cache.append(1, Message(role=Role.BOT, content='b'), size=2, length=2)
+    cache.trim(1, 1)
+    entry = cache.get(1)
+    assert [message.content for message in entry.messages] == ['b']
+    assert entry.end == 2
+    assert cache.size == entry.nbytes
+
+    # В чат писал другой процесс: история выбрасывается
+    cache.append(1, Message(role=Role.USER, content='c'), size=2, length=5)
+    assert cache.get(1) is None
+    assert cache.size == 0
+
+
+def test_lru_budget() -> None:
+    size: int = len(dump('a')[0])
+    cache: HistoryCache = HistoryCache(budget=size * 2)
+    cache.merge(1, epoch=0, head=0, start=0, tail=dump('a'))
+    cache.merge(2, epoch=0, head=0, start=0, tail=dump('a'))
+    cache.get(1)
+    cache.merge(3, epoch=0, head=0, start=0, tail=dump('a'))
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    assert cache.size == size * 2
@@ -0,0 +1,111 @@
+import asyncio
+from typing import AsyncIterator
+
+import fakeredis
+import pytest
+
+from hpc_bot.exceptions import BusyError, InferenceJobError
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.jobs import JobQueue, RemoteInference
+from hpc_bot.model.worker import InferenceWorker
+
+
+class EchoInference:
+    """
+    Инференс, отвечающий последним сообщением переписки.
+    """
+
+    def __init__(self) -> None:
+        self.invalidated: list[int] = []
+
+    async def __call__(self, conversation: Conversation) -> str:
+        if conversation.messages[-1].content == 'fail':
+            raise ValueError('broken prompt')
+        return conversation.messages[-1].content.upper()
+
+    async def stream(self, conversation: Conversation) -> AsyncIterator[str]:
+        for word in conversation.messages[-1].content.split():
+            yield word + ' '
+
+    async def invalidate(self, chat_id: int) -> None:
+        self.invalidated.append(chat_id)
+
+
+def make_conversation(text: str, chat_id: int = 1) -> Conversation:
+    return Conversation(
+        messages=[*Conversation().messages, Message(role=Role.USER, content=text)],
+        chat_id=chat_id,
+        mode='window'
+    )
+
+
+@pytest.fixture
+def queue() -> JobQueue:
+    return JobQueue(fakeredis.aioredis.FakeRedis(decode_responses=True), max_pending=4)
+
+
+@pytest.mark.asyncio
+async def test_worker_round_trip(queue: JobQueue) -> None:
+    inference: EchoInference = EchoInference()
+    worker: asyncio.Task = asyncio.create_task(
+        InferenceWorker(queue, inference, consumer='w1').run(block=10)
+    )
+    remote: RemoteInference = RemoteInference(queue, timeout=5)
+    await remote.invalidate(7)
+
+    assert await remote(make_conversation('привет', chat_id=7)) == 'ПРИВЕТ'
+    assert [chunk async for chunk in remote.stream(make_conversation('как дела'))] == ['как ', 'дела ']
+    with pytest.raises(InferenceJobError):
+        await remote(make_conversation('fail'))
+
+    assert inference.invalidated == [7]
+    assert await queue.cache.xlen(queue.stream) == 0
+    worker.cancel()
+    await asyncio.gather(worker, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_publish_backpressure(queue: JobQueue) -> None:
+    for _ in range(queue.max_pending):
+        await queue.publish({})
+    with pytest.raises(BusyError) as error:
+        await queue.publish({})
+    assert error.value.position == queue.max_pending
+
+
+@pytest.mark.asyncio
+async def test_stuck_job_is_claimed(queue: JobQueue) -> None:
+    await queue.ensure_group()
+    remote: RemoteInference = RemoteInference(queue, timeout=5)
+    answer: asyncio.Task = asyncio.create_task(remote(make_conversation('потерянный')))
+
+    # Процесс взял задачу и упал, не подтвердив её
+    while not await queue.read('dead', 1, 10):
+        await asyncio.sleep(0.01)
+
+    worker: InferenceWorker = InferenceWorker(queue, EchoInference(), consumer='w2', claim_idle=50)
+    await asyncio.sleep(0.1)
+    await worker.poll(block=10)
+    assert await asyncio.wait_for(answer, timeout=5) == 'ПОТЕРЯННЫЙ'
+
+
+@pytest.mark.asyncio
+async def test_exhausted_job_fails(queue: JobQueue) -> None:
+    await queue.ensure_group()
+    remote: RemoteInference = RemoteInference(queue, timeout=5)
+    answer: asyncio.Task = asyncio.create_task(remote(make_conversation('ядовитый')))
+    while not await queue.read('dead', 1, 10):
+        await asyncio.sleep(0.01)
+
+    worker: InferenceWorker = InferenceWorker(
+        queue,
+        EchoInference(),
+        consumer='w3',
+        claim_idle=50,
+        max_deliveries=1
+    )
+    await asyncio.sleep(0.1)
+    await worker.poll(block=10)
+    with pytest.raises(InferenceJobError):
+        await asyncio.wait_for(answer, timeout=5)
+    assert await queue.cache.xlen(queue.stream) == 0
@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+from unittest.mock import AsyncMock
+
+import pytest
+
+from hpc_bot.exceptions import WarmingUpError
+from hpc_bot.metrics import MODEL_READY
+from hpc_bot.model.executor import InferenceExecutor
+from hpc_bot.model.inference import ModelInference
+from hpc_bot.model.loader import ModelLoader
+from hpc_bot.telegram.manager import ModelManager
+
+LOAD_TIME: float = 0.2
+
+
+class SlowInference:
+    """
+    Инференс, веса которого загружаются с задержкой.
+    """
+
+    def __init__(self) -> None:
+        self.model: object | None = None
+        self.warmed: list[tuple[str, int]] = []
+        self.threads: list[str] = []
+
+    def load_model(self) -> None:
+        time.sleep(LOAD_TIME)
+        self.model = object()
+
+    def warm_up(self, prompt: str, max_new_tokens: int) -> str:
+        self.warmed.append((prompt, max_new_tokens))
+        self.threads.append(threading.current_thread().name)
+        return 'ok'
+
+
+@pytest.mark.asyncio
+async def test_requests_rejected_while_loading() -> None:
+    inference: SlowInference = SlowInference()
+    loader: ModelLoader = ModelLoader(
+        InferenceExecutor(inference),
+        prompt='Привет',
+        max_new_tokens=4,
+        wait=0
+    )
+    cache: AsyncMock = AsyncMock(name='mock-cache')
+    manager: ModelManager = ModelManager(inference=AsyncMock(), cache=cache, loader=loader)
+
+    task: asyncio.Task = loader.start()
+    with pytest.raises(WarmingUpError):
+        await manager.answer(1, 'Привет', 'UserMode:window')
+    cache.open_turn.assert_not_awaited()
+    assert MODEL_READY._value.get() == 0
+
+    await task
+    assert loader.ready
+    assert inference.warmed == [('Привет', 4)]
+    # Прогрев идёт в потоке инференса, а не в общем пуле asyncio
+    assert inference.threads[0].startswith('inference')
+    assert MODEL_READY._value.get() == 1
+    await loader.wait_ready()
+
+
+@pytest.mark.asyncio
+async def test_requests_wait_for_model() -> None:
+    loader: ModelLoader = ModelLoader(InferenceExecutor(SlowInference()), prompt='', wait=LOAD_TIME * 5)
+    loader.start()
+    await loader.wait_ready()
+    assert loader.ready
+
+
+@pytest.mark.asyncio
+async def test_failed_load() -> None:
+    inference: SlowInference = SlowInference()
+    inference.load_model = lambda: 1 / 0
+    loader: ModelLoader = ModelLoader(InferenceExecutor(inference))
+    with pytest.raises(ZeroDivisionError):
+        await loader.load()
+    assert not loader.ready
+    with pytest.raises(RuntimeError):
+        await loader.wait_ready()
+
+
+def test_warm_up_keeps_generation_config(tiny_inference: ModelInference) -> None:
+    max_new_tokens: int = tiny_inference.generation_config.max_new_tokens
+    assert isinstance(tiny_inference.warm_up('Привет', 1), str)
+    assert tiny_inference.generation_config.max_new_tokens == max_new_tokens
+
+
+def test_generation_requires_model(tiny_inference: ModelInference) -> None:
+    model = tiny_inference.model
+    tiny_inference.model = None
+    try:
+        with pytest.raises(WarmingUpError):
+            tiny_inference.generate('Привет')
+    finally:
+        tiny_inference.model = model
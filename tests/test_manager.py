@@ -1,9 +1,10 @@
-from unittest.mock import AsyncMock, MagicMock, patch
+from unittest.mock import AsyncMock, patch
 
 import pytest
 from torch.cuda import OutOfMemoryError
 
-from hpc_bot.exceptions import ExistChatError, NoExistChatError
+from hpc_bot.exceptions import ContextOverflowError, ExistChatError, NoExistChatError
+from hpc_bot.model.budget import ContextBudget
 from hpc_bot.model.conversion import DEFAULT_SYSTEM_PROMPT, Conversation, Message, Role
 from hpc_bot.telegram.manager import ModelManager
 
@@ -11,7 +12,7 @@ from hpc_bot.telegram.manager import ModelManager
 @pytest.fixture(scope='module')
 def mock_manager() -> ModelManager:
     return ModelManager(
-        inference=MagicMock(name='mock-inference'),
+        inference=AsyncMock(name='mock-inference'),
         cache=AsyncMock(name='mock-cache')
     )
 
@@ -80,59 +81,45 @@ async def test_answer(mock_manager: ModelManager) -> None:
     original: str = 'Hello, You!'
 
     # Успешный сценарий
-    mock_manager.cache.exist_chat.return_value = True
-    mock_manager.cache.get_correspondence.return_value = []
+    mock_manager.cache.open_turn.return_value = []
     mock_manager.inference.return_value = original
-    output: str = await mock_manager.answer(chat_id, message)
+    output: str = await mock_manager.answer(chat_id, message, 'UserMode:window')
     assert output == original
+    mock_manager.cache.open_turn.assert_called_with(chat_id, Message(role=Role.USER, content=message))
+    mock_manager.cache.close_turn.assert_called_with(chat_id, Message(role=Role.BOT, content=original), 0)
 
     # Случай когда чата ещё нет
-    mock_manager.cache.exist_chat.return_value = False
+    mock_manager.cache.open_turn.return_value = None
     with pytest.raises(NoExistChatError):
-        await mock_manager.answer(chat_id, message)
-    mock_manager.cache.exist_chat.return_value = True
+        await mock_manager.answer(chat_id, message, 'UserMode:window')
 
     # Обработка переполнения в рантайме
     # один раз
     mock_manager.inference.side_effect = [OutOfMemoryError(), original]
-    mock_manager.cache.get_correspondence.return_value = [
+    mock_manager.cache.open_turn.return_value = [
         Message(role=Role.USER, content=message),
         Message(role=Role.BOT, content=message)
     ]
-    output = await mock_manager.answer(chat_id, message * 275)
+    output = await mock_manager.answer(chat_id, message * 275, 'UserMode:window')
     assert output == original
-    assert mock_manager.cache.pop_first_message.called
-    # два раза
-    mock_manager.cache.pop_first_message.reset_mock(return_value=True, side_effect=True)
+    mock_manager.cache.close_turn.assert_called_with(chat_id, Message(role=Role.BOT, content=original), 1)
+    # два раза, сообщения выбрасываются из кэша одной командой вместе с ответом
     mock_manager.inference.side_effect = [OutOfMemoryError(), OutOfMemoryError(), original]
-    mock_manager.cache.get_correspondence.return_value = [
-        Message(role=Role.USER, content=message),
-        Message(role=Role.BOT, content=message)
-    ]
-    output = await mock_manager.answer(chat_id, message * 275)
+    output = await mock_manager.answer(chat_id, message * 275, 'UserMode:window')
     assert output == original
-    assert mock_manager.cache.pop_first_message.call_count == 2
+    mock_manager.cache.close_turn.assert_called_with(chat_id, Message(role=Role.BOT, content=original), 2)
+    assert not mock_manager.cache.pop_first_message.called
 
     # Обработка когда после очистки осталось только системное сообщение
+    mock_manager.inference.side_effect = OutOfMemoryError()
     with pytest.raises(RuntimeError):
-        await mock_manager.answer(chat_id, message * 300)
-        assert mock_manager.pop_first_message.called
-
-    # Обработка предварительного сжатия
-    mock_manager.inference.reset_mock(return_value=True, side_effect=True)
-    mock_manager.inference.return_value = original
-    mock_manager.cache.get_correspondence.return_value = [
-        Message(role=Role.USER, content=message * 500),
-        Message(role=Role.BOT, content=message)
-    ]
-    output = await mock_manager.answer(chat_id, message)
-    assert output == original
-    assert mock_manager.cache.pop_first_message.called
+        await mock_manager.answer(chat_id, message * 300, 'UserMode:window')
 
     # Обработка внезапной ощибки
     mock_manager.inference.side_effect = Exception('test exception')
     with pytest.raises(Exception):
-        await mock_manager.answer(chat_id, message)
+        await mock_manager.answer(chat_id, message, 'UserMode:window')
+    mock_manager.inference.reset_mock(return_value=True, side_effect=True)
 
 
 @pytest.mark.asyncio
@@ -141,3 +128,35 @@ async def test_reset_context(mock_manager: ModelManager) -> None:
 
     await mock_manager.reset_context(chat_id)
     assert mock_manager.cache.clear_conversion.called
+    mock_manager.inference.invalidate.assert_called_with(chat_id)
+
+
+@pytest.mark.asyncio
+async def test_answer_with_budget() -> None:
+    chat_id: int = 1
+    message: str = 'Hello, world!'
+    original: str = 'Hello, You!'
+    manager: ModelManager = ModelManager(
+        inference=AsyncMock(name='mock-inference'),
+        cache=AsyncMock(name='mock-cache'),
+        budget=ContextBudget(len, max_new_tokens=0, max_context=len(DEFAULT_SYSTEM_PROMPT) + 100)
+    )
+    manager.inference.return_value = original
+    manager.cache.open_turn.return_value = [
+        Message(role=Role.USER, content=message * 10),
+        Message(role=Role.BOT, content=message)
+    ]
+
+    # Окно сдвигается заранее одной командой, без ошибок нехватки памяти
+    output: str = await manager.answer(chat_id, message, 'UserMode:window')
+    assert output == original
+    assert manager.inference.call_count == 1
+    manager.cache.close_turn.assert_called_once_with(chat_id, Message(role=Role.BOT, content=original), 1)
+    assert not manager.cache.pop_first_message.called
+
+    # В линейном режиме переполнение сообщается до генерации, сообщение убирается из кэша
+    manager.inference.reset_mock()
+    with pytest.raises(ContextOverflowError):
+        await manager.answer(chat_id, message, 'UserMode:inline')
+    assert not manager.inference.called
+    manager.cache.pop_last_message.assert_called_once_with(chat_id)
@@ -0,0 +1,37 @@
+import os
+from pathlib import Path
+
+from hpc_bot.metrics import FolderSize, depth_buckets
+
+
+def test_folder_size(tmp_path: Path) -> None:
+    (tmp_path / 'blobs').mkdir()
+    (tmp_path / 'blobs' / 'weights').write_bytes(b'0' * 100)
+    (tmp_path / 'snapshots').mkdir()
+    os.symlink(tmp_path / 'blobs' / 'weights', tmp_path / 'snapshots' / 'weights')
+
+    get_size: FolderSize = FolderSize()
+    assert get_size(str(tmp_path)) == 100
+
+    (tmp_path / 'blobs' / 'config').write_bytes(b'0' * 10)
+    assert get_size(str(tmp_path)) == 110
+
+    # Дописанный файл не меняет время изменения директории, но учитывается
+    with open(tmp_path / 'blobs' / 'config', 'ab') as file:
+        file.write(b'0' * 5)
+    assert get_size(str(tmp_path)) == 115
+
+    (tmp_path / 'blobs' / 'weights').unlink()
+    (tmp_path / 'blobs' / 'config').unlink()
+    (tmp_path / 'blobs').rmdir()
+    assert get_size(str(tmp_path)) == 0
+    assert get_size(str(tmp_path / 'missing')) == 0
+
+
+def test_depth_buckets() -> None:
+    buckets: dict[float, int] = depth_buckets([1, 2, 3, 100, 10_000])
+    assert buckets[2] == 2
+    assert buckets[4] == 3
+    assert buckets[64] == 3
+    assert buckets[128] == 4
+    assert buckets[float('inf')] == 5
@@ -0,0 +1,97 @@
+import torch
+
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.inference import ModelInference
+from hpc_bot.model.prefix_cache import PastKeyValues, PrefixCache, past_size
+
+
+def make_past(length: int, layers: int = 2) -> PastKeyValues:
+    return tuple(
+        (torch.zeros(1, 2, length, 4), torch.zeros(1, 2, length, 4))
+        for _ in range(layers)
+    )
+
+
+def test_lookup_common_prefix() -> None:
+    cache: PrefixCache = PrefixCache()
+    cache.store(1, torch.tensor([1, 2, 3, 4]), make_past(4))
+
+    covered, past = cache.lookup(1, torch.tensor([1, 2, 3, 4, 5, 6]))
+    assert covered == 4
+    assert past[0][0].shape[2] == 4
+
+    covered, past = cache.lookup(1, torch.tensor([1, 2, 9, 9]))
+    assert covered == 2
+    assert past[0][0].shape[2] == 2
+
+    # Последний токен промпта всегда остаётся для генерации
+    covered, _ = cache.lookup(1, torch.tensor([1, 2, 3]))
+    assert covered == 2
+
+    assert cache.lookup(2, torch.tensor([1, 2, 3])) == (0, None)
+
+
+def test_lru_eviction_and_invalidation() -> None:
+    entry_size: int = past_size(make_past(4))
+    cache: PrefixCache = PrefixCache(budget=entry_size * 2)
+    cache.store(1, torch.tensor([1, 2, 3, 4]), make_past(4))
+    cache.store(2, torch.tensor([1, 2, 3, 4]), make_past(4))
+    cache.lookup(1, torch.tensor([1, 2, 3, 4, 5]))
+    cache.store(3, torch.tensor([1, 2, 3, 4]), make_past(4))
+
+    assert len(cache) == 2
+    assert cache.size == entry_size * 2
+    assert cache.lookup(2, torch.tensor([1, 2, 3])) == (0, None)
+
+    cache.invalidate(1)
+    assert len(cache) == 1
+    assert cache.size == entry_size
+
+    cache.store(4, torch.tensor([1, 2, 3, 4, 5, 6, 7, 8, 9]), make_past(9))
+    assert cache.lookup(4, torch.tensor([1, 2, 3])) == (0, None)
+
+
+def test_cached_generation_matches_full_prefill(tiny_inference: ModelInference) -> None:
+    chat_id: int = 42
+    tiny_inference.prefix_cache.invalidate(chat_id)
+    conversation: Conversation = Conversation(chat_id=chat_id)
+
+    for question in ('Привет', 'Что такое KV кэш?', 'Спасибо'):
+        conversation.append(Message(role=Role.USER, content=question))
+        expected: str = tiny_inference.generate(conversation.get_prompt())
+        assert tiny_inference(conversation) == expected
+        conversation.append(Message(role=Role.BOT, content=expected))
+
+    assert len(tiny_inference.prefix_cache) >= 1
+    tiny_inference.prefix_cache.invalidate(chat_id)
+
+
+def test_shared_system_prefix(tiny_inference: ModelInference) -> None:
+    conversation: Conversation = Conversation(messages=[
+        Message(role=Role.SYSTEM, content='Ты тестовый ассистент.'),
+        Message(role=Role.USER, content='Привет')
+    ])
+    prompt: str = tiny_inference.render(conversation)
+    input_ids: torch.Tensor = tiny_inference.tokenizer(
+        prompt,
+        return_tensors='pt',
+        add_special_tokens=False
+    )['input_ids']
+    expected: str = tiny_inference.tokenizer.decode(
+        tiny_inference.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            generation_config=tiny_inference.generation_config
+        )[0, input_ids.shape[1]:],
+        skip_special_tokens=True
+    ).strip()
+
+    assert tiny_inference(conversation) == expected
+    assert tiny_inference.prefix_cache.shared_text == conversation.system_prefix
+
+    covered, _ = tiny_inference.prefix_cache.lookup(None, input_ids[0])
+    assert covered >= len(tiny_inference.tokenizer(conversation.system_prefix)['input_ids']) - 1
+
+    # Вернуть системный промпт по умолчанию для остальных тестов
+    tiny_inference(Conversation())
+    assert tiny_inference.prefix_cache.shared_text == Conversation().system_prefix
@@ -0,0 +1,87 @@
+from unittest.mock import AsyncMock
+
+import pytest
+from transformers import GenerationConfig
+
+from hpc_bot.model.conversion import DEFAULT_SYSTEM_PROMPT, Conversation, Message, Role
+from hpc_bot.telegram.manager import ModelManager
+from hpc_bot.telegram.response_cache import ResponseCache
+
+
+class MemoryResponses:
+    """
+    Ответы модели в памяти процесса вместо Redis.
+    """
+
+    def __init__(self) -> None:
+        self.responses: dict[str, tuple[str, float]] = {}
+
+    async def get_response(self, digest: str) -> tuple[str, float] | None:
+        return self.responses.get(digest)
+
+    async def put_response(
+        self,
+        digest: str,
+        text: str,
+        seconds: float,
+        ttl: int,
+        max_entries: int
+    ) -> None:
+        self.responses[digest] = (text, seconds)
+
+
+def build_manager(responses: ResponseCache) -> ModelManager:
+    cache: AsyncMock = AsyncMock(name='mock-cache')
+    cache.open_turn.return_value = []
+    inference: AsyncMock = AsyncMock(name='mock-inference', return_value='Hi!')
+    return ModelManager(inference=inference, cache=cache, responses=responses)
+
+
+@pytest.mark.asyncio
+async def test_repeated_prompt_is_answered_from_cache() -> None:
+    responses: ResponseCache = ResponseCache(MemoryResponses(), 'model', GenerationConfig(do_sample=False))
+    manager: ModelManager = build_manager(responses)
+
+    assert await manager.answer(1, 'Hello', 'UserMode:window') == 'Hi!'
+    assert await manager.answer(2, 'Hello', 'UserMode:inline') == 'Hi!'
+    assert manager.inference.await_count == 1
+    assert manager.cache.close_turn.await_count == 2
+
+    chunks: list[str] = [chunk async for chunk in manager.answer_stream(3, 'Hello', 'UserMode:window')]
+    assert chunks == ['Hi!']
+    assert manager.inference.await_count == 1
+
+    await manager.answer(4, 'Bye', 'UserMode:window')
+    assert manager.inference.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_key_depends_on_model_and_config() -> None:
+    storage: MemoryResponses = MemoryResponses()
+    conversation: Conversation = Conversation(messages=[
+        Message(role=Role.SYSTEM, content=DEFAULT_SYSTEM_PROMPT),
+        Message(role=Role.USER, content='Hello')
+    ])
+    greedy: ResponseCache = ResponseCache(storage, 'model', GenerationConfig(max_new_tokens=8))
+    await greedy.put(conversation, 'Hi!', 1.0)
+    assert await greedy.get(conversation) == 'Hi!'
+    other_model: ResponseCache = ResponseCache(storage, 'other', GenerationConfig(max_new_tokens=8))
+    assert await other_model.get(conversation) is None
+    other_config: ResponseCache = ResponseCache(storage, 'model', GenerationConfig(max_new_tokens=16))
+    assert await other_config.get(conversation) is None
+
+    # Длинные переписки не кэшируются, совпадений у них почти не бывает
+    conversation.extend([Message(role=Role.BOT, content='Hi!'), Message(role=Role.USER, content='Hello')])
+    assert not greedy.eligible(conversation)
+
+
+@pytest.mark.asyncio
+async def test_sampling_disables_cache() -> None:
+    storage: MemoryResponses = MemoryResponses()
+    responses: ResponseCache = ResponseCache(storage, 'model', GenerationConfig(do_sample=True))
+    manager: ModelManager = build_manager(responses)
+
+    await manager.answer(1, 'Hello', 'UserMode:window')
+    await manager.answer(2, 'Hello', 'UserMode:window')
+    assert manager.inference.await_count == 2
+    assert not storage.responses
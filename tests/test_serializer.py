@@ -0,0 +1,94 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+
+from hpc_bot.telegram.common_handlers import conversation_handler
+from hpc_bot.telegram.messages import CONFUSED_TEXT
+from hpc_bot.telegram.serializer import ChatSerializer
+
+
+class MemoryTurnCache:
+    """
+    Входящие и блокировки ходов в памяти вместо Redis.
+    """
+
+    def __init__(self) -> None:
+        self.inbox: dict[int, list[str]] = {}
+        self.locks: dict[int, str] = {}
+
+    async def enqueue_message(self, chat_id: int, text: str, token: str, ttl: int) -> bool:
+        self.inbox.setdefault(chat_id, []).append(text)
+        return self.locks.setdefault(chat_id, token) == token
+
+    async def take_messages(self, chat_id: int) -> list[str]:
+        return self.inbox.pop(chat_id, [])
+
+    async def release_turn(self, chat_id: int, token: str, force: bool = False) -> bool:
+        if self.locks.get(chat_id) != token:
+            return True
+        if not force and self.inbox.get(chat_id):
+            return False
+        del self.locks[chat_id]
+        return True
+
+    async def refresh_turn(self, chat_id: int, token: str, ttl: int) -> bool:
+        return self.locks.get(chat_id) == token
+
+
+@pytest.mark.asyncio
+async def test_messages_coalesced_while_generating() -> None:
+    cache: MemoryTurnCache = MemoryTurnCache()
+    serializer: ChatSerializer = ChatSerializer(cache)
+    turns: list[str] = []
+    started: asyncio.Event = asyncio.Event()
+
+    async def handle(text: str) -> None:
+        turns.append(text)
+        started.set()
+        await asyncio.sleep(0.05)
+
+    first: asyncio.Task = asyncio.create_task(serializer.run(1, 'a', handle))
+    await started.wait()
+    results: list[bool] = await asyncio.gather(
+        serializer.run(1, 'b', handle),
+        serializer.run(1, 'c', handle),
+        serializer.run(2, 'x', handle)
+    )
+
+    assert await first
+    assert results == [False, False, True]
+    assert turns == ['a', 'x', 'b\nc']
+    assert not cache.locks and not cache.inbox
+
+
+@pytest.mark.asyncio
+async def test_turn_released_on_error() -> None:
+    cache: MemoryTurnCache = MemoryTurnCache()
+    serializer: ChatSerializer = ChatSerializer(cache)
+
+    async def handle(text: str) -> None:
+        await cache.enqueue_message(1, 'late', 'other', 0)
+        raise RuntimeError(text)
+
+    with pytest.raises(RuntimeError):
+        await serializer.run(1, 'a', handle)
+    assert not cache.locks
+
+
+@pytest.mark.asyncio
+async def test_handler_answers_serialize_errors() -> None:
+    state: AsyncMock = AsyncMock(name='state')
+    state.get_state.return_value = 'UserMode:inline'
+    manager: AsyncMock = AsyncMock(name='manager')
+    manager.serialize.side_effect = ConnectionError('redis')
+
+    # Сообщение без текста не доходит до сериализатора
+    sticker: AsyncMock = AsyncMock(name='sticker', text=None)
+    await conversation_handler(sticker, manager, state)
+    sticker.answer.assert_called_once_with(CONFUSED_TEXT)
+    assert not manager.serialize.called
+
+    message: AsyncMock = AsyncMock(name='message', text='Привет')
+    await conversation_handler(message, manager, state)
+    message.answer.assert_called_once_with(CONFUSED_TEXT)
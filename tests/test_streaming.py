@@ -0,0 +1,82 @@
+from typing import AsyncIterator
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.executor import InferenceExecutor
+from hpc_bot.model.inference import ModelInference
+from hpc_bot.telegram.manager import ModelManager
+from hpc_bot.telegram.messages import EMPTY_ANSWER_TEXT
+from hpc_bot.telegram.streaming import stream_answer
+
+
+async def fake_chunks(count: int) -> AsyncIterator[str]:
+    for i in range(count):
+        yield f'слово{i} '
+
+
+@pytest.mark.asyncio
+async def test_executor_stream(tiny_inference: ModelInference) -> None:
+    executor: InferenceExecutor = InferenceExecutor(tiny_inference)
+    conversation: Conversation = Conversation()
+    chunks: list[str] = [chunk async for chunk in executor.stream(conversation)]
+
+    assert ''.join(chunks).strip() == tiny_inference(conversation)
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_stream_answer_coalesces_edits() -> None:
+    placeholder: AsyncMock = AsyncMock(name='placeholder')
+    message: AsyncMock = AsyncMock(name='message')
+    message.answer.return_value = placeholder
+
+    text: str = await stream_answer(message, fake_chunks(20), edit_interval=60)
+    assert text == ''.join([f'слово{i} ' for i in range(20)]).strip()
+    assert message.answer.call_count == 1
+    # Первый кусок показывается сразу, остальные объединяются в финальную правку
+    assert [call.args[0] for call in placeholder.edit_text.call_args_list] == ['слово0', text]
+
+    placeholder.reset_mock()
+    await stream_answer(message, fake_chunks(20), edit_interval=0)
+    assert placeholder.edit_text.call_count == 20
+
+
+@pytest.mark.asyncio
+async def test_stream_answer_removes_placeholder_on_error() -> None:
+    async def broken_chunks() -> AsyncIterator[str]:
+        yield 'начало '
+        raise RuntimeError('broken')
+
+    placeholder: AsyncMock = AsyncMock(name='placeholder')
+    message: AsyncMock = AsyncMock(name='message')
+    message.answer.return_value = placeholder
+
+    with pytest.raises(RuntimeError):
+        await stream_answer(message, broken_chunks())
+    assert placeholder.delete.called
+
+
+@pytest.mark.asyncio
+async def test_stream_answer_replaces_placeholder_on_empty_answer() -> None:
+    placeholder: AsyncMock = AsyncMock(name='placeholder')
+    message: AsyncMock = AsyncMock(name='message')
+    message.answer.return_value = placeholder
+
+    assert await stream_answer(message, fake_chunks(0), edit_interval=0) == ''
+    placeholder.edit_text.assert_called_once_with(EMPTY_ANSWER_TEXT)
+    assert not placeholder.delete.called
+
+
+@pytest.mark.asyncio
+async def test_answer_stream_persists_answer() -> None:
+    inference: MagicMock = MagicMock(name='mock-inference')
+    inference.stream = lambda conversation: fake_chunks(3)
+    cache: AsyncMock = AsyncMock(name='mock-cache')
+    cache.open_turn.return_value = []
+    manager: ModelManager = ModelManager(inference=inference, cache=cache)
+
+    chunks: list[str] = [chunk async for chunk in manager.answer_stream(1, 'Привет', 'UserMode:inline')]
+    assert chunks == ['слово0 ', 'слово1 ', 'слово2 ']
+    cache.close_turn.assert_called_with(1, Message(role=Role.BOT, content='слово0 слово1 слово2'), 0)
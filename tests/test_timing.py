@@ -0,0 +1,50 @@
+import torch
+from prometheus_client import REGISTRY
+
+from hpc_bot.model.conversion import Conversation, Message, Role
+from hpc_bot.model.inference import ModelInference
+from hpc_bot.model.timing import PhaseTimer, generated_lengths
+
+
+def sample_count(name: str, mode: str) -> float:
+    return REGISTRY.get_sample_value(f'{name}_count', {'mode': mode}) or 0.0
+
+
+def test_generated_lengths() -> None:
+    output_ids: torch.Tensor = torch.tensor([
+        [5, 6, 2, 0],
+        [5, 6, 7, 8],
+        [2, 0, 0, 0],
+    ])
+    assert generated_lengths(output_ids, 2) == [3, 4, 1]
+    assert generated_lengths(output_ids, [2, 8]) == [3, 4, 1]
+    assert generated_lengths(output_ids, None) == [4, 4, 4]
+
+
+def test_phase_timer() -> None:
+    timer: PhaseTimer = PhaseTimer()
+    timer.mark_prefill()
+    timer.put(torch.tensor([[1, 2, 3]]))
+    assert timer.first_token is None
+    timer.put(torch.tensor([4]))
+    timer.put(torch.tensor([5]))
+    timer.end()
+    assert 0 <= timer.prefill_time <= timer.time_to_first_token
+    assert timer.decode_time >= 0
+
+
+def test_inference_phases_labelled_by_mode(tiny_inference: ModelInference) -> None:
+    names: tuple[str, ...] = (
+        'inference_prompt_tokens',
+        'inference_generated_tokens',
+        'inference_prefill_seconds',
+        'inference_time_to_first_token_seconds',
+        'inference_detokenize_seconds',
+    )
+    before: dict[str, float] = {name: sample_count(name, 'window') for name in names}
+    conversation: Conversation = Conversation(mode='window')
+    conversation.append(Message(role=Role.USER, content='Привет'))
+    tiny_inference(conversation)
+    for name in names:
+        assert sample_count(name, 'window') == before[name] + 1
+    assert REGISTRY.get_sample_value('inference_prompt_tokens_sum', {'mode': 'window'}) >= 1
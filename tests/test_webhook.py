@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiohttp.test_utils import TestClient, TestServer
+
+from hpc_bot.telegram.webhook import WEBHOOK_PATH, build_application
+
+FAKE_TOKEN: str = '123456:' + 'A' * 35
+
+
+def make_update(update_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': 1, 'type': 'private'},
+            'text': str(update_id),
+        },
+    }
+
+
+@pytest.mark.asyncio
+async def test_webhook_acks_before_processing() -> None:
+    dispatcher: Dispatcher = Dispatcher()
+    release: asyncio.Event = asyncio.Event()
+    handled: list[str] = []
+
+    @dispatcher.message()
+    async def slow(message: Message) -> None:
+        await release.wait()
+        handled.append(message.text)
+
+    app = build_application(dispatcher, Bot(FAKE_TOKEN), workers=2, max_pending=2)
+    async with TestClient(TestServer(app)) as client:
+        statuses: list[int] = []
+        for update_id in range(5):
+            response = await client.post(WEBHOOK_PATH, json=make_update(update_id))
+            statuses.append(response.status)
+            await asyncio.sleep(0)
+
+        # Две задачи заняты, ещё два обновления ждут в очереди, остальное отклонено
+        assert statuses == [200, 200, 200, 200, 503]
+        assert handled == []
+
+        release.set()
+        for _ in range(100):
+            if len(handled) == 4:
+                break
+            await asyncio.sleep(0.01)
+        assert sorted(handled) == ['0', '1', '2', '3']